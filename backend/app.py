@@ -1,10 +1,21 @@
 import os
-from flask import Flask, request, abort, jsonify, render_template, redirect
+from datetime import datetime, timezone
+from flask import Flask, Response, request, abort, jsonify, render_template, redirect, stream_with_context
 from models import setup_db
 from flask_cors import CORS
 from flask_migrate import Migrate
-from models import db, Forum, Thread, Page, Post, User
+from sqlalchemy.exc import DBAPIError, IntegrityError
+from werkzeug.exceptions import HTTPException
+from models import db, Forum, Thread, Page, Post, User, THREAD_ORDERS, page_for_seq, unit_of_work, user_name_cache, read_replica, replica_set, violated_constraint
 from auth import AuthError, requires_auth
+from cache import cached_response, response_cache
+from search import SEARCH_TYPES, include_object, search_content, search_index_missing
+from instrumentation import init_instrumentation, route_stats
+from metrics import init_metrics
+from json_provider import init_json
+from roles_and_status import ForumRoles, UserStatus
+import queries
+import moderation
 
 
 def create_app(test_config=None):
@@ -16,10 +27,18 @@ def create_app(test_config=None):
     :return: Flask application instance
     """
     app = Flask(__name__)
+    init_json(app)
+    engines = []
     if test_config is None:
         with app.app_context():
             setup_db(app)
+            engines = [db.engine] + replica_set.engines
+    else:
+        # Test databases are dropped and recreated between runs, which the shared cache can't see
+        app.config['RESPONSE_CACHE'] = False
     CORS(app)
+    init_instrumentation(app, engines)
+    metrics_view = init_metrics(app)
 
     @app.after_request
     def after_request(response):
@@ -39,6 +58,15 @@ def create_app(test_config=None):
     def get_home():
         return render_template('index.html')
     
+    @app.route('/metrics', methods=['GET'])
+    def get_metrics():
+        """
+        Request, database pool, cache and worker metrics in the Prometheus text format, summed across workers.
+
+        :return: Prometheus exposition text
+        """
+        return metrics_view()
+
     @app.route('/admin/create/forum', methods=['POST'])
     @requires_auth('admin')
     def create_forum(jwt):
@@ -58,32 +86,73 @@ def create_app(test_config=None):
         exception = None
         try:
             data = request.get_json()
-            if len(Forum.query.filter(Forum.name == data.get('name')).all()) > 0:
-                exception = 409
-                raise Exception()
-            else:
-                new_forum = Forum(**data)
-                new_forum.insert()
-                response = {
-                    'status': 'SUCCESS',
-                    'message': 'Forum successfully created'
-                }
+            new_forum = Forum(**data)
+            # uq_forums_name rejects duplicates, so there is no lookup before the insert
+            new_forum.insert()
+            response_cache.bump('forums')
+            response = {
+                'status': 'SUCCESS',
+                'message': 'Forum successfully created'
+            }
+        except IntegrityError as e:
+            db.session.rollback()
+            exception = 409 if violated_constraint(e, Forum.__table__) == 'uq_forums_name' else 400
         except Exception:
-            if exception == 409:
-                abort(409)
-            abort(500)
+            db.session.rollback()
+            exception = 500
+        if exception:
+            abort(exception)
         return jsonify(response)
     
     @app.route('/admin/users', methods=['GET'])
     @requires_auth('admin')
+    @read_replica('users')
     def get_user_list(jwt):
         """
-        Gets user list for admin portal
+        Gets one page of the user list for the admin portal, or streams every matching user as NDJSON.
+
+        :return: JSON response with success status, users and the cursor for the next page
+        :Query parameters:
+            role: str - Only users with this role
+            status: str - Only users with this status
+            name: str - Only users whose name starts with this, ignoring case
+            limit: int - Maximum number of users to return, default 50, at most 100
+            cursor: str - next_cursor from the previous page
+            format: str - "ndjson" streams every matching user after cursor, one JSON object per line, ignoring limit
+        """
+        role = request.args.get('role')
+        status = request.args.get('status')
+        if role is not None and role not in {member.value for member in ForumRoles}:
+            abort(400)
+        if status is not None and status not in {member.value for member in UserStatus}:
+            abort(400)
+        filters = {'role': role, 'status': status, 'name_prefix': request.args.get('name'), 'cursor': request.args.get('cursor')}
+        try:
+            if request.args.get('format') == 'ndjson':
+                batches = queries.stream_users(**filters)
+                lines = (''.join(app.json.dumps(user) + '\n' for user in batch) for batch in batches)
+                return Response(stream_with_context(lines), mimetype='application/x-ndjson')
+            limit = min(max(int(request.args.get('limit', 50)), 1), 100)
+            users, next_cursor = queries.page_users(limit, **filters)
+        except ValueError:
+            abort(400)
+        return {
+            'status': 'SUCCESS',
+            'users': users,
+            'next_cursor': next_cursor
+        }
+    
+    @app.route('/admin/sql-stats', methods=['GET'])
+    @requires_auth('admin')
+    def get_sql_stats(jwt):
+        """
+        Gets per route SQL statement counts and timings collected by this worker process.
+        Empty unless SQL_INSTRUMENTATION is enabled.
         """
-        users = [user.format() for user in User.query.all()]
         return {
             'status': 'SUCCESS',
-            'users': users
+            'enabled': app.config['SQL_INSTRUMENTATION'],
+            'routes': route_stats.snapshot()
         }
     
     @app.route('/admin/user', methods=['POST'])
@@ -109,6 +178,7 @@ def create_app(test_config=None):
         try:
             user = User(id=user_id, name=name, role=role)
             user.insert()
+            response_cache.bump('users')
             formatted_user = user.format()
             return jsonify({
                 'status': 'SUCCESS',
@@ -152,6 +222,7 @@ def create_app(test_config=None):
         if data.get('duration'):
             user.set_probation(data.get('duration'))
         user.update()
+        response_cache.bump('users')
         return {
             'status': 'SUCCESS',
             'message': 'User Status updated!',
@@ -159,32 +230,49 @@ def create_app(test_config=None):
         }
 
     @app.route('/all', methods=['GET'])
+    @cached_response('forums')
+    @read_replica('forums')
     def get_forums():
         """
         Retrieves the list of forums.
 
         :return: JSON response with success status and list of forums
         """
-        forums = [forum.format() for forum in Forum.query.all()]
         return {
             'status': 'SUCCESS',
-            'forums': forums
+            'forums': queries.list_forums()
         }
     @app.route('/forum/<int:forum_id>', methods=['GET'])
+    @cached_response('forum:{forum_id}')
+    @read_replica('forum:{forum_id}')
     def get_forum(forum_id):
         """
-        Retrieves a specific forum and its threads.
+        Retrieves a specific forum and one page of its threads.
 
         :param forum_id: The ID of the forum
         :type forum_id: int
-        :return: JSON response with success status, forum, and threads
+        :return: JSON response with success status, forum, threads and the cursor for the next page
+        :Query parameters:
+            order: str - "activity" (default) for most recent reply first, "created" for newest thread first
+            limit: int - Maximum number of threads to return, default 50, at most 100
+            cursor: str - next_cursor from the previous page
         """
-        forum = Forum.query.get(forum_id)
-        threads = [thread.format() for thread in forum.format_threads()['threads']]
+        forum = queries.get_forum(forum_id)
+        if forum is None:
+            abort(404)
+        order = request.args.get('order', 'activity')
+        if order not in THREAD_ORDERS:
+            abort(400)
+        try:
+            limit = min(max(int(request.args.get('limit', 50)), 1), 100)
+            threads, next_cursor = queries.list_forum_threads(forum_id, order, limit, request.args.get('cursor'))
+        except ValueError:
+            abort(400)
         return { 
             'status': 'SUCCESS',
-            'forum': forum.format(),
-            'threads': threads or []
+            'forum': forum,
+            'threads': threads,
+            'next_cursor': next_cursor
         }
     
     @app.route('/forum/<int:forum_id>', methods=['POST'])
@@ -206,32 +294,24 @@ def create_app(test_config=None):
         """
         data = request.get_json()
         user_id = jwt['user_id']
-        thread = Thread(forum_id=forum_id, title=data['title'], user_id=user_id)
-        thread.insert()
-
-        add_post(thread, user_id, data['content'])
+        with unit_of_work():
+            thread = Thread(forum_id=forum_id, title=data['title'], user_id=user_id)
+            thread.insert()
+            add_post(thread, user_id, data['content'])
+        response_cache.bump(f'forum:{forum_id}')
         return {
             'status': 'SUCCESS',
             'thread': thread.get_page_posts(1)
         }
 
     
-    def create_page(thread):
-        """
-        Creates a new page for the specified thread.
-
-        :param thread: The thread instance
-        :type thread: Thread
-        :return: New page instance
-        """
-        page_number = len(thread.pages) + 1
-        new_page = Page(thread_id=thread.id, page_number=page_number)
-        new_page.insert()
-        return new_page
-    
     def add_post(thread, user_id, content):
         """
         Adds a new post to the specified thread.
+        The post's sequence number decides its page, creating the page when the post is its first.
+        Call inside unit_of_work() so the counter update, page and post commit together.
+        The post row is written first and the thread counter is reserved last, which keeps the window where
+        other posters in the thread wait on its row lock down to a few small statements before the commit.
 
         :param thread: The thread instance
         :type thread: Thread
@@ -240,17 +320,19 @@ def create_app(test_config=None):
         :param content: The content of the post
         :type content: str
         """
-        page = None
-        len_pages = len(thread.pages)
-        if len_pages == 0:
-            page = create_page(thread)
-        else:
-            page = thread.pages[len_pages - 1]
-        
-        post = Post(user_id=user_id, page_id=page.id, content=content)
+        date_created = datetime.utcnow()
+        post = Post(user_id=user_id, thread_id=thread.id, content=content, date_created=date_created)
         post.insert()
 
+        seq = thread.next_post_seq(user_id, date_created)
+        page_id = Page.ensure(thread.id, page_for_seq(seq))
+        post.seq = seq
+        post.page_id = page_id
+        post.update()
+
     @app.route('/threads/<int:thread_id>', methods=['GET'])
+    @cached_response('thread:{thread_id}')
+    @read_replica('thread:{thread_id}')
     def get_thread(thread_id):
         """
         Retrieves a specific thread.
@@ -268,7 +350,99 @@ def create_app(test_config=None):
         abort(404)
         
 
+    @app.route('/search', methods=['GET'])
+    @read_replica()
+    def search_forums():
+        """
+        Full text search over post contents or thread titles, best match first.
+
+        :return: JSON response with success status, ranked results and the cursor for the next page
+        :Query parameters:
+            q: str - Search terms
+            type: str - "posts" (default) or "threads"
+            forum_id: int, optional - Only return results from this forum
+            user_id: str, optional - Only return results written by this user
+            limit: int - Maximum number of results, default 20, at most 100
+            cursor: str - next_cursor from the previous page
+        """
+        q = request.args.get('q', '').strip()
+        search_type = request.args.get('type', 'posts')
+        if not q or search_type not in SEARCH_TYPES:
+            abort(400)
+        try:
+            forum_id = request.args.get('forum_id')
+            limit = min(max(int(request.args.get('limit', 20)), 1), 100)
+            results, next_cursor = search_content(
+                q,
+                search_type,
+                forum_id=int(forum_id) if forum_id is not None else None,
+                user_id=request.args.get('user_id'),
+                limit=limit,
+                cursor=request.args.get('cursor')
+            )
+        except ValueError:
+            abort(400)
+        except DBAPIError as e:
+            if not search_index_missing(e):
+                raise
+            db.session.rollback()
+            abort(503, 'Search is not available until the search index is built.')
+        return {
+            'status': 'SUCCESS',
+            'results': results,
+            'next_cursor': next_cursor
+        }
+
+    @app.route('/threads/<int:thread_id>/posts', methods=['GET'])
+    @cached_response('thread:{thread_id}', 'user-names')
+    @read_replica('thread:{thread_id}', 'user-names')
+    def get_posts_since(thread_id):
+        """
+        Retrieves the posts added to a thread after a cursor, for clients polling for new replies.
+
+        :param thread_id: The ID of the thread
+        :type thread_id: int
+        :return: JSON response with success status, the new posts and the cursor to poll with next
+        :Query parameters:
+            cursor: str - next_cursor from a previous response
+            after: int - ID of the last post the client has, when it has no cursor
+            since: str - ISO-8601 timestamp, returns posts created after it when there is no cursor or post ID
+            limit: int - Maximum number of posts to return, default 40, at most 100
+        """
+        thread = Thread.query.get(thread_id)
+        if thread is None:
+            abort(404)
+        try:
+            limit = min(max(int(request.args.get('limit', 40)), 1), 100)
+            if 'cursor' in request.args:
+                seq = int(request.args['cursor'])
+            elif 'after' in request.args:
+                post = Post.query.get(int(request.args['after']))
+                if post is None or post.thread_id != thread.id:
+                    abort(404)
+                seq = post.seq
+            elif 'since' in request.args:
+                since = datetime.fromisoformat(request.args['since'])
+                if since.tzinfo is not None:
+                    since = since.astimezone(timezone.utc).replace(tzinfo=None)
+                seq = thread.seq_before(since)
+            else:
+                seq = 0
+        except ValueError:
+            abort(400)
+        posts = thread.get_posts_after(seq, limit + 1)
+        has_more = len(posts) > limit
+        posts = posts[:limit]
+        return {
+            'status': 'SUCCESS',
+            'posts': posts,
+            'next_cursor': str(posts[-1]['seq'] if posts else seq),
+            'has_more': has_more
+        }
+
     @app.route('/threads/<int:thread_id>/<int:page_number>', methods=['GET'])
+    @cached_response('thread:{thread_id}', 'user-names')
+    @read_replica('thread:{thread_id}', 'user-names')
     def get_thread_page(thread_id, page_number):
         """
         Retrieves a specific page of a thread.
@@ -280,20 +454,16 @@ def create_app(test_config=None):
         :return: JSON response with success status and page information
         """
         try:
-            thread = Thread.query.get(thread_id)
-            page = thread.get_page_posts(page_number)
-            users = {}
-            for post in page['posts']:
-                if post['user_id'] not in users.keys():
-                    users[post['user_id']] = User.query.filter(User.id == post['user_id']).one().name
-                post['user_name'] = users[post['user_id']]
-            return {
-                'status': 'SUCCESS',
-                'page': page
-            }
-        except Exception as e:
-            print(e)
-            abort(500)
+            page = queries.get_thread_page(thread_id, page_number)
+        except (LookupError, IndexError):
+            abort(404)
+        users = user_name_cache.get_many(post['user_id'] for post in page['posts'])
+        for post in page['posts']:
+            post['user_name'] = users[post['user_id']]
+        return {
+            'status': 'SUCCESS',
+            'page': page
+        }
     
     @app.route('/threads/<int:thread_id>', methods=['POST'])
     @requires_auth('post:post')
@@ -315,15 +485,18 @@ def create_app(test_config=None):
             data = request.get_json()
             user_id = jwt['user_id']
             content = data['content']
-            thread = Thread.query.get(thread_id)
-            page = thread.pages[-1]
-            if len(page.posts) + 1 > 40:
-                create_page(thread)
-            add_post(thread, user_id, content)
+            with unit_of_work():
+                thread = Thread.query.get(thread_id)
+                if thread.locked and not jwt['admin']:
+                    abort(403, 'This thread is locked.')
+                add_post(thread, user_id, content)
+            response_cache.bump(f'thread:{thread.id}', f'forum:{thread.forum_id}')
             return {
                 'status': 'SUCCESS',
                 'thread': thread.format()
             }
+        except HTTPException:
+            raise
         except:
             abort(400)
         
@@ -354,10 +527,11 @@ def create_app(test_config=None):
         if post is not None and (jwt['admin'] or (user_id is not None and post.user_id == user_id)):
             post.content = content
             post.update()
+            response_cache.bump(f'thread:{post.thread_id}')
             return {
                 'status': 'SUCCESS',
             }
-        abort(503)
+        abort(503, 'Request is not valid.')
 
     @app.route('/threads/<int:thread_id>', methods=['DELETE'])
     @requires_auth('delete:post')
@@ -383,10 +557,189 @@ def create_app(test_config=None):
             abort(404)
         if post is not None and (jwt['admin'] or (user_id is not None and post.user_id == user_id)):
             post.delete()
+            response_cache.bump(f'thread:{post.thread_id}')
             return {
                 'status': 'SUCCESS'
             }
-        abort(503)
+        abort(503, 'Request is not valid.')
+
+    def moderate_posts(action, **kwargs):
+        try:
+            filters = moderation.filters_from_json(request.get_json(silent=True))
+        except (TypeError, ValueError):
+            abort(400)
+        with unit_of_work():
+            count, thread_ids = action(**kwargs, **filters)
+        if thread_ids:
+            response_cache.bump(*(f'thread:{thread_id}' for thread_id in thread_ids))
+        return {
+            'status': 'SUCCESS',
+            'posts': count,
+            'threads': sorted(thread_ids)
+        }
+
+    @app.route('/admin/posts/delete', methods=['POST'])
+    @requires_auth('admin')
+    def bulk_delete_posts(jwt):
+        """
+        Deletes many posts at once: a list of posts, or everything a user wrote, optionally limited to one forum
+        or a date range. Runs in one transaction.
+
+        :param jwt: JSON Web Token for authentication
+        :type jwt: str
+        :return: JSON response with success status, the number of posts deleted and the IDs of their threads
+        :Request JSON:
+            {
+                "post_ids": [int] - The IDs of the posts to delete,
+                "user_id": str - Delete posts by this user,
+                "forum_id": int - Only posts in this forum (optional),
+                "since": str - Only posts created at or after this ISO-8601 timestamp (optional),
+                "until": str - Only posts created before this ISO-8601 timestamp (optional)
+            }
+            post_ids or user_id is required. When both are given, only the listed posts by that user are deleted.
+        """
+        return moderate_posts(moderation.delete_posts)
+
+    @app.route('/admin/posts/edit', methods=['POST'])
+    @requires_auth('admin')
+    def bulk_edit_posts(jwt):
+        """
+        Replaces the content of many posts at once, selected as for bulk_delete_posts. Runs in one transaction.
+
+        :param jwt: JSON Web Token for authentication
+        :type jwt: str
+        :return: JSON response with success status, the number of posts edited and the IDs of their threads
+        :Request JSON:
+            {
+                "content": str - The new content of every selected post,
+                "post_ids", "user_id", "forum_id", "since", "until" - as for POST /admin/posts/delete
+            }
+        """
+        content = (request.get_json(silent=True) or {}).get('content')
+        if not isinstance(content, str) or not content or len(content) > 1024:
+            abort(400)
+        return moderate_posts(moderation.edit_posts, content=content)
+
+    def set_threads_locked(locked):
+        try:
+            thread_ids = moderation.ids_from_json(request.get_json(silent=True), 'thread_ids')
+        except ValueError:
+            abort(400)
+        with unit_of_work():
+            forums = moderation.set_threads_locked(thread_ids, locked)
+        if forums:
+            response_cache.bump(*(f'thread:{thread_id}' for thread_id in forums), *(f'forum:{forum_id}' for forum_id in forums.values()))
+        return {
+            'status': 'SUCCESS',
+            'threads': sorted(forums)
+        }
+
+    @app.route('/admin/threads/lock', methods=['POST'])
+    @requires_auth('admin')
+    def lock_threads(jwt):
+        """
+        Locks many threads at once. Only admins can post in a locked thread.
+
+        :param jwt: JSON Web Token for authentication
+        :type jwt: str
+        :return: JSON response with success status and the IDs of the threads found
+        :Request JSON:
+            {
+                "thread_ids": [int] - The IDs of the threads to lock
+            }
+        """
+        return set_threads_locked(True)
+
+    @app.route('/admin/threads/unlock', methods=['POST'])
+    @requires_auth('admin')
+    def unlock_threads(jwt):
+        """
+        Unlocks many threads at once.
+
+        :param jwt: JSON Web Token for authentication
+        :type jwt: str
+        :return: JSON response with success status and the IDs of the threads found
+        :Request JSON:
+            {
+                "thread_ids": [int] - The IDs of the threads to unlock
+            }
+        """
+        return set_threads_locked(False)
+
+    @app.route('/admin/threads/move', methods=['POST'])
+    @requires_auth('admin')
+    def move_threads(jwt):
+        """
+        Moves many threads to another forum at once.
+
+        :param jwt: JSON Web Token for authentication
+        :type jwt: str
+        :return: JSON response with success status and the IDs of the threads moved
+        :Request JSON:
+            {
+                "thread_ids": [int] - The IDs of the threads to move,
+                "forum_id": int - The ID of the forum they move to
+            }
+        """
+        data = request.get_json(silent=True)
+        try:
+            thread_ids = moderation.ids_from_json(data, 'thread_ids')
+            forum_id = int(data['forum_id'])
+        except (KeyError, TypeError, ValueError):
+            abort(400)
+        try:
+            with unit_of_work():
+                moved_from = moderation.move_threads(thread_ids, forum_id)
+        except LookupError:
+            abort(404)
+        if moved_from:
+            response_cache.bump(
+                f'forum:{forum_id}',
+                *(f'thread:{thread_id}' for thread_id in moved_from),
+                *(f'forum:{old_forum_id}' for old_forum_id in moved_from.values())
+            )
+        return {
+            'status': 'SUCCESS',
+            'threads': sorted(moved_from)
+        }
+
+    @app.route('/admin/threads/merge', methods=['POST'])
+    @requires_auth('admin')
+    def merge_threads(jwt):
+        """
+        Merges one thread into another. Posts of both threads are renumbered in the order they were written and
+        the source thread is deleted.
+
+        :param jwt: JSON Web Token for authentication
+        :type jwt: str
+        :return: JSON response with success status and the merged thread
+        :Request JSON:
+            {
+                "source_id": int - The ID of the thread merged away,
+                "target_id": int - The ID of the thread that receives its posts
+            }
+        """
+        data = request.get_json(silent=True)
+        try:
+            source_id = int(data['source_id'])
+            target_id = int(data['target_id'])
+        except (KeyError, TypeError, ValueError):
+            abort(400)
+        try:
+            with unit_of_work():
+                forums = moderation.merge_threads(source_id, target_id)
+        except ValueError:
+            abort(400)
+        except LookupError:
+            abort(404)
+        response_cache.bump(
+            f'thread:{source_id}', f'thread:{target_id}',
+            *(f'forum:{forum_id}' for forum_id in forums.values())
+        )
+        return {
+            'status': 'SUCCESS',
+            'thread': Thread.query.get(target_id).format()
+        }
 
 
     # Error Handling
@@ -424,6 +777,15 @@ def create_app(test_config=None):
             return error_message(404, 'resource not found!')
         return redirect('/')
 
+    @app.errorhandler(403)
+    def forbidden(error):
+        '''
+            Handles HTTP 403 status code, such as a post to a locked thread
+            Arguments
+                error -- Error information
+        '''
+        return error_message(403, error.description)
+
     @app.errorhandler(401)
     def unauthorized(error):
         '''
@@ -445,11 +807,12 @@ def create_app(test_config=None):
     @app.errorhandler(503)
     def bad_user(error):
         '''
-            Handles HTTP 503 status code when user who is not owner of resources tries to modify
+            Handles HTTP 503 status code when user who is not owner of resources tries to modify, or when
+            search runs before the search index is built
             Arguments
                 error -- Error information
         '''
-        return error_message(503, 'Request is not valid.')
+        return error_message(503, error.description)
     
     @app.errorhandler(AuthError)
     def auth_error(error):
@@ -479,7 +842,7 @@ def create_app(test_config=None):
 
 
 app = create_app()
-migrate = Migrate(app, db)
+migrate = Migrate(app, db, include_object=include_object)
 
 if __name__ == '__main__':
     app.run()
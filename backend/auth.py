@@ -1,16 +1,35 @@
 import json
+import hashlib
+import logging
+from collections import OrderedDict
 from flask import request
 from functools import wraps
 from urllib.request import urlopen
 import jwt
-from jwt import PyJWKClient
+from jwt import PyJWKSet
 import os
+import threading
+import time
 
 
 
 AUTH0_DOMAIN = os.environ['AUTH0_DOMAIN']
 ALGORITHMS = ['RS256']
 API_AUDIENCE = os.environ['AUTH0_AUDIENCE']
+# Overridable so the key set can be served from a local file (file://...) or a stub server when testing offline
+JWKS_URL = os.environ.get('AUTH0_JWKS_URL', f'{AUTH0_DOMAIN}.well-known/jwks.json')
+# Seconds a fetched key set is considered fresh
+JWKS_CACHE_TTL = int(os.environ.get('AUTH0_JWKS_CACHE_TTL', 600))
+# Seconds past the TTL that stale keys are still served while a refresh runs or the endpoint is down
+JWKS_MAX_STALE = int(os.environ.get('AUTH0_JWKS_MAX_STALE', 86400))
+# Minimum seconds between fetch attempts, so forged kids or a failing endpoint can't make every request refetch
+JWKS_REFRESH_COOLDOWN = int(os.environ.get('AUTH0_JWKS_REFRESH_COOLDOWN', 30))
+JWKS_FETCH_TIMEOUT = int(os.environ.get('AUTH0_JWKS_FETCH_TIMEOUT', 5))
+# Set AUTH_TOKEN_CACHE=false to verify every token from scratch
+TOKEN_CACHE_ENABLED = os.environ.get('AUTH_TOKEN_CACHE', 'true').lower() not in ('0', 'false', 'no', 'off')
+TOKEN_CACHE_SIZE = int(os.environ.get('AUTH_TOKEN_CACHE_SIZE', 4096))
+
+logger = logging.getLogger(__name__)
 
 ## AuthError Exception
 '''
@@ -23,6 +42,195 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+## JWKS Key Cache
+
+class JWKSCache:
+    '''
+    Process-wide cache of the identity provider's signing keys, keyed by kid.
+    Fresh keys are served from memory. Once the TTL passes, the stale key is still served while a single
+    background refresh runs, and it keeps being served if the endpoint is slow or down until max_stale runs out.
+    An unknown kid triggers one synchronous refetch shared by every thread waiting on it.
+    After any fetch attempt, successful or not, the next one waits at least refresh_cooldown seconds.
+    Arguments
+        url -- (str) Location of the jwks.json document. Anything urlopen accepts, including file:// urls
+        ttl -- (int) Seconds the fetched key set is considered fresh
+        max_stale -- (int) Seconds past the ttl that stale keys may still be served
+        refresh_cooldown -- (int) Minimum seconds between fetch attempts
+        timeout -- (int) Seconds to wait on the jwks endpoint
+    '''
+    def __init__(self, url, ttl=JWKS_CACHE_TTL, max_stale=JWKS_MAX_STALE, refresh_cooldown=JWKS_REFRESH_COOLDOWN, timeout=JWKS_FETCH_TIMEOUT):
+        self.url = url
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.refresh_cooldown = refresh_cooldown
+        self.timeout = timeout
+        self.fetches = 0
+        self.fetch_errors = 0
+        self._keys = {}
+        self._fetched_at = None
+        self._last_attempt = None
+        self._lock = threading.Lock()
+
+    def fetch(self):
+        '''
+        Downloads the key set and returns its signing keys as a dict of kid -> PyJWK
+        '''
+        with urlopen(self.url, timeout=self.timeout) as response:
+            jwks = json.load(response)
+        return {
+            key.key_id: key for key in PyJWKSet.from_dict(jwks).keys
+            if key.key_id and key.public_key_use in ('sig', None)
+        }
+
+    def get_signing_key(self, kid):
+        '''
+        Returns the PyJWK for kid, refreshing the key set when it is stale or does not know the kid
+        Arguments
+            kid -- (str) Key id from the token header
+        '''
+        now = time.monotonic()
+        key = self._keys.get(kid)
+        if key is not None:
+            age = now - self._fetched_at
+            if age < self.ttl:
+                return key
+            if age < self.ttl + self.max_stale:
+                self._refresh_in_background()
+                return key
+        self._refresh(now)
+        key = self._keys.get(kid)
+        if key is None:
+            if not self._keys:
+                raise AuthError('Unable to fetch signing keys', 503)
+            raise AuthError('Unable to find appropriate key', 401)
+        if time.monotonic() - self._fetched_at >= self.ttl + self.max_stale:
+            raise AuthError('Unable to fetch signing keys', 503)
+        return key
+
+    def clear(self):
+        '''
+        Drops every cached key
+        '''
+        with self._lock:
+            self._keys = {}
+            self._fetched_at = None
+            self._last_attempt = None
+
+    def _cooling_down(self, now):
+        return self._last_attempt is not None and now - self._last_attempt < self.refresh_cooldown
+
+    def _refresh(self, requested_at):
+        with self._lock:
+            # Another thread refreshed while we waited on the lock
+            if self._last_attempt is not None and self._last_attempt >= requested_at:
+                return
+            if self._cooling_down(requested_at):
+                return
+            self._load()
+
+    def _refresh_in_background(self):
+        if self._cooling_down(time.monotonic()) or not self._lock.acquire(blocking=False):
+            return
+        if self._cooling_down(time.monotonic()):
+            self._lock.release()
+            return
+        def refresh():
+            try:
+                self._load()
+            finally:
+                self._lock.release()
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def _load(self):
+        # Callers hold self._lock
+        self._last_attempt = time.monotonic()
+        self.fetches += 1
+        try:
+            keys = self.fetch()
+        except Exception as e:
+            # Keep serving whatever we already have; get_signing_key decides whether it is too old to use
+            self.fetch_errors += 1
+            logger.warning('JWKS fetch from %s failed: %s', self.url, e)
+            return
+        self._keys = keys
+        self._fetched_at = self._last_attempt
+
+
+jwks_cache = JWKSCache(JWKS_URL)
+
+
+## Verified Token Cache
+
+class TokenCache:
+    '''
+    Bounded LRU of verified token payloads so a session's repeat bearer token skips RSA verification.
+    Entries are keyed by a sha256 of the token, never the token itself, and expire at the token's exp claim.
+    Arguments
+        maxsize -- (int) Maximum number of payloads kept
+        enabled -- (bool) When False every lookup misses and nothing is stored
+    '''
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE, enabled=TOKEN_CACHE_ENABLED):
+        self.maxsize = maxsize
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        '''
+        Returns a copy of the cached payload for token, or None
+        Arguments
+            token -- user's jwt auth token
+        '''
+        if not self.enabled:
+            return None
+        digest = self._digest(token)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None and entry[0] <= time.time():
+                del self._entries[digest]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(digest)
+            self.hits += 1
+        return dict(entry[1])
+
+    def put(self, token, payload):
+        '''
+        Stores a verified payload until its exp claim
+        Arguments
+            token -- user's jwt auth token
+            payload -- the decoded jwt, including the derived user_id and admin fields
+        '''
+        if not self.enabled or not payload.get('exp'):
+            return
+        digest = self._digest(token)
+        with self._lock:
+            self._entries[digest] = (payload['exp'], dict(payload))
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        '''
+        Drops every cached payload and resets the counters
+        '''
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    @staticmethod
+    def _digest(token):
+        return hashlib.sha256(token.encode('utf-8')).digest()
+
+
+token_cache = TokenCache()
+
+
 ## Auth Header
 
 def get_token_auth_header():
@@ -53,17 +261,27 @@ def check_permissions(permission, payload):
 def verify_decode_jwt(token):
     '''
         Note to reviewer - I am using a work machine to do this course. I cannot install an earlier version of python and I kept getting errors using the jose package. I am not about to write a patch to get it to work with a new version so I ended up using PyJWKClient as part of the jwt package. It seriously much better, anyways.
+        Signing keys now come from the shared jwks_cache instead of a fresh PyJWKClient, so the jwks.json round trip only happens on refresh.
+        Verified payloads are kept in token_cache until they expire, so a repeat token returns without any crypto.
         Arguments
             token -- user's jwt auth token
     '''
-    url = f'{AUTH0_DOMAIN}.well-known/jwks.json'
-    client = PyJWKClient(url)
-    key = client.get_signing_key_from_jwt(token)
+    cached = token_cache.get(token)
+    if cached is not None:
+        return cached
+    try:
+        kid = jwt.get_unverified_header(token).get('kid')
+    except jwt.PyJWTError:
+        raise AuthError('Malformed token', 401)
+    if not kid:
+        raise AuthError('Token has no key id', 401)
+    key = jwks_cache.get_signing_key(kid)
     payload = {}
     try:
         payload = jwt.decode(jwt=token, key=key.key, verify=True, algorithms=ALGORITHMS, audience=API_AUDIENCE, issuer=AUTH0_DOMAIN)
         payload['user_id'] = payload['sub'].split('|')[1]
         payload['admin'] = 'admin' in payload['permissions']
+        token_cache.put(token, payload)
     except:
         raise AuthError('Token expired or could not be verified', 401)
     finally:
@@ -0,0 +1,482 @@
+import http.client
+import json
+import os
+import platform
+import re
+import secrets
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import quote
+import click
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+AUDIENCE = 'forum-benchmark'
+ISSUER = 'https://benchmark.invalid/'
+KEY_ID = 'benchmark'
+ADMIN_ID = 'benchmark-admin'
+USER_ID = 'benchmark-user'
+PERMISSIONS = ['post:thread', 'post:post', 'edit:post', 'delete:post']
+# Metrics compared against a baseline, and whether a bigger number is better
+COMPARED_METRICS = {'p50_ms': False, 'p95_ms': False, 'p99_ms': False, 'throughput': True, 'queries_per_request': False}
+
+SERVER_TIMING_QUERIES = re.compile(r'sql;[^,]*desc="(\d+) queries"')
+
+Response = namedtuple('Response', ['status', 'body', 'headers'])
+Endpoint = namedtuple('Endpoint', ['name', 'method', 'path', 'body', 'token'])
+
+'''
+Every route in create_app, reads first so the writes don't change what the reads measure. Thread merges are
+left out because each one deletes its source thread.
+path and body are called with the benchmark context and the request number
+'''
+ENDPOINTS = [
+    Endpoint('get_forums', 'GET', lambda c, i: '/all', None, None),
+    Endpoint('get_forum', 'GET', lambda c, i: f"/forum/{c['forums'][i % len(c['forums'])]}", None, None),
+    Endpoint('get_thread', 'GET', lambda c, i: f"/threads/{c['threads'][i % len(c['threads'])]}", None, None),
+    Endpoint('get_thread_page', 'GET', lambda c, i: f"/threads/{c['hot_thread']}/{i % c['hot_pages'] + 1}", None, None),
+    Endpoint('get_posts_since', 'GET', lambda c, i: f"/threads/{c['hot_thread']}/posts?cursor={i % c['hot_posts']}", None, None),
+    Endpoint('search_forums', 'GET', lambda c, i: f"/search?q={quote(c['words'][i % len(c['words'])])}", None, None),
+    Endpoint('get_user_list', 'GET', lambda c, i: '/admin/users', None, 'admin'),
+    Endpoint('filter_user_list', 'GET', lambda c, i: f'/admin/users?status=NORMAL&name=user0_{i % 10}', None, 'admin'),
+    Endpoint('create_forum', 'POST', lambda c, i: '/admin/create/forum',
+             lambda c, i: {'name': f"bench {c['run']} {i}", 'description': 'Benchmark forum'}, 'admin'),
+    Endpoint('create_user', 'POST', lambda c, i: '/admin/user',
+             lambda c, i: {'user_id': f"bench-{c['run']}-{i}", 'name': f"bench{c['run']}{i}"[:36], 'role': 'USER'}, 'admin'),
+    Endpoint('ban_user', 'POST', lambda c, i: '/admin/ban-user',
+             lambda c, i: {'id': c['ban_user'], 'type': 'WATCH' if i % 2 == 0 else 'REMOVE'}, 'admin'),
+    Endpoint('create_thread', 'POST', lambda c, i: f"/forum/{c['forums'][i % len(c['forums'])]}",
+             lambda c, i: {'title': f'Benchmark thread {i}', 'content': 'Benchmark opening post'}, 'user'),
+    Endpoint('create_post', 'POST', lambda c, i: f"/threads/{c['write_thread']}",
+             lambda c, i: {'content': f'Benchmark reply {i}'}, 'user'),
+    Endpoint('edit_post', 'PATCH', lambda c, i: f"/threads/{c['write_thread']}",
+             lambda c, i: {'post_id': c['edit_post'], 'content': f'Benchmark edit {i}'}, 'user'),
+    Endpoint('delete_post', 'DELETE', lambda c, i: f"/threads/{c['write_thread']}",
+             lambda c, i: {'post_id': c['delete_post']}, 'user'),
+    Endpoint('bulk_edit_posts', 'POST', lambda c, i: '/admin/posts/edit',
+             lambda c, i: {'post_ids': [c['edit_post']], 'content': f'Benchmark bulk edit {i}'}, 'admin'),
+    Endpoint('bulk_delete_posts', 'POST', lambda c, i: '/admin/posts/delete',
+             lambda c, i: {'user_id': USER_ID, 'forum_id': c['forums'][0]}, 'admin'),
+    Endpoint('lock_threads', 'POST', lambda c, i: '/admin/threads/lock',
+             lambda c, i: {'thread_ids': [c['write_thread']]}, 'admin'),
+    Endpoint('unlock_threads', 'POST', lambda c, i: '/admin/threads/unlock',
+             lambda c, i: {'thread_ids': [c['write_thread']]}, 'admin'),
+    Endpoint('move_threads', 'POST', lambda c, i: '/admin/threads/move',
+             lambda c, i: {'thread_ids': [c['write_thread']], 'forum_id': c['forums'][i % 2]}, 'admin'),
+]
+
+
+def configure_environment(workdir, database, response_cache):
+    '''
+    Points auth at a key set written to workdir and returns tokens signed with its private key, so nothing talks
+    to Auth0. Must run before app, auth or models are imported, since they read the environment at import time
+    '''
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(key.public_key()))
+    jwk.update(kid=KEY_ID, use='sig', alg='RS256')
+    jwks_path = os.path.join(workdir, 'jwks.json')
+    with open(jwks_path, 'w') as f:
+        json.dump({'keys': [jwk]}, f)
+
+    os.environ.update({
+        'AUTH0_DOMAIN': ISSUER,
+        'AUTH0_AUDIENCE': AUDIENCE,
+        'AUTH0_JWKS_URL': f'file://{jwks_path}',
+        'RESPONSE_CACHE': 'true' if response_cache else 'false',
+        # Query counts come back in the Server-Timing header, the same way in both modes
+        'SQL_INSTRUMENTATION': 'true',
+        'RESPONSE_CACHE_PATH': os.path.join(workdir, 'response-cache.sqlite3'),
+    })
+    if database:
+        os.environ['DATABASE_URL'] = database
+    elif 'DATABASE_URL' not in os.environ:
+        os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(workdir, 'benchmark.db')}"
+
+    def token(user_id, permissions):
+        return jwt.encode({
+            'sub': f'auth0|{user_id}',
+            'permissions': permissions,
+            'aud': AUDIENCE,
+            'iss': ISSUER,
+            'exp': int(time.time()) + 24 * 3600,
+        }, key, algorithm='RS256', headers={'kid': KEY_ID})
+    return {'admin': token(ADMIN_ID, ['admin'] + PERMISSIONS), 'user': token(USER_ID, PERMISSIONS)}
+
+
+def prepare_database(app, seed_options):
+    '''
+    Seeds an empty database, makes sure the benchmark users exist and the search index is built, and collects
+    the ids the endpoints use
+    '''
+    from models import db, Forum, Thread, User
+    from search import rebuild_search_index
+    import seed
+
+    with app.app_context():
+        if db.session.query(Forum.id).first() is None:
+            seed.seed(batch_size=seed.BATCH_SIZE, **seed_options)
+        for user_id, role in ((ADMIN_ID, 'ADMIN'), (USER_ID, 'USER')):
+            if db.session.get(User, user_id) is None:
+                User(id=user_id, name=user_id, role=role).insert()
+        hot = Thread.query.order_by(Thread.post_count.desc()).first()
+        context = {
+            'run': secrets.token_hex(4),
+            'forums': [row.id for row in db.session.query(Forum.id).order_by(Forum.id).limit(20)],
+            'threads': [row.id for row in db.session.query(Thread.id).order_by(Thread.last_post_at.desc()).limit(100)],
+            'hot_thread': hot.id,
+            'hot_pages': hot.page_count,
+            'hot_posts': hot.post_count,
+            'ban_user': db.session.query(User.id).filter(User.id.notin_([ADMIN_ID, USER_ID])).order_by(User.id).first().id,
+            'words': ['forum', 'database cache', 'reply', 'server error', 'thanks'],
+        }
+        db.session.remove()
+        # A database seeded elsewhere may not have the index yet, and searching it would only time errors
+        rebuild_search_index()
+    return context
+
+
+class TestClientTarget:
+    '''
+    Sends requests through Flask's test client in this process
+    '''
+    concurrency = 1
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, body, headers):
+        response = self.client.open(path, method=method, json=body, headers=headers)
+        return Response(response.status_code, response.get_data(), response.headers)
+
+    def close(self):
+        pass
+
+
+class GunicornTarget:
+    '''
+    Starts gunicorn on a free local port with the benchmark environment and sends real HTTP requests to it.
+    Each client thread keeps its own connection
+    '''
+    def __init__(self, workers, threads, concurrency):
+        self.concurrency = concurrency
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            self.port = s.getsockname()[1]
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', 'app:app', '--bind', f'127.0.0.1:{self.port}',
+             '--workers', str(workers), '--threads', str(threads), '--log-level', 'warning'],
+            cwd=BACKEND_DIR, env=os.environ.copy()
+        )
+        self._local = threading.local()
+        deadline = time.monotonic() + 60
+        while True:
+            try:
+                if self.request('GET', '/all', None, {}).status == 200:
+                    break
+            except OSError:
+                self._local.connection = None
+            if self.process.poll() is not None or time.monotonic() > deadline:
+                self.close()
+                raise click.ClickException('gunicorn did not start')
+            time.sleep(0.2)
+
+    def request(self, method, path, body, headers):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+        data = None
+        headers = dict(headers)
+        if body is not None:
+            data = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        try:
+            connection.request(method, path, body=data, headers=headers)
+            response = connection.getresponse()
+            return Response(response.status, response.read(), response.headers)
+        except (http.client.HTTPException, OSError):
+            connection.close()
+            self._local.connection = None
+            raise
+
+    def close(self):
+        self.process.terminate()
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+def query_count_from(response):
+    '''
+    SQL statement count reported by the app's Server-Timing header, None when it carries none
+    '''
+    match = SERVER_TIMING_QUERIES.search(response.headers.get('Server-Timing', ''))
+    return int(match.group(1)) if match else None
+
+
+def percentile(ordered, fraction):
+    '''
+    Nearest rank percentile of an already sorted list
+    '''
+    if not ordered:
+        return None
+    rank = max(int(round(fraction * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def run_endpoint(target, endpoint, context, tokens, requests, warmup):
+    '''
+    Sends warmup untimed requests then requests timed ones, spread over the target's client threads
+    Returns the endpoint's summary: throughput, latency percentiles in ms, errors and queries per request
+    '''
+    lock = threading.Lock()
+    latencies = []
+    queries = []
+    errors = []
+
+    def send(i):
+        headers = {'Authorization': f'Bearer {tokens[endpoint.token]}'} if endpoint.token else {}
+        body = endpoint.body(context, i) if endpoint.body else None
+        start = time.perf_counter()
+        try:
+            response = target.request(endpoint.method, endpoint.path(context, i), body, headers)
+            status, query_count = response.status, query_count_from(response)
+        except (http.client.HTTPException, OSError) as e:
+            status, query_count = type(e).__name__, None
+        return time.perf_counter() - start, status, query_count
+
+    def run(first, last, record):
+        counter = iter(range(first, last))
+        def worker():
+            while True:
+                with lock:
+                    i = next(counter, None)
+                if i is None:
+                    return
+                elapsed, status, query_count = send(i)
+                if not record:
+                    continue
+                with lock:
+                    latencies.append(elapsed)
+                    if query_count is not None:
+                        queries.append(query_count)
+                    if not (isinstance(status, int) and status < 400):
+                        errors.append(status)
+        with ThreadPoolExecutor(target.concurrency) as executor:
+            for future in [executor.submit(worker) for _ in range(target.concurrency)]:
+                future.result()
+
+    run(0, warmup, record=False)
+    started = time.perf_counter()
+    run(warmup, warmup + requests, record=True)
+    duration = time.perf_counter() - started
+
+    return summarize(latencies, duration, errors, queries)
+
+
+def summarize(latencies, duration, errors=(), queries=()):
+    '''
+    Throughput, latency percentiles in ms, errors and queries per request for one endpoint
+    '''
+    ordered = sorted(latencies)
+    milliseconds = lambda value: round(value * 1000, 3) if value is not None else None
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'error_statuses': sorted({str(status) for status in errors}),
+        'throughput': round(len(latencies) / duration, 1) if duration else None,
+        'mean_ms': milliseconds(sum(ordered) / len(ordered)) if ordered else None,
+        'p50_ms': milliseconds(percentile(ordered, 0.50)),
+        'p95_ms': milliseconds(percentile(ordered, 0.95)),
+        'p99_ms': milliseconds(percentile(ordered, 0.99)),
+        'max_ms': milliseconds(ordered[-1]) if ordered else None,
+        'queries_per_request': round(sum(queries) / len(queries), 2) if queries else None,
+    }
+
+
+def run_encoding(app, context, requests, warmup):
+    '''
+    Times building the JSON response for a full thread page and for the whole admin user list with Flask's
+    default provider and each provider in json_provider. Yields (name, summary) pairs
+    '''
+    from flask.json.provider import DefaultJSONProvider
+    from json_provider import JSON_PROVIDERS
+    from models import user_name_cache
+    import queries
+
+    with app.app_context():
+        page = queries.get_thread_page(context['hot_thread'], 1)
+        users = user_name_cache.get_many(post['user_id'] for post in page['posts'])
+        for post in page['posts']:
+            post['user_name'] = users[post['user_id']]
+        payloads = {
+            'page': {'status': 'SUCCESS', 'page': page},
+            'users': {'status': 'SUCCESS', 'users': queries.list_users()},
+        }
+    providers = {'flask': DefaultJSONProvider, **JSON_PROVIDERS}
+    for payload_name, payload in payloads.items():
+        for provider_name, provider_class in providers.items():
+            provider = provider_class(app)
+            for _ in range(warmup):
+                provider.response(payload)
+            latencies = []
+            started = time.perf_counter()
+            for _ in range(requests):
+                start = time.perf_counter()
+                response = provider.response(payload)
+                latencies.append(time.perf_counter() - start)
+            summary = summarize(latencies, time.perf_counter() - started)
+            summary['bytes'] = len(response.get_data())
+            yield f'{payload_name}:{provider_name}', summary
+
+
+def prepare_writes(target, context, tokens):
+    '''
+    Creates the thread and posts the write endpoints act on, through the API so every mode sees the same setup
+    '''
+    headers = {'Authorization': f"Bearer {tokens['user']}"}
+    response = target.request('POST', f"/forum/{context['forums'][0]}", {'title': 'Benchmark writes', 'content': 'Setup'}, headers)
+    if response.status != 200:
+        raise click.ClickException(f'Could not create the benchmark thread: {response.status} {response.body[:200]!r}')
+    thread = json.loads(response.body)['thread']
+    context['write_thread'] = thread['id']
+    context['edit_post'] = thread['posts'][0]['id']
+    target.request('POST', f"/threads/{context['write_thread']}", {'content': 'Setup reply'}, headers)
+    page = target.request('GET', f"/threads/{context['write_thread']}/1", None, {})
+    context['delete_post'] = json.loads(page.body)['page']['posts'][-1]['id']
+
+
+def run_endpoints(target, context, tokens, only, requests, warmup, results):
+    '''
+    Runs every selected endpoint against target, printing each summary and adding it to results
+    '''
+    try:
+        prepare_writes(target, context, tokens)
+        click.echo(f"{'endpoint':<18}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'queries':>9}{'errors':>8}")
+        for endpoint in ENDPOINTS:
+            if only and endpoint.name not in only:
+                continue
+            summary = run_endpoint(target, endpoint, context, tokens, requests, warmup)
+            results['endpoints'][endpoint.name] = summary
+            click.echo(
+                f"{endpoint.name:<18}{summary['throughput']:>10}{summary['p50_ms']:>10}{summary['p95_ms']:>10}"
+                f"{summary['p99_ms']:>10}{str(summary['queries_per_request']):>9}{summary['errors']:>8}"
+            )
+    finally:
+        target.close()
+
+
+def compare(results, baseline, threshold):
+    '''
+    Prints each endpoint's change against a baseline run and returns the regressions worse than threshold percent
+    '''
+    regressions = []
+    for setting in ('mode', 'database', 'concurrency', 'workers', 'threads', 'response_cache'):
+        if baseline['meta'].get(setting) != results['meta'].get(setting):
+            click.echo(f"Warning: baseline ran with {setting}={baseline['meta'].get(setting)}, this run with {results['meta'].get(setting)}", err=True)
+    click.echo(f"\n{'endpoint':<18}{'metric':<22}{'baseline':>12}{'current':>12}{'change':>10}")
+    for name, current in results['endpoints'].items():
+        previous = baseline['endpoints'].get(name)
+        if previous is None:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            old, new = previous.get(metric), current.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old * 100
+            worse = -change if higher_is_better else change
+            flag = ''
+            if worse > threshold:
+                flag = '  REGRESSION'
+                regressions.append((name, metric, old, new))
+            click.echo(f'{name:<18}{metric:<22}{old:>12}{new:>12}{change:>+9.1f}%{flag}')
+    return regressions
+
+
+@click.command()
+@click.option('--mode', type=click.Choice(['client', 'gunicorn', 'encode']), default='client', show_default=True,
+              help='Flask test client in process, HTTP against a gunicorn subprocess, or JSON encoding of a thread page and the user list alone')
+@click.option('--database', help='Database URL, defaults to DATABASE_URL or a fresh SQLite file')
+@click.option('--requests', 'request_count', default=200, show_default=True, help='Timed requests per endpoint')
+@click.option('--warmup', default=20, show_default=True, help='Untimed requests per endpoint before measuring')
+@click.option('--endpoint', 'only', multiple=True, help='Only run these endpoints, repeatable')
+@click.option('--concurrency', default=4, show_default=True, help='Client threads in gunicorn mode')
+@click.option('--workers', default=2, show_default=True, help='gunicorn worker processes')
+@click.option('--threads', 'worker_threads', default=1, show_default=True, help='gunicorn threads per worker')
+@click.option('--response-cache/--no-response-cache', default=False, show_default=True, help='Serve reads from the shared response cache')
+@click.option('--seed-forums', default=10, show_default=True, help='Forums to seed an empty database with')
+@click.option('--seed-threads', default=500, show_default=True, help='Threads to seed an empty database with')
+@click.option('--seed-posts', default=20000, show_default=True, help='Posts to seed an empty database with')
+@click.option('--seed-users', default=500, show_default=True, help='Users to seed an empty database with')
+@click.option('--output', type=click.Path(dir_okay=False), help='Write the results to this JSON file')
+@click.option('--baseline', type=click.Path(exists=True, dir_okay=False), help='Compare against results saved with --output')
+@click.option('--threshold', default=10.0, show_default=True, help='Percent change that counts as a regression')
+@click.option('--fail-on-regression', is_flag=True, help='Exit with status 1 when a regression is found')
+def main(mode, database, request_count, warmup, only, concurrency, workers, worker_threads, response_cache,
+         seed_forums, seed_threads, seed_posts, seed_users, output, baseline, threshold, fail_on_regression):
+    '''
+    Measures throughput, p50/p95/p99 latency and SQL queries per request for every route, against a seeded database
+    '''
+    unknown = set(only) - {endpoint.name for endpoint in ENDPOINTS}
+    if unknown:
+        raise click.BadParameter(f"unknown endpoints: {', '.join(sorted(unknown))}", param_hint='--endpoint')
+    workdir = tempfile.mkdtemp(prefix='forum-benchmark-')
+    tokens = configure_environment(workdir, database, response_cache)
+    from app import app
+
+    context = prepare_database(app, {
+        'forums': seed_forums, 'threads': seed_threads, 'posts': seed_posts, 'users': seed_users, 's': 1.1, 'seed_value': 0
+    })
+    if mode == 'encode':
+        target = None
+    elif mode == 'client':
+        target = TestClientTarget(app)
+    else:
+        target = GunicornTarget(workers, worker_threads, concurrency)
+    results = {
+        'meta': {
+            'mode': mode,
+            'database': app.config['SQLALCHEMY_DATABASE_URI'].split('://')[0],
+            'requests': request_count,
+            'warmup': warmup,
+            'concurrency': target.concurrency if target else 1,
+            'workers': workers if mode == 'gunicorn' else None,
+            'threads': worker_threads if mode == 'gunicorn' else None,
+            'response_cache': response_cache,
+            'python': platform.python_version(),
+            'started_at': datetime.now(timezone.utc).isoformat(),
+        },
+        'endpoints': {},
+    }
+    if mode == 'encode':
+        click.echo(f"{'payload':<18}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'bytes':>10}")
+        for name, summary in run_encoding(app, context, request_count, warmup):
+            results['endpoints'][name] = summary
+            click.echo(
+                f"{name:<18}{summary['throughput']:>10}{summary['p50_ms']:>10}{summary['p95_ms']:>10}"
+                f"{summary['p99_ms']:>10}{summary['bytes']:>10}"
+            )
+    else:
+        run_endpoints(target, context, tokens, only, request_count, warmup, results)
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if baseline:
+        with open(baseline) as f:
+            regressions = compare(results, json.load(f), threshold)
+        if regressions and fail_on_regression:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
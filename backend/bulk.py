@@ -0,0 +1,102 @@
+import gzip
+import io
+import json
+import sys
+from datetime import datetime
+from models import db, User, Forum, Thread, Page, Post
+
+
+# Foreign key order, so an import never references a row it hasn't written yet
+EXPORT_MODELS = [User, Forum, Thread, Page, Post]
+TABLES = {model.__tablename__: model.__table__ for model in EXPORT_MODELS}
+BATCH_SIZE = 1000
+
+
+def open_ndjson(path, mode):
+    '''
+    Opens an NDJSON file for text reading ('r') or writing ('w'). Paths ending in .gz are gzip compressed and
+    '-' means stdin/stdout
+    '''
+    if path == '-':
+        stream = sys.stdout if mode == 'w' else sys.stdin
+        return io.TextIOWrapper(stream.buffer, encoding='utf-8', newline='\n')
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+def insert_rows(table, rows):
+    '''
+    Writes a batch of row dicts with a single executemany INSERT
+    '''
+    if rows:
+        db.session.execute(table.insert(), rows)
+
+def reset_sequences(tables):
+    '''
+    Moves Postgres id sequences past the highest imported id. SQLite's rowids follow MAX(id) on their own
+    '''
+    if db.session.get_bind().dialect.name != 'postgresql':
+        return
+    for table in tables:
+        if table.c.id.type.python_type is not int:
+            continue
+        db.session.execute(db.text(
+            f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), COALESCE(MAX(id), 1), MAX(id) IS NOT NULL) FROM {table.name}"
+        ))
+
+def export_ndjson(path, batch_size=BATCH_SIZE):
+    '''
+    Streams every user, forum, thread, page and post to path as one {"table": ..., "row": {...}} object per line.
+    Rows are read through a server side cursor batch_size at a time, so memory stays flat however big the forum is
+    Returns a dict of table name -> rows written
+    '''
+    counts = {}
+    with open_ndjson(path, 'w') as f:
+        for table in TABLES.values():
+            counts[table.name] = 0
+            result = db.session.execute(
+                db.select(table).order_by(table.c.id).execution_options(yield_per=batch_size)
+            )
+            for row in result.mappings():
+                f.write(json.dumps({'table': table.name, 'row': {
+                    column: value.isoformat() if isinstance(value, datetime) else value
+                    for column, value in row.items()
+                }}) + '\n')
+                counts[table.name] += 1
+            result.close()
+    return counts
+
+def import_ndjson(path, batch_size=BATCH_SIZE):
+    '''
+    Loads a file written by export_ndjson into an empty database in one transaction, batch_size rows per
+    executemany, then moves the id sequences past the imported ids
+    Returns a dict of table name -> rows read
+    '''
+    counts = {}
+    batch = []
+    table = None
+    datetime_columns = set()
+    try:
+        with open_ndjson(path, 'r') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if table is None or record['table'] != table.name or len(batch) >= batch_size:
+                    insert_rows(table, batch)
+                    batch = []
+                    table = TABLES[record['table']]
+                    datetime_columns = {column.name for column in table.columns if isinstance(column.type, db.DateTime)}
+                row = record['row']
+                for column in datetime_columns:
+                    if row.get(column):
+                        row[column] = datetime.fromisoformat(row[column])
+                batch.append(row)
+                counts[table.name] = counts.get(table.name, 0) + 1
+        insert_rows(table, batch)
+        reset_sequences(TABLES.values())
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return counts
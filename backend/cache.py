@@ -0,0 +1,282 @@
+import os
+import hashlib
+import math
+import secrets
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timezone
+from functools import wraps
+from flask import request, current_app
+
+
+RESPONSE_CACHE_PATH = os.environ.get('RESPONSE_CACHE_PATH', os.path.join(tempfile.gettempdir(), 'forum-response-cache.sqlite3'))
+# Set RESPONSE_CACHE=false to stop caching response bodies. Versions are still tracked
+RESPONSE_CACHE_ENABLED = os.environ.get('RESPONSE_CACHE', 'true').lower() not in ('0', 'false', 'no', 'off')
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+# Seconds between refreshes of an entry's access time, so hits rarely need a write
+ACCESS_RESOLUTION = 30
+# Local counters are added to the shared stats table after this many operations or seconds
+STATS_FLUSH_OPERATIONS = 100
+STATS_FLUSH_SECONDS = 10
+# An eviction pass runs after this many stores from one process
+EVICTION_INTERVAL = 32
+# Row in the versions table identifying this incarnation of the store. Its version is random and its
+# updated_at is when the store was created, which stands in for the last change of scopes never bumped since
+GENERATION = '~generation'
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS versions (scope TEXT PRIMARY KEY, version INTEGER NOT NULL, updated_at REAL NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, body BLOB NOT NULL, size INTEGER NOT NULL, accessed_at REAL NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS ix_entries_accessed_at ON entries (accessed_at)',
+    'CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)',
+]
+
+# Part of every key. Bump when the body a route returns changes shape (e.g. the ISO-8601 dates from
+# json_provider), so bodies and ETags from older code are never served
+FORMAT_VERSION = 2
+
+ScopeState = namedtuple('ScopeState', ['generation', 'versions', 'updated_at'])
+
+
+class ResponseCache:
+    '''
+    Response cache shared by every gunicorn worker on the host through one SQLite file.
+    Each cached route depends on a few scopes ('forums', 'forum:<id>', 'thread:<id>', 'user-names'). Entries are
+    keyed by the request and the current version of those scopes, so writes invalidate by bumping a version
+    rather than hunting down keys. Unreachable entries age out through size bounded LRU eviction.
+    Arguments
+        path -- (str) SQLite file holding the cache
+        max_bytes -- (int) Upper bound on the total size of cached bodies
+        enabled -- (bool) When False bodies are never stored or served, but versions are still kept
+    '''
+    def __init__(self, path=RESPONSE_CACHE_PATH, max_bytes=RESPONSE_CACHE_MAX_BYTES, enabled=RESPONSE_CACHE_ENABLED):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._pending_operations = 0
+        self._flushed_at = time.monotonic()
+        self._stores = 0
+
+    def _connection(self):
+        # sqlite3 connections can't cross threads or forks, so keep one per thread per process
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            for statement in SCHEMA:
+                connection.execute(statement)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def state(self, scopes):
+        '''
+        Returns the store generation, a dict of scope -> current version (0 for scopes that were never bumped)
+        and the time the most recent of those scopes changed, in one query
+        Arguments
+            scopes -- list of scope names
+        '''
+        connection = self._connection()
+        placeholders = ','.join('?' * (len(scopes) + 1))
+        query = f'SELECT scope, version, updated_at FROM versions WHERE scope IN ({placeholders})'
+        rows = {scope: (version, updated_at) for scope, version, updated_at in connection.execute(query, [GENERATION, *scopes])}
+        if GENERATION not in rows:
+            connection.execute(
+                'INSERT OR IGNORE INTO versions (scope, version, updated_at) VALUES (?, ?, ?)',
+                (GENERATION, secrets.randbits(63), time.time())
+            )
+            rows[GENERATION] = connection.execute('SELECT version, updated_at FROM versions WHERE scope = ?', (GENERATION,)).fetchone()
+        generation, created_at = rows.pop(GENERATION)
+        versions = {scope: rows.get(scope, (0, created_at))[0] for scope in scopes}
+        updated_at = max([created_at] + [updated_at for version, updated_at in rows.values()])
+        return ScopeState(generation, versions, updated_at)
+
+    def versions(self, scopes):
+        '''
+        Returns a dict of scope -> current version, 0 for scopes that were never bumped
+        Arguments
+            scopes -- list of scope names
+        '''
+        return self.state(scopes).versions
+
+    def bump(self, *scopes):
+        '''
+        Moves each scope to a new version, making every cached response that depends on it unreachable.
+        Call after the write has committed.
+        '''
+        now = time.time()
+        self._connection().executemany(
+            'INSERT INTO versions (scope, version, updated_at) VALUES (?, 1, ?) '
+            'ON CONFLICT (scope) DO UPDATE SET version = version + 1, updated_at = excluded.updated_at',
+            [(scope, now) for scope in set(scopes)]
+        )
+
+    def get(self, key):
+        '''
+        Returns the cached body for key, or None
+        '''
+        if not self.enabled:
+            return None
+        connection = self._connection()
+        row = connection.execute('SELECT body, accessed_at FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self._record('misses')
+            return None
+        now = time.time()
+        if now - row[1] > ACCESS_RESOLUTION:
+            connection.execute('UPDATE entries SET accessed_at = ? WHERE key = ?', (now, key))
+        self._record('hits')
+        return row[0]
+
+    def put(self, key, body):
+        '''
+        Stores body under key, evicting the least recently used entries when the cache is over its size bound
+        '''
+        if not self.enabled or len(body) > self.max_bytes:
+            return
+        self._connection().execute(
+            'INSERT OR REPLACE INTO entries (key, body, size, accessed_at) VALUES (?, ?, ?, ?)',
+            (key, body, len(body), time.time())
+        )
+        self._record('stores')
+        with self._lock:
+            self._stores += 1
+            evict = self._stores % EVICTION_INTERVAL == 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        '''
+        Deletes least recently used entries until the cache is back under 90% of max_bytes
+        '''
+        connection = self._connection()
+        total = connection.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        target = total - int(self.max_bytes * 0.9)
+        keys = []
+        for key, size in connection.execute('SELECT key, size FROM entries ORDER BY accessed_at'):
+            keys.append((key,))
+            target -= size
+            if target <= 0:
+                break
+        connection.executemany('DELETE FROM entries WHERE key = ?', keys)
+        self._record('evictions', len(keys))
+
+    def clear(self):
+        '''
+        Drops every cached response and starts a new generation, which changes every ETag and Last-Modified.
+        Use after the database was changed behind the app's back, e.g. by an import
+        '''
+        connection = self._connection()
+        connection.execute('DELETE FROM entries')
+        connection.execute('DELETE FROM versions')
+
+    def stats(self):
+        '''
+        Returns cache counters summed across every process, plus the current entry count and size
+        '''
+        self.flush_stats()
+        connection = self._connection()
+        stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+        stats.update(connection.execute('SELECT name, value FROM stats').fetchall())
+        stats['entries'], stats['bytes'] = connection.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+    def flush_stats(self):
+        '''
+        Adds this process's pending counters to the shared stats table
+        '''
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+            self._pending_operations = 0
+            self._flushed_at = time.monotonic()
+        if pending:
+            self._connection().executemany(
+                'INSERT INTO stats (name, value) VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET value = value + excluded.value',
+                list(pending.items())
+            )
+
+    def _record(self, name, count=1):
+        with self._lock:
+            self._pending[name] = self._pending.get(name, 0) + count
+            self._pending_operations += 1
+            due = self._pending_operations >= STATS_FLUSH_OPERATIONS or time.monotonic() - self._flushed_at >= STATS_FLUSH_SECONDS
+        if due:
+            self.flush_stats()
+
+
+response_cache = ResponseCache()
+
+
+def last_modified(updated_at):
+    '''
+    HTTP dates only carry whole seconds, so Last-Modified is the second after the change. It is only usable once
+    that second has passed; until then a second change could land in the same second unnoticed.
+    '''
+    timestamp = math.floor(updated_at) + 1
+    if timestamp > time.time():
+        return None
+    return datetime.fromtimestamp(timestamp, timezone.utc)
+
+
+def cached_response(*scopes):
+    '''
+    Decorator for read routes. Answers conditional GETs from the scope versions alone, before the view touches
+    the database, then serves the body from response_cache, and tags 200 responses with a strong ETag and
+    Last-Modified derived from the same versions
+    Arguments
+        scopes -- (str) Scopes the response depends on, formatted with the view's arguments, e.g. 'thread:{thread_id}'
+    '''
+    def cached_response_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            # Versions are read before the database so a write racing this request can only leave its result
+            # under the old version
+            state = response_cache.state([scope.format(**kwargs) for scope in scopes])
+            # Entries from a different database must never be served, e.g. after pointing DATABASE_URL elsewhere
+            database = hashlib.sha1(current_app.config['SQLALCHEMY_DATABASE_URI'].encode('utf-8')).hexdigest()[:12]
+            key = '|'.join([database, str(FORMAT_VERSION), str(state.generation), request.full_path] + [
+                f'{scope}={version}' for scope, version in sorted(state.versions.items())
+            ])
+            etag = hashlib.sha1(key.encode('utf-8')).hexdigest()
+            modified = last_modified(state.updated_at)
+
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains(etag)
+            else:
+                not_modified = modified is not None and request.if_modified_since is not None and request.if_modified_since >= modified
+            if not_modified:
+                response = current_app.response_class(status=304)
+            else:
+                body = None
+                use_cache = response_cache.enabled and current_app.config.get('RESPONSE_CACHE', True)
+                if use_cache:
+                    body = response_cache.get(key)
+                if body is not None:
+                    response = current_app.response_class(body, mimetype='application/json')
+                else:
+                    response = current_app.make_response(f(*args, **kwargs))
+                    if response.status_code != 200:
+                        return response
+                    if use_cache and response.is_json:
+                        response_cache.put(key, response.get_data())
+            response.set_etag(etag)
+            if modified is not None:
+                response.last_modified = modified
+            # Shared caches may store these, but must revalidate with the ETag before reuse
+            response.cache_control.public = True
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return cached_response_decorator
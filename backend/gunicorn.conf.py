@@ -0,0 +1,42 @@
+import glob
+import os
+import shutil
+import tempfile
+
+# gunicorn loads this file from the working directory, so `gunicorn app:app` in the Procfile picks it up.
+# Workers write their metric samples to files in a shared directory, and GET /metrics in any worker sums them.
+# The variable has to be set before the workers import prometheus_client, which is why it lives here.
+DEFAULT_MULTIPROC_DIR = os.path.join(tempfile.gettempdir(), f'forum-metrics-{os.getpid()}')
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', DEFAULT_MULTIPROC_DIR)
+
+# Imported up front: child_exit runs inside the master's SIGCHLD handler, where a first import can re-enter itself
+from prometheus_client import multiprocess
+
+# Worker count comes from WEB_CONCURRENCY, which gunicorn reads itself. models.py sizes each worker's
+# connection pool from the same two variables
+threads = int(os.environ.get('GUNICORN_THREADS', 1))
+
+
+def on_starting(server):
+    '''
+    Starts every run with an empty metrics directory, so counters from a previous master don't leak in
+    '''
+    directory = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    os.makedirs(directory, exist_ok=True)
+    for path in glob.glob(os.path.join(directory, '*.db')):
+        os.remove(path)
+
+
+def child_exit(server, worker):
+    '''
+    Drops a dead worker's live gauges (in-progress requests, pool sizes, memory). Its counters and histograms stay
+    '''
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def on_exit(server):
+    '''
+    Removes the metrics directory when it is the per-master default
+    '''
+    if os.environ['PROMETHEUS_MULTIPROC_DIR'] == DEFAULT_MULTIPROC_DIR:
+        shutil.rmtree(DEFAULT_MULTIPROC_DIR, ignore_errors=True)
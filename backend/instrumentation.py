@@ -0,0 +1,158 @@
+import os
+import threading
+import time
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+
+# Set SQL_INSTRUMENTATION=true to count and time the SQL each request runs
+SQL_INSTRUMENTATION_ENABLED = os.environ.get('SQL_INSTRUMENTATION', 'false').lower() in ('1', 'true', 'yes', 'on')
+# Requests running more statements than this are logged with their slowest statement, which is how N+1 loops show up
+SQL_QUERY_WARN_THRESHOLD = int(os.environ.get('SQL_QUERY_WARN_THRESHOLD', 20))
+# Longest statement text kept for the slowest query
+STATEMENT_PREVIEW = 500
+
+
+class RequestQueries:
+    '''
+    SQL statements run while handling one request
+    '''
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.count = 0
+        self.duration = 0.0
+        self.slowest = None
+        self.slowest_duration = 0.0
+
+    def record(self, statement, duration):
+        self.count += 1
+        self.duration += duration
+        if duration >= self.slowest_duration:
+            self.slowest = statement
+            self.slowest_duration = duration
+
+    def server_timing(self, total):
+        '''
+        Server-Timing header value. Carries durations and the statement count, never statement text
+        '''
+        return ', '.join([
+            f'sql;dur={self.duration * 1000:.3f};desc="{self.count} queries"',
+            f'sql-slowest;dur={self.slowest_duration * 1000:.3f}',
+            f'app;dur={total * 1000:.3f}',
+        ])
+
+
+class RouteStats:
+    '''
+    Per route totals for this process: requests, statements, database time and the worst request seen
+    '''
+    def __init__(self):
+        self._routes = {}
+        self._lock = threading.Lock()
+
+    def add(self, route, queries, total):
+        with self._lock:
+            stats = self._routes.setdefault(route, {
+                'requests': 0, 'queries': 0, 'sql_seconds': 0.0, 'seconds': 0.0,
+                'max_queries': 0, 'slowest_query_seconds': 0.0, 'slowest_query': None,
+            })
+            stats['requests'] += 1
+            stats['queries'] += queries.count
+            stats['sql_seconds'] += queries.duration
+            stats['seconds'] += total
+            stats['max_queries'] = max(stats['max_queries'], queries.count)
+            if queries.slowest is not None and queries.slowest_duration > stats['slowest_query_seconds']:
+                stats['slowest_query_seconds'] = queries.slowest_duration
+                stats['slowest_query'] = queries.slowest
+
+    def snapshot(self):
+        '''
+        Returns a dict of route -> totals, with per request averages added
+        '''
+        with self._lock:
+            routes = {route: dict(stats) for route, stats in self._routes.items()}
+        for stats in routes.values():
+            stats['queries_per_request'] = stats['queries'] / stats['requests']
+            stats['sql_ms_per_request'] = stats['sql_seconds'] * 1000 / stats['requests']
+        return routes
+
+    def clear(self):
+        with self._lock:
+            self._routes.clear()
+
+
+route_stats = RouteStats()
+
+
+def current_queries():
+    '''
+    The RequestQueries of the request being handled, or None outside instrumented requests
+    '''
+    if not has_request_context():
+        return None
+    return g.get('sql_queries')
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['query_started'].pop()
+    queries = current_queries()
+    if queries is not None:
+        queries.record(statement[:STATEMENT_PREVIEW], time.perf_counter() - started)
+
+def handle_error(exception_context):
+    # A failed statement never reaches after_cursor_execute
+    connection = exception_context.connection
+    if connection is not None and connection.info.get('query_started'):
+        connection.info['query_started'].pop()
+
+LISTENERS = (
+    ('before_cursor_execute', before_cursor_execute),
+    ('after_cursor_execute', after_cursor_execute),
+    ('handle_error', handle_error),
+)
+
+def instrument_engine(engine):
+    '''
+    Times every statement engine runs. Statements outside an instrumented request only pay for the lookup of
+    flask.g. Engines already instrumented are left as they are
+    '''
+    for name, listener in LISTENERS:
+        if not event.contains(engine, name, listener):
+            event.listen(engine, name, listener)
+
+
+def init_instrumentation(app, engines):
+    '''
+    Counts and times the SQL of every request on app, reports it in a Server-Timing header and adds it to
+    route_stats. Does nothing unless SQL_INSTRUMENTATION is enabled
+    Arguments
+        engines -- list of the engines whose statements are counted, the primary and its replicas
+    '''
+    app.config['SQL_INSTRUMENTATION'] = SQL_INSTRUMENTATION_ENABLED
+    if not SQL_INSTRUMENTATION_ENABLED:
+        return
+    for engine in engines:
+        instrument_engine(engine)
+
+    @app.before_request
+    def start_sql_instrumentation():
+        g.sql_queries = RequestQueries()
+
+    @app.after_request
+    def finish_sql_instrumentation(response):
+        queries = g.pop('sql_queries', None)
+        if queries is None:
+            return response
+        total = time.perf_counter() - queries.started
+        response.headers.add('Server-Timing', queries.server_timing(total))
+        route = request.endpoint or 'unmatched'
+        route_stats.add(route, queries, total)
+        if queries.count > SQL_QUERY_WARN_THRESHOLD:
+            app.logger.warning(
+                '%s ran %d SQL statements in %.1f ms, slowest %.1f ms: %s',
+                route, queries.count, queries.duration * 1000, queries.slowest_duration * 1000, queries.slowest
+            )
+        return response
@@ -0,0 +1,81 @@
+import os
+from datetime import date, datetime, timezone
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+'''
+JSON encoding for every response. Datetimes are written as ISO-8601 strings. The database stores naive UTC
+values, so those get an explicit +00:00 offset.
+JSON_PROVIDER picks the encoder: 'orjson' (the default when it is installed) or 'std' for the standard library
+json module. Both produce the same output, so switching never changes a response.
+'''
+JSON_PROVIDER = os.environ.get('JSON_PROVIDER', 'orjson' if orjson else 'std')
+
+
+def iso_datetime(value):
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.isoformat()
+
+def default(value):
+    '''
+    Encodes what json can't: datetimes and dates as ISO-8601, then whatever Flask's provider supports
+    (decimals, UUIDs, dataclasses, __html__)
+    '''
+    if isinstance(value, datetime):
+        return iso_datetime(value)
+    if isinstance(value, date):
+        return value.isoformat()
+    return DefaultJSONProvider.default(value)
+
+
+class StdJSONProvider(DefaultJSONProvider):
+    '''
+    Flask's provider with ISO-8601 datetimes. Keys keep their insertion order and text is written as UTF-8
+    rather than \\u escapes, as with orjson
+    '''
+    default = staticmethod(default)
+    sort_keys = False
+    ensure_ascii = False
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    '''
+    Encodes with orjson, which handles dicts, lists and datetimes in native code, and builds responses
+    straight from its bytes
+    '''
+    sort_keys = False
+    options = orjson.OPT_NAIVE_UTC | orjson.OPT_NON_STR_KEYS if orjson else 0
+
+    def _encode(self, obj, indent=None):
+        return orjson.dumps(obj, default=default, option=self.options | (orjson.OPT_INDENT_2 if indent else 0))
+
+    def dumps(self, obj, **kwargs):
+        return self._encode(obj, kwargs.get('indent')).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = self.compact is False or (self.compact is None and self._app.debug)
+        return self._app.response_class(self._encode(obj, indent) + b'\n', mimetype=self.mimetype)
+
+
+JSON_PROVIDERS = {'std': StdJSONProvider}
+if orjson is not None:
+    JSON_PROVIDERS['orjson'] = OrjsonProvider
+
+
+def init_json(app):
+    '''
+    Installs the JSON_PROVIDER encoder on app
+    '''
+    if JSON_PROVIDER not in JSON_PROVIDERS:
+        raise RuntimeError(f'JSON_PROVIDER={JSON_PROVIDER} is not available, choose from {", ".join(JSON_PROVIDERS)}')
+    app.json = JSON_PROVIDERS[JSON_PROVIDER](app)
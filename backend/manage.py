@@ -1,14 +1,87 @@
-from flask_script import Manager
-from flask_migrate import Migrate, MigrateCommand
+import click
+from flask.cli import FlaskGroup
 
 from app import app
-from models import db
+from models import backfill_post_seq, repair_thread_counters
+from cache import response_cache
+from search import rebuild_search_index
+from bulk import BATCH_SIZE, export_ndjson, import_ndjson
 
-migrate = Migrate(app, db)
-manager = Manager(app)
+# flask_script does not run on Flask 3. FlaskGroup picks up Flask-Migrate's `db` commands from app.cli,
+# so `python manage.py db upgrade` keeps working alongside the maintenance commands below.
+manager = FlaskGroup(create_app=lambda: app)
 
-manager.add_command('db', MigrateCommand)
+
+@manager.command('backfill-post-seq')
+def backfill_post_seq_command():
+    '''
+    Numbers existing posts within their threads. Run once after migrating in Post.seq
+    '''
+    backfill_post_seq()
+    click.echo('Post sequence numbers backfilled')
+
+
+@manager.command('repair-thread-counters')
+def repair_thread_counters_command():
+    '''
+    Recomputes the denormalized thread counters from the posts table
+    '''
+    repair_thread_counters()
+    click.echo('Thread counters repaired')
+
+
+@manager.command('rebuild-search-index')
+def rebuild_search_index_command():
+    '''
+    Creates the full text search index if needed and reindexes every post and thread title
+    '''
+    rebuild_search_index()
+    click.echo('Search index rebuilt')
+
+
+@manager.command('export')
+@click.argument('path')
+@click.option('--batch-size', default=BATCH_SIZE, show_default=True, help='Rows fetched per round trip')
+def export_command(path, batch_size):
+    '''
+    Streams users, forums, threads, pages and posts to an NDJSON file. Use a .gz path to compress, - for stdout
+    '''
+    counts = export_ndjson(path, batch_size)
+    if path != '-':
+        for table, count in counts.items():
+            click.echo(f'{table}: {count}')
+
+
+@manager.command('import')
+@click.argument('path')
+@click.option('--batch-size', default=BATCH_SIZE, show_default=True, help='Rows written per executemany')
+def import_command(path, batch_size):
+    '''
+    Loads an NDJSON file written by export into an empty database, in one transaction
+    '''
+    counts = import_ndjson(path, batch_size)
+    response_cache.clear()
+    for table, count in counts.items():
+        click.echo(f'{table}: {count}')
+
+
+@manager.command('clear-cache')
+def clear_cache_command():
+    '''
+    Empties the shared response cache
+    '''
+    response_cache.clear()
+    click.echo('Response cache cleared')
+
+
+@manager.command('cache-stats')
+def cache_stats_command():
+    '''
+    Prints response cache hit rate and size, summed across workers
+    '''
+    for name, value in response_cache.stats().items():
+        click.echo(f'{name}: {value}')
 
 
 if __name__ == '__main__':
-    manager.run()
\ No newline at end of file
+    manager()
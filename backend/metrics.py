@@ -0,0 +1,195 @@
+import os
+import hmac
+import resource
+import threading
+import time
+from flask import Response, abort, g, request
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest, multiprocess
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+from auth import jwks_cache, token_cache
+from cache import response_cache
+
+
+# gunicorn.conf.py points this at a shared directory so every worker's samples are summed on scrape
+MULTIPROCESS_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+# When set, GET /metrics requires "Authorization: Bearer <METRICS_TOKEN>"
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+# Seconds between refreshes of the worker memory gauge
+MEMORY_SAMPLE_INTERVAL = 10
+
+REQUESTS = Counter('forum_http_requests_total', 'Requests handled', ['route', 'method', 'status'])
+REQUEST_DURATION = Histogram(
+    'forum_http_request_duration_seconds', 'Time from routing a request to its response', ['route', 'method'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+REQUESTS_IN_PROGRESS = Gauge('forum_http_requests_in_progress', 'Requests being handled', multiprocess_mode='livesum')
+
+# Pool metrics are labelled pool="primary" or pool="replica-N", N being the replica's place in DATABASE_REPLICA_URLS
+POOL_CHECKOUT_WAIT = Histogram(
+    'forum_db_pool_checkout_wait_seconds', 'Time spent waiting for a database connection from the pool, including connecting', ['pool'],
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30)
+)
+POOL_CHECKOUT_TIMEOUTS = Counter('forum_db_pool_checkout_timeouts_total', 'Checkouts that gave up after the pool timeout', ['pool'])
+POOL_SIZE = Gauge('forum_db_pool_size', 'Connections the pools keep open', ['pool'], multiprocess_mode='livesum')
+POOL_CHECKED_OUT = Gauge('forum_db_pool_checked_out', 'Connections currently checked out', ['pool'], multiprocess_mode='livesum')
+POOL_OVERFLOW = Gauge('forum_db_pool_overflow', 'Connections open beyond the pool size', ['pool'], multiprocess_mode='livesum')
+
+JWKS_FETCHES = Counter('forum_jwks_fetches_total', 'Downloads of the signing key set', ['result'])
+TOKEN_CACHE_LOOKUPS = Counter('forum_token_cache_lookups_total', 'Verified token cache lookups', ['result'])
+WORKER_MEMORY = Gauge('forum_worker_resident_memory_bytes', 'Resident memory of each worker process', multiprocess_mode='liveall')
+
+
+class MeteredQueuePool(QueuePool):
+    '''
+    QueuePool that reports checkout wait time and its size to the metrics above, under pool=pool_label
+    '''
+    pool_label = 'primary'
+
+    @classmethod
+    def labelled(cls, label):
+        '''
+        Subclass reporting under pool=label, to pass as an engine's poolclass
+        '''
+        return type(cls.__name__, (cls,), {'pool_label': label})
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            POOL_CHECKOUT_TIMEOUTS.labels(self.pool_label).inc()
+            raise
+        finally:
+            POOL_CHECKOUT_WAIT.labels(self.pool_label).observe(time.perf_counter() - started)
+            self._report()
+
+    def _do_return_conn(self, record):
+        super()._do_return_conn(record)
+        self._report()
+
+    def _report(self):
+        POOL_SIZE.labels(self.pool_label).set(self.size())
+        POOL_CHECKED_OUT.labels(self.pool_label).set(self.checkedout())
+        POOL_OVERFLOW.labels(self.pool_label).set(max(self.overflow(), 0))
+
+
+class CounterSync:
+    '''
+    Copies plain integer counters kept by other modules into Prometheus counters by adding what changed
+    since the last sync. A counter that went down was reset, so its whole value is new
+    '''
+    def __init__(self, sources):
+        self.sources = sources
+        self._last = {}
+        self._lock = threading.Lock()
+
+    def sync(self):
+        with self._lock:
+            for counter, read in self.sources:
+                value = read()
+                last = self._last.get(counter, 0)
+                delta = value - last if value >= last else value
+                if delta:
+                    counter.inc(delta)
+                self._last[counter] = value
+
+
+class ResponseCacheCollector:
+    '''
+    Reports the response cache's counters at scrape time. They already live in the cache's shared SQLite file,
+    summed over every worker, so they are read once rather than tracked per process
+    '''
+    def __init__(self, cache):
+        self.cache = cache
+
+    def collect(self):
+        stats = self.cache.stats()
+        lookups = CounterMetricFamily('forum_response_cache_lookups', 'Response cache lookups', labels=['result'])
+        lookups.add_metric(['hit'], stats['hits'])
+        lookups.add_metric(['miss'], stats['misses'])
+        yield lookups
+        yield CounterMetricFamily('forum_response_cache_stores', 'Responses stored in the cache', value=stats['stores'])
+        yield CounterMetricFamily('forum_response_cache_evictions', 'Responses evicted to stay under the size bound', value=stats['evictions'])
+        yield GaugeMetricFamily('forum_response_cache_entries', 'Responses in the cache', value=stats['entries'])
+        yield GaugeMetricFamily('forum_response_cache_bytes', 'Total size of cached responses', value=stats['bytes'])
+
+
+def resident_memory():
+    '''
+    Current resident set size in bytes. Falls back to the peak where /proc is not available
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# One per process, like the counters it feeds, however many apps are created
+auth_counters = CounterSync([
+    (JWKS_FETCHES.labels('ok'), lambda: jwks_cache.fetches - jwks_cache.fetch_errors),
+    (JWKS_FETCHES.labels('error'), lambda: jwks_cache.fetch_errors),
+    (TOKEN_CACHE_LOOKUPS.labels('hit'), lambda: token_cache.hits),
+    (TOKEN_CACHE_LOOKUPS.labels('miss'), lambda: token_cache.misses),
+])
+# Kept apart from the default registry, which the multiprocess collector replaces
+cache_registry = CollectorRegistry()
+cache_registry.register(ResponseCacheCollector(response_cache))
+
+
+def init_metrics(app):
+    '''
+    Records request counts and latency for app, keeps the auth cache counters and worker memory current, and
+    returns a view function rendering every metric in the text exposition format
+    '''
+    memory_sampled_at = [0.0]
+
+    def record(status):
+        route = request.endpoint or 'unmatched'
+        REQUESTS.labels(route, request.method, str(status)).inc()
+        REQUEST_DURATION.labels(route, request.method).observe(time.perf_counter() - g.metrics_started)
+        g.metrics_recorded = True
+
+    @app.before_request
+    def start_request_metrics():
+        g.metrics_started = time.perf_counter()
+        g.metrics_recorded = False
+        REQUESTS_IN_PROGRESS.inc()
+
+    @app.after_request
+    def finish_request_metrics(response):
+        if 'metrics_started' in g:
+            record(response.status_code)
+        return response
+
+    @app.teardown_request
+    def teardown_request_metrics(exception):
+        if 'metrics_started' not in g:
+            return
+        REQUESTS_IN_PROGRESS.dec()
+        if not g.metrics_recorded:
+            record(500)
+        # Cheap enough per request, and it keeps workers that are never scraped up to date
+        auth_counters.sync()
+        now = time.monotonic()
+        if now - memory_sampled_at[0] >= MEMORY_SAMPLE_INTERVAL:
+            memory_sampled_at[0] = now
+            WORKER_MEMORY.set(resident_memory())
+
+    def metrics_view():
+        if METRICS_TOKEN:
+            supplied = request.headers.get('Authorization', '')
+            if not hmac.compare_digest(supplied.encode('utf-8'), f'Bearer {METRICS_TOKEN}'.encode('utf-8')):
+                abort(401)
+        auth_counters.sync()
+        WORKER_MEMORY.set(resident_memory())
+        if MULTIPROCESS_DIR is None:
+            registry = REGISTRY
+        else:
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        return Response(generate_latest(registry) + generate_latest(cache_registry), content_type=CONTENT_TYPE_LATEST)
+
+    return metrics_view
@@ -1,5 +1,18 @@
 import os
-from sqlalchemy import Column, String, create_engine
+import base64
+import random
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from math import ceil
+from sqlalchemy import Column, String, UniqueConstraint, create_engine, event, text
+from sqlalchemy.orm import object_session
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import NullPool
+import flask_sqlalchemy.session
 from flask_sqlalchemy import SQLAlchemy
 import json
 from flask import jsonify
@@ -7,12 +20,322 @@ from flask_migrate import Migrate
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
 from roles_and_status import ForumRoles, UserStatus
+from metrics import MeteredQueuePool
+from cache import response_cache
 
 database_path = os.environ['DATABASE_URL']
 if database_path.startswith("postgres://"):
   database_path = database_path.replace("postgres://", "postgresql://", 1)
 
-db = SQLAlchemy()
+# Comma separated read replica URLs. Read routes go to a healthy replica, everything else to DATABASE_URL
+DATABASE_REPLICA_URLS = [
+    url.strip().replace('postgres://', 'postgresql://', 1)
+    for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()
+]
+# Seconds a replica that failed is skipped before it is checked again
+REPLICA_RETRY_SECONDS = int(os.environ.get('REPLICA_RETRY_SECONDS', 30))
+# Seconds between health checks of a replica in use, which also measure its replication lag
+REPLICA_CHECK_INTERVAL = int(os.environ.get('REPLICA_CHECK_INTERVAL', 10))
+# A Postgres replica further behind than this many seconds is treated as down
+REPLICA_MAX_LAG = float(os.environ.get('REPLICA_MAX_LAG', 5))
+# Connect timeout of health checks, which run in the request that finds one due. Short, so a replica that
+# stopped answering costs that request at most this many seconds
+REPLICA_PROBE_TIMEOUT = int(os.environ.get('REPLICA_PROBE_TIMEOUT', 2))
+# Reads of a forum, thread or the user list written less than this many seconds ago go to the primary, so
+# a poster sees their own reply however far behind the replicas are
+REPLICA_STICKY_SECONDS = float(os.environ.get('REPLICA_STICKY_SECONDS', 10))
+
+REPLICA_LAG_SQL = {
+    'postgresql': '''SELECT CASE WHEN pg_last_wal_receive_lsn() IS NULL OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                     ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END''',
+}
+
+
+class ReplicaSet:
+    '''
+    Engines for the read replicas and what is known about their health.
+    A replica is skipped for retry_seconds after a connection error or a failed check, then checked again
+    before it takes reads. Replicas in use are rechecked every check_interval seconds, which for Postgres
+    also compares their replication lag against max_lag. Checks run in the request that finds one due, one
+    at a time per replica, on a connection of their own that gives up after REPLICA_PROBE_TIMEOUT seconds.
+    Arguments
+        retry_seconds -- (int) Seconds a failed replica is skipped
+        check_interval -- (int) Seconds between checks of a healthy replica
+        max_lag -- (float) Seconds of replication lag before a replica counts as down
+    '''
+    def __init__(self, retry_seconds=REPLICA_RETRY_SECONDS, check_interval=REPLICA_CHECK_INTERVAL, max_lag=REPLICA_MAX_LAG):
+        self.retry_seconds = retry_seconds
+        self.check_interval = check_interval
+        self.max_lag = max_lag
+        self.engines = []
+        self._probes = {}
+        self._next_check = {}
+        self._healthy = {}
+        self._lock = threading.Lock()
+
+    def configure(self, urls, options=None):
+        '''
+        Replaces the replica engines with new ones for urls, created with the engine options of the primary
+        Arguments
+            urls -- list of database URLs
+            options -- function returning the engine options for a URL and the label of its pool's metrics
+        '''
+        for engine in self.engines + list(self._probes.values()):
+            engine.dispose()
+        self.engines = [
+            create_engine(url, **(options(url, f'replica-{n}') if options else {})) for n, url in enumerate(urls)
+        ]
+        self._probes = {engine: create_engine(url, **probe_options(url)) for engine, url in zip(self.engines, urls)}
+        self._next_check = {engine: 0 for engine in self.engines}
+        self._healthy = {engine: False for engine in self.engines}
+        for engine in self.engines:
+            event.listen(engine, 'handle_error', self._handle_error)
+
+    def _handle_error(self, exception_context):
+        # Lost or refused connections take the replica out until it passes a check again
+        if exception_context.is_disconnect or exception_context.connection is None:
+            self.mark_down(exception_context.engine)
+
+    def mark_down(self, engine):
+        with self._lock:
+            self._healthy[engine] = False
+            self._next_check[engine] = time.monotonic() + self.retry_seconds
+
+    def check(self, engine):
+        '''
+        Connects to the replica and measures its lag. Returns True when it may take reads
+        '''
+        try:
+            with self._probes[engine].connect() as connection:
+                lag_sql = REPLICA_LAG_SQL.get(engine.dialect.name)
+                lag = float(connection.execute(text(lag_sql)).scalar() or 0) if lag_sql else 0
+        except Exception:
+            lag = None
+        healthy = lag is not None and lag <= self.max_lag
+        with self._lock:
+            self._healthy[engine] = healthy
+            self._next_check[engine] = time.monotonic() + (self.check_interval if healthy else self.retry_seconds)
+        return healthy
+
+    def choose(self):
+        '''
+        Returns a healthy replica engine, or None when reads should go to the primary
+        '''
+        now = time.monotonic()
+        due = []
+        with self._lock:
+            for engine in self.engines:
+                if self._next_check[engine] <= now:
+                    # Claimed by this request, so concurrent requests don't check the same replica
+                    self._next_check[engine] = now + self.retry_seconds
+                    due.append(engine)
+        for engine in due:
+            self.check(engine)
+        healthy = [engine for engine in self.engines if self._healthy[engine]]
+        return random.choice(healthy) if healthy else None
+
+    def is_healthy(self, engine):
+        return self._healthy.get(engine, False)
+
+
+def probe_options(database_path):
+    '''
+    Engine options for replica health checks: a fresh connection per check, given REPLICA_PROBE_TIMEOUT
+    seconds to connect instead of DB_CONNECT_TIMEOUT
+    '''
+    options = {'poolclass': NullPool}
+    if make_url(database_path).get_backend_name() == 'postgresql':
+        options['connect_args'] = {'connect_timeout': REPLICA_PROBE_TIMEOUT}
+    return options
+
+
+replica_set = ReplicaSet()
+
+
+class RoutingSession(flask_sqlalchemy.session.Session):
+    '''
+    Sends the session's statements to a read replica while session.info['read_replica'] is set, unless it is
+    flushing writes. Every other statement, and every read when no replica is healthy, goes to the primary
+    '''
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self.info.get('read_replica') and not self._flushing:
+            engine = self.info.get('replica_engine')
+            if engine is None:
+                # Chosen once, so every statement of the request reads the same snapshot of one replica
+                engine = self.info['replica_engine'] = replica_set.choose() or False
+            if engine:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+
+def read_replica(*scopes):
+    '''
+    Decorator for read-only routes. Their queries go to a healthy replica unless one of scopes was written in
+    the last REPLICA_STICKY_SECONDS, in which case the primary answers so the writer sees the write. If the
+    replica fails during the request the view runs again on the primary.
+    Arguments
+        scopes -- (str) Response cache scopes the route reads, formatted with the view's arguments, e.g. 'thread:{thread_id}'
+    '''
+    def read_replica_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if not replica_set.engines:
+                return f(*args, **kwargs)
+            names = [scope.format(**kwargs) for scope in scopes]
+            # Write times come from the cache versions every worker on the host shares
+            if names and time.time() - response_cache.state(names).updated_at < REPLICA_STICKY_SECONDS:
+                return f(*args, **kwargs)
+            session = db.session()
+            session.info['read_replica'] = True
+            try:
+                return f(*args, **kwargs)
+            except Exception:
+                engine = session.info.get('replica_engine')
+                if not engine or replica_set.is_healthy(engine):
+                    raise
+                session.rollback()
+                session.info['replica_engine'] = False
+                return f(*args, **kwargs)
+            finally:
+                session.info.pop('read_replica', None)
+                session.info.pop('replica_engine', None)
+        return wrapper
+    return read_replica_decorator
+
+POSTS_PER_PAGE = 40
+# What a deleted post's content is replaced with
+DELETED_POST_CONTENT = 'This post has been deleted.'
+# Seconds a cached user name is trusted. Bounds staleness in other worker processes, which miss local invalidations
+USER_NAME_CACHE_TTL = int(os.environ.get('USER_NAME_CACHE_TTL', 300))
+USER_NAME_CACHE_SIZE = int(os.environ.get('USER_NAME_CACHE_SIZE', 10000))
+
+'''
+unit_of_work()
+    groups every model insert/update/delete made inside the block into a single transaction
+'''
+@contextmanager
+def unit_of_work():
+    session = db.session()
+    depth = session.info.get('unit_of_work', 0)
+    session.info['unit_of_work'] = depth + 1
+    try:
+        yield session
+        if depth == 0:
+            session.commit()
+    except Exception:
+        if depth == 0:
+            session.rollback()
+        raise
+    finally:
+        session.info['unit_of_work'] = depth
+
+def commit_or_flush():
+    '''
+    Commits the session, or only flushes it while a unit_of_work block is open so the block commits once
+    '''
+    if db.session.info.get('unit_of_work'):
+        db.session.flush()
+    else:
+        db.session.commit()
+
+def violated_constraint(error, table):
+    '''
+    Name of the unique constraint of table that an IntegrityError reports, None for any other violation
+    Arguments
+        error -- (IntegrityError) Error raised by the flush or commit
+        table -- (Table) Table the statement wrote to
+    '''
+    diag = getattr(error.orig, 'diag', None)
+    if diag is not None:
+        return diag.constraint_name
+    # SQLite only names the columns, e.g. "UNIQUE constraint failed: forums.name"
+    message = str(error.orig)
+    for constraint in table.constraints:
+        if isinstance(constraint, UniqueConstraint):
+            columns = ', '.join(f'{table.name}.{column.name}' for column in constraint.columns)
+            if message == f'UNIQUE constraint failed: {columns}':
+                return constraint.name
+    return None
+
+def env_flag(name, default):
+    return os.environ.get(name, str(default)).lower() in ('1', 'true', 'yes', 'on')
+
+# gunicorn reads WEB_CONCURRENCY for its worker count, and gunicorn.conf.py reads GUNICORN_THREADS for threads per worker
+WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', 1))
+GUNICORN_THREADS = int(os.environ.get('GUNICORN_THREADS', 1))
+# Total connections the database allows this app, shared by every worker. Caps the per worker pool when set
+DB_MAX_CONNECTIONS = int(os.environ.get('DB_MAX_CONNECTIONS', 0))
+# PgBouncer in transaction mode hands each transaction a different server connection, so nothing may be set
+# per session: no startup options and no server side prepared statements
+DB_PGBOUNCER = env_flag('DB_PGBOUNCER', False)
+# Seconds a request waits for a free connection before failing, instead of queueing behind a saturated pool
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+# Managed Postgres and proxies close idle connections, so test them on checkout and replace them every 30 minutes
+DB_POOL_PRE_PING = env_flag('DB_POOL_PRE_PING', True)
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+DB_CONNECT_TIMEOUT = int(os.environ.get('DB_CONNECT_TIMEOUT', 10))
+# Milliseconds, 0 for no limit. Postgres only
+DB_STATEMENT_TIMEOUT = int(os.environ.get('DB_STATEMENT_TIMEOUT', 0))
+
+def pool_settings():
+    '''
+    Per worker pool size and overflow. A worker never runs more requests at once than it has threads, so the
+    pool holds a connection per thread plus a spare, with as many again for bursts (streamed responses, CLI
+    commands, the threaded dev server), unless DB_MAX_CONNECTIONS split over the workers allows less
+    '''
+    pool_size = GUNICORN_THREADS + 1
+    max_overflow = GUNICORN_THREADS
+    if DB_MAX_CONNECTIONS:
+        per_worker = max(DB_MAX_CONNECTIONS // WEB_CONCURRENCY, 1)
+        pool_size = min(pool_size, per_worker)
+        max_overflow = min(max_overflow, per_worker - pool_size)
+    return (
+        int(os.environ.get('DB_POOL_SIZE', pool_size)),
+        int(os.environ.get('DB_MAX_OVERFLOW', max_overflow)),
+    )
+
+def engine_options(database_path, pool_label='primary'):
+    '''
+    SQLAlchemy engine options for database_path, from the DB_* environment variables
+    Arguments
+        database_path -- (str) Database URL
+        pool_label -- (str) Value of the pool label on the connection pool metrics
+    '''
+    url = make_url(database_path)
+    # In-memory SQLite keeps its single connection in a different pool class, with none of these settings
+    if url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:'):
+        return {}
+    pool_size, max_overflow = pool_settings()
+    options = {
+        'poolclass': MeteredQueuePool.labelled(pool_label),
+        'pool_size': pool_size,
+        'max_overflow': max_overflow,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_pre_ping': DB_POOL_PRE_PING,
+        'pool_recycle': DB_POOL_RECYCLE,
+    }
+    if url.get_backend_name() != 'postgresql':
+        return options
+    connect_args = {'connect_timeout': DB_CONNECT_TIMEOUT}
+    if DB_PGBOUNCER:
+        if url.get_driver_name() == 'psycopg':
+            # psycopg 3 prepares repeated statements on the server by default. psycopg2 never does
+            connect_args['prepare_threshold'] = None
+    elif DB_STATEMENT_TIMEOUT:
+        connect_args['options'] = f'-c statement_timeout={DB_STATEMENT_TIMEOUT}'
+    options['connect_args'] = connect_args
+    return options
+
+def statement_timeout_per_transaction(engine, timeout):
+    '''
+    Sets the statement timeout at the start of every transaction, for poolers that drop session settings
+    '''
+    @event.listens_for(engine, 'begin')
+    def set_local_statement_timeout(conn):
+        conn.exec_driver_sql(f'SET LOCAL statement_timeout = {int(timeout)}')
 
 '''
 setup_db(app)
@@ -21,8 +344,14 @@ setup_db(app)
 def setup_db(app, database_path=database_path):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_path)
     db.app = app
     db.init_app(app)
+    replica_set.configure(DATABASE_REPLICA_URLS, engine_options)
+    if DB_PGBOUNCER and DB_STATEMENT_TIMEOUT:
+        for engine in [db.engine] + replica_set.engines:
+            if engine.dialect.name == 'postgresql':
+                statement_timeout_per_transaction(engine, DB_STATEMENT_TIMEOUT)
     db.create_all()
 
 class Forum(db.Model):
@@ -33,20 +362,24 @@ class Forum(db.Model):
     description = db.Column(db.String(120), nullable=False)
     threads = db.relationship('Thread', backref=db.backref('forums'), lazy=True, cascade='all, delete')
 
+    __table_args__ = (
+        db.UniqueConstraint('name', name='uq_forums_name'),
+    )
+
     def __init__(self, name, description):
         self.name = name
         self.description = description
     
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit_or_flush()
 
     def update(self):
-        db.session.commit()
+        commit_or_flush()
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        commit_or_flush()
 
     def format(self):
         return {
@@ -54,14 +387,6 @@ class Forum(db.Model):
             'name': self.name,
             'description': self.description,
         }
-        
-    def format_threads(self):
-        return {
-            'id': self.id,
-            'name': self.name,
-            'description': self.description,
-            'threads': self.threads
-        }
 
 class Thread(db.Model):
     __tablename__ = 'threads'
@@ -70,9 +395,19 @@ class Thread(db.Model):
     forum_id = db.Column(db.Integer, db.ForeignKey('forums.id'))
     title = db.Column(db.String(36), nullable=False)
     user_id = db.Column(db.String(), db.ForeignKey('users.id'))
-    date_created = db.Column(db.DateTime, nullable=False, default=datetime.utcnow())
+    date_created = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     pages = db.relationship('Page', backref=db.backref('threads'), lazy=True, cascade="all, delete")
     locked = db.Column(db.Boolean, default=False)
+    # Denormalized counters. Kept current by next_post_seq, rebuilt by repair_thread_counters
+    post_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    page_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    last_post_at = db.Column(db.DateTime)
+    last_poster = db.Column(db.String(), db.ForeignKey('users.id'))
+
+    __table_args__ = (
+        db.Index('ix_threads_forum_id_activity', 'forum_id', db.func.coalesce(last_post_at, date_created), 'id'),
+        db.Index('ix_threads_forum_id_date_created', 'forum_id', 'date_created', 'id'),
+    )
 
     def lock_thread(self):
         self.locked = True
@@ -82,14 +417,14 @@ class Thread(db.Model):
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit_or_flush()
 
     def update(self):
-        db.session.commit()
+        commit_or_flush()
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        commit_or_flush()
 
     def format(self):
         return {
@@ -98,17 +433,93 @@ class Thread(db.Model):
             'user_id': self.user_id,
             'title': self.title,
             'dateCreated': self.date_created,
-            'pages': len(self.pages),
+            'pages': self.page_count,
+            'postCount': self.post_count,
+            'lastPostAt': self.last_post_at,
+            'lastPoster': self.last_poster,
             'locked': self.locked
         }
     
+    def next_post_seq(self, user_id, posted_at):
+        '''
+        Atomically reserves the next post sequence number in this thread and moves the thread's counters past it.
+        The counter row stays locked until the surrounding transaction commits, so the post using it must be
+        written in the same transaction, and callers should reserve it as late as possible so concurrent
+        posters in the thread wait on the lock only briefly.
+        Arguments
+            user_id -- (str) ID of the user making the post
+            posted_at -- (datetime) Creation date of the post
+        '''
+        seq, page_count = db.session.execute(
+            db.update(Thread)
+            .where(Thread.id == self.id)
+            .values(
+                post_count=Thread.post_count + 1,
+                page_count=Thread.post_count // POSTS_PER_PAGE + 1,
+                last_post_at=posted_at,
+                last_poster=user_id
+            )
+            .returning(Thread.post_count, Thread.page_count)
+            .execution_options(synchronize_session=False)
+        ).one()
+        set_committed_value(self, 'post_count', seq)
+        set_committed_value(self, 'page_count', page_count)
+        set_committed_value(self, 'last_post_at', posted_at)
+        set_committed_value(self, 'last_poster', user_id)
+        return seq
+
+    def get_posts_after(self, seq, limit):
+        '''
+        Keyset read of the posts that follow seq, with their authors' names, in a single indexed query
+        Arguments
+            seq -- (int) Sequence number of the last post the caller already has, 0 for the start of the thread
+            limit -- (int) Maximum number of posts to return
+        '''
+        rows = db.session.query(Post, User.name).outerjoin(User, User.id == Post.user_id).filter(
+            Post.thread_id == self.id,
+            Post.seq > seq
+        ).order_by(Post.seq).limit(limit).all()
+        posts = []
+        for post, user_name in rows:
+            formatted = post.format()
+            formatted['seq'] = post.seq
+            formatted['user_name'] = user_name
+            posts.append(formatted)
+        return posts
+
+    def seq_before(self, timestamp):
+        '''
+        Sequence number of the last post created at or before timestamp, 0 if there is none
+        Arguments
+            timestamp -- (datetime) Naive UTC datetime
+        '''
+        # Walks ix_posts_thread_id_date_created backwards and stops at the first row. MAX(seq) would have to
+        # visit every earlier post of the thread
+        seq = db.session.query(Post.seq).filter(
+            Post.thread_id == self.id,
+            Post.date_created <= timestamp
+        ).order_by(Post.date_created.desc(), Post.seq.desc()).limit(1).scalar()
+        return seq or 0
+
     def get_page_posts(self, page_number):
+        '''
+        Loads one page straight from its post sequence range, without going through Page rows
+        Arguments
+            page_number -- (int) 1 based page number
+        '''
+        if page_number < 1 or page_number > count_pages(self.post_count):
+            raise IndexError(f'Thread {self.id} has no page {page_number}')
+        first, last = page_seq_range(page_number)
+        posts = Post.query.filter(
+            Post.thread_id == self.id,
+            Post.seq.between(first, last)
+        ).order_by(Post.seq).all()
         return {
             'forumId': self.forum_id,
             'id': self.id,
             'title': self.title,
             'dateCreated': self.date_created,
-            'posts': [post.format() for post in self.pages[page_number - 1].posts],
+            'posts': [post.format() for post in posts],
             'locked': self.locked
         }
     
@@ -121,19 +532,30 @@ class Post(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.String(), db.ForeignKey('users.id'))
     page_id = db.Column(db.Integer, db.ForeignKey('pages.id'))
+    thread_id = db.Column(db.Integer, db.ForeignKey('threads.id'))
+    # Dense 1 based position of the post within its thread, see Thread.next_post_seq
+    seq = db.Column(db.Integer)
     content = db.Column(db.String(1024), nullable=False)
-    date_created = db.Column(db.DateTime, nullable=False, default=datetime.utcnow())
+    date_created = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     date_edited = db.Column(db.DateTime)
 
+    __table_args__ = (
+        db.UniqueConstraint('thread_id', 'seq', name='uq_posts_thread_id_seq'),
+        db.Index('ix_posts_thread_id_date_created', 'thread_id', 'date_created'),
+        db.Index('ix_posts_page_id', 'page_id'),
+        # Also walks one user's posts in id order for bulk moderation
+        db.Index('ix_posts_user_id_id', 'user_id', 'id'),
+    )
+
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit_or_flush()
 
     def update(self):
-        db.session.commit()
+        commit_or_flush()
 
     def delete(self):
-        self.content = 'This post has been deleted.'
+        self.content = DELETED_POST_CONTENT
         self.date_edited = datetime.utcnow()
         self.update()
 
@@ -153,18 +575,44 @@ class Page(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     thread_id = db.Column(db.Integer, db.ForeignKey('threads.id'))
     page_number = db.Column(db.Integer)
-    posts = db.relationship('Post', backref=db.backref('pages', uselist=False), order_by='posts.columns.date_created')
+    posts = db.relationship('Post', backref=db.backref('pages', uselist=False), order_by='posts.columns.seq')
+
+    __table_args__ = (
+        db.UniqueConstraint('thread_id', 'page_number', name='uq_pages_thread_id_page_number'),
+    )
 
     def insert(self):
         db.session.add(self)
-        db.session.commit() 
+        commit_or_flush()
+
+    @staticmethod
+    def ensure(thread_id, page_number):
+        '''
+        Returns the id of a thread's page, creating the page if it does not exist yet.
+        The insert is an INSERT ... ON CONFLICT DO NOTHING against uq_pages_thread_id_page_number, so two
+        writers racing to open the same page both end up with the one row.
+        Arguments
+            thread_id -- (int) ID of the thread
+            page_number -- (int) 1 based page number
+        '''
+        query = db.session.query(Page.id).filter(Page.thread_id == thread_id, Page.page_number == page_number)
+        page_id = query.scalar()
+        if page_id is None:
+            dialect = postgresql if db.session.get_bind().dialect.name == 'postgresql' else sqlite
+            db.session.execute(
+                dialect.insert(Page)
+                .values(thread_id=thread_id, page_number=page_number)
+                .on_conflict_do_nothing(index_elements=['thread_id', 'page_number'])
+            )
+            page_id = query.scalar()
+        return page_id
 
 class User(db.Model):
     __tablename__ = 'users'
 
     id = db.Column(db.String(), primary_key=True)
     name = db.Column(db.String(36), nullable=False)
-    join_date = db.Column(db.DateTime, default=datetime.utcnow())
+    join_date = db.Column(db.DateTime, default=datetime.utcnow)
     posts = db.relationship('Post', backref=db.backref('users'), lazy=True)
     # role = db.Column(db.String(), nullable=False, default=ForumRoles.USER)
     role = db.Column(db.String(), nullable=False, default='USER')
@@ -173,6 +621,13 @@ class User(db.Model):
     probation_start_date = db.Column(db.DateTime)
     probation_end_date = db.Column(db.DateTime)
 
+    # The admin user list pages by id within a role or status, and searches names by case-insensitive prefix
+    __table_args__ = (
+        db.Index('ix_users_role_id', 'role', 'id'),
+        db.Index('ix_users_status_id', 'status', 'id'),
+        db.Index('ix_users_name_lower', db.func.lower(name).label('name_lower'), postgresql_ops={'name_lower': 'text_pattern_ops'}),
+    )
+
     def format(self):
         return {
             'id': self.id,
@@ -185,10 +640,10 @@ class User(db.Model):
 
     def insert(self):
         db.session.add(self)
-        db.session.commit()
+        commit_or_flush()
     
     def update(self):
-        db.session.commit()
+        commit_or_flush()
 
     def set_role(self, new_role):
         status = 'FAILED'
@@ -238,3 +693,178 @@ class User(db.Model):
             self.probation_end_date = self.probation_start_date + relativedelta(hours=hours, days=days, months=months)
             status = 'SUCCESS'
         return status
+
+
+class UserNameCache:
+    '''
+    Small per-process map of user id -> display name so page views don't look authors up one by one.
+    Misses are loaded with a single IN query. Entries are dropped when this process updates or deletes the
+    user and otherwise expire after ttl seconds.
+    Arguments
+        ttl -- (int) Seconds an entry is trusted
+        maxsize -- (int) Maximum number of names kept
+    '''
+    def __init__(self, ttl=USER_NAME_CACHE_TTL, maxsize=USER_NAME_CACHE_SIZE):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._names = {}
+        self._lock = threading.Lock()
+
+    def get_many(self, user_ids):
+        '''
+        Returns a dict of user id -> name for user_ids, None for ids with no user row
+        Arguments
+            user_ids -- iterable of user ids
+        '''
+        now = time.monotonic()
+        names = {}
+        missing = set()
+        with self._lock:
+            for user_id in set(user_ids):
+                entry = self._names.get(user_id)
+                if entry is not None and now - entry[1] < self.ttl:
+                    names[user_id] = entry[0]
+                else:
+                    missing.add(user_id)
+        if missing:
+            loaded = dict(db.session.query(User.id, User.name).filter(User.id.in_(missing)).all())
+            with self._lock:
+                if len(self._names) + len(loaded) > self.maxsize:
+                    self._names.clear()
+                for user_id, name in loaded.items():
+                    self._names[user_id] = (name, now)
+            for user_id in missing:
+                names[user_id] = loaded.get(user_id)
+        return names
+
+    def invalidate(self, user_id=None):
+        '''
+        Drops one user's name, or every name when user_id is None
+        '''
+        with self._lock:
+            if user_id is None:
+                self._names.clear()
+            else:
+                self._names.pop(user_id, None)
+
+
+user_name_cache = UserNameCache()
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def invalidate_user_name(mapper, connection, target):
+    user_name_cache.invalidate(target.id)
+
+# Thread pages show author names through the 'user-names' cache scope, which moves once a name change commits
+@event.listens_for(User, 'after_update')
+def user_name_changed(mapper, connection, target):
+    if db.inspect(target).attrs.name.history.has_changes():
+        object_session(target).info['user_names_changed'] = True
+
+@event.listens_for(User, 'after_delete')
+def user_name_removed(mapper, connection, target):
+    object_session(target).info['user_names_changed'] = True
+
+@event.listens_for(RoutingSession, 'after_commit')
+def bump_user_names(session):
+    if session.info.pop('user_names_changed', False):
+        response_cache.bump('user-names')
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def forget_user_names(session):
+    session.info.pop('user_names_changed', None)
+
+
+# Sort keys of the forum thread listing. Threads written by bulk SQL, or before repair-thread-counters ran, have
+# no last_post_at yet and sort by their creation date, so the key is never NULL for a keyset cursor
+THREAD_ORDERS = {
+    'activity': db.func.coalesce(Thread.last_post_at, Thread.date_created),
+    'created': Thread.date_created,
+}
+
+def encode_cursor(*values):
+    '''
+    Packs keyset values into an opaque url safe cursor
+    '''
+    raw = '|'.join(str(value) for value in values)
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    '''
+    Unpacks a cursor made by encode_cursor into its string values. Raises ValueError for a malformed cursor
+    '''
+    try:
+        return base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').split('|')
+    except (UnicodeError, base64.binascii.Error) as e:
+        raise ValueError(f'Malformed cursor: {e}')
+
+def count_pages(post_count):
+    '''
+    Number of pages needed to hold post_count posts
+    '''
+    return ceil(post_count / POSTS_PER_PAGE)
+
+def page_for_seq(seq):
+    '''
+    Page number that the post with sequence number seq lives on
+    '''
+    return (seq - 1) // POSTS_PER_PAGE + 1
+
+def page_seq_range(page_number):
+    '''
+    First and last post sequence numbers on page_number
+    '''
+    return (page_number - 1) * POSTS_PER_PAGE + 1, page_number * POSTS_PER_PAGE
+
+REPAIR_THREAD_COUNTERS = [
+    '''UPDATE threads SET
+           post_count = COALESCE((SELECT MAX(posts.seq) FROM posts WHERE posts.thread_id = threads.id), 0),
+           last_post_at = COALESCE((SELECT MAX(posts.date_created) FROM posts WHERE posts.thread_id = threads.id), threads.date_created),
+           last_poster = (SELECT posts.user_id FROM posts WHERE posts.thread_id = threads.id ORDER BY posts.seq DESC LIMIT 1)''',
+    'UPDATE threads SET page_count = (post_count + :per_page - 1) / :per_page',
+]
+
+def repair_thread_counters():
+    '''
+    Recomputes every thread's post_count, page_count, last_post_at and last_poster from its posts
+    '''
+    try:
+        for statement in REPAIR_THREAD_COUNTERS:
+            db.session.execute(text(statement), {'per_page': POSTS_PER_PAGE})
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+def backfill_post_seq():
+    '''
+    Numbers every existing post within its thread and brings the thread counters and the Page rows in line.
+    Posts keep their current order (page, then creation date). Meant to be run once right after the
+    thread_id/seq/post_count columns are migrated in, before the app serves writes.
+    '''
+    statements = [
+        'UPDATE posts SET thread_id = pages.thread_id FROM pages WHERE posts.page_id = pages.id AND posts.thread_id IS NULL',
+        'UPDATE posts SET seq = NULL',
+        '''UPDATE posts SET seq = numbered.seq FROM (
+               SELECT posts.id AS id, row_number() OVER (
+                   PARTITION BY posts.thread_id ORDER BY pages.page_number, posts.date_created, posts.id
+               ) AS seq
+               FROM posts JOIN pages ON pages.id = posts.page_id
+           ) AS numbered WHERE posts.id = numbered.id''',
+        *REPAIR_THREAD_COUNTERS,
+        '''INSERT INTO pages (thread_id, page_number)
+           SELECT DISTINCT posts.thread_id, (posts.seq - 1) / :per_page + 1 FROM posts
+           WHERE NOT EXISTS (
+               SELECT 1 FROM pages WHERE pages.thread_id = posts.thread_id AND pages.page_number = (posts.seq - 1) / :per_page + 1
+           )''',
+        '''UPDATE posts SET page_id = (
+               SELECT pages.id FROM pages WHERE pages.thread_id = posts.thread_id AND pages.page_number = (posts.seq - 1) / :per_page + 1
+           )''',
+    ]
+    try:
+        for statement in statements:
+            db.session.execute(text(statement), {'per_page': POSTS_PER_PAGE})
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
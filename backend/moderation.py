@@ -0,0 +1,246 @@
+import os
+from datetime import datetime, timezone
+from sqlalchemy.dialects import postgresql, sqlite
+from models import db, Forum, Thread, Page, Post, DELETED_POST_CONTENT, POSTS_PER_PAGE, count_pages
+
+
+# Posts changed per UPDATE statement. Every chunk runs in the same transaction, this only bounds statement size
+MODERATION_CHUNK_SIZE = int(os.environ.get('MODERATION_CHUNK_SIZE', 1000))
+
+
+def naive_utc(timestamp):
+    '''
+    Parses an ISO-8601 timestamp into the naive UTC datetime the database stores. Times without an offset are UTC
+    '''
+    value = datetime.fromisoformat(timestamp)
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+def ids_from_json(data, name):
+    '''
+    Reads a list of integer IDs from a request body. Raises ValueError unless data[name] is one
+    '''
+    ids = data.get(name) if isinstance(data, dict) else None
+    if not isinstance(ids, list) or not all(isinstance(id_, int) and not isinstance(id_, bool) for id_ in ids):
+        raise ValueError(f'{name} must be a list of integers')
+    return ids
+
+def filters_from_json(data):
+    '''
+    Reads the post selection of a bulk moderation request body into keyword arguments for post_filters.
+    Raises ValueError for a malformed body
+    Arguments
+        data -- (dict) Request JSON with post_ids or user_id, and optionally forum_id, since and until
+    '''
+    if not isinstance(data, dict):
+        raise ValueError('Expected a JSON object')
+    filters = {}
+    if data.get('post_ids') is not None:
+        filters['post_ids'] = ids_from_json(data, 'post_ids')
+    if data.get('user_id') is not None:
+        filters['user_id'] = str(data['user_id'])
+    if data.get('forum_id') is not None:
+        filters['forum_id'] = int(data['forum_id'])
+    for name in ('since', 'until'):
+        if data.get(name) is not None:
+            filters[name] = naive_utc(data[name])
+    if 'post_ids' not in filters and 'user_id' not in filters:
+        raise ValueError('post_ids or user_id is required')
+    return filters
+
+def post_filters(post_ids=None, user_id=None, forum_id=None, since=None, until=None):
+    '''
+    WHERE conditions narrowing down the posts a bulk action applies to, apart from post_ids. Every criterion
+    given must match
+    Arguments
+        post_ids -- (list of int) Only these posts
+        user_id -- (str) Only posts written by this user
+        forum_id -- (int) Only posts in threads of this forum
+        since -- (datetime) Only posts created at or after this naive UTC time
+        until -- (datetime) Only posts created before this naive UTC time
+    Raises ValueError when neither post_ids nor user_id is given, so a bad request can't touch every post
+    '''
+    if post_ids is None and user_id is None:
+        raise ValueError('post_ids or user_id is required')
+    conditions = []
+    if user_id is not None:
+        conditions.append(Post.user_id == user_id)
+    if forum_id is not None:
+        conditions.append(Post.thread_id.in_(db.select(Thread.id).where(Thread.forum_id == forum_id)))
+    if since is not None:
+        conditions.append(Post.date_created >= since)
+    if until is not None:
+        conditions.append(Post.date_created < until)
+    return conditions
+
+def update_posts(values, conditions, post_ids=None, chunk_size=MODERATION_CHUNK_SIZE):
+    '''
+    Applies values to the posts matching conditions with set-based UPDATE statements of at most chunk_size posts
+    each. Given post_ids are split into chunks up front. Otherwise the matching posts are walked in id order, each
+    chunk picked by a keyset subquery inside its UPDATE. Runs in the session's transaction and leaves committing
+    to the caller
+    Arguments
+        values -- (dict) Column name -> new value
+        conditions -- WHERE conditions, see post_filters
+        post_ids -- (list of int) Only these posts
+        chunk_size -- (int) Maximum posts per statement
+    Returns the number of posts updated and the set of their thread ids
+    '''
+    updated = 0
+    thread_ids = set()
+
+    def update(in_chunk):
+        nonlocal updated
+        rows = db.session.execute(
+            db.update(Post)
+            .where(in_chunk, *conditions)
+            .values(**values)
+            .returning(Post.id, Post.thread_id)
+            .execution_options(synchronize_session=False)
+        ).all()
+        updated += len(rows)
+        thread_ids.update(thread_id for _, thread_id in rows)
+        return rows
+
+    if post_ids is not None:
+        post_ids = sorted(set(post_ids))
+        for start in range(0, len(post_ids), chunk_size):
+            update(Post.id.in_(post_ids[start:start + chunk_size]))
+        return updated, thread_ids
+    last_id = 0
+    while True:
+        chunk = db.select(Post.id).where(*conditions, Post.id > last_id).order_by(Post.id).limit(chunk_size)
+        rows = update(Post.id.in_(chunk.scalar_subquery()))
+        if len(rows) < chunk_size:
+            return updated, thread_ids
+        last_id = max(post_id for post_id, _ in rows)
+
+def delete_posts(chunk_size=MODERATION_CHUNK_SIZE, **filters):
+    '''
+    Soft deletes every matching post the way Post.delete does. Posts already deleted are left alone
+    Arguments
+        filters -- see post_filters
+    Returns the number of posts deleted and the set of their thread ids
+    '''
+    conditions = post_filters(**filters) + [Post.content != DELETED_POST_CONTENT]
+    values = {'content': DELETED_POST_CONTENT, 'date_edited': datetime.utcnow()}
+    return update_posts(values, conditions, filters.get('post_ids'), chunk_size)
+
+def edit_posts(content, chunk_size=MODERATION_CHUNK_SIZE, **filters):
+    '''
+    Replaces the content of every matching post and marks it edited
+    Arguments
+        content -- (str) New content
+        filters -- see post_filters
+    Returns the number of posts edited and the set of their thread ids
+    '''
+    values = {'content': content, 'date_edited': datetime.utcnow()}
+    return update_posts(values, post_filters(**filters), filters.get('post_ids'), chunk_size)
+
+def set_threads_locked(thread_ids, locked):
+    '''
+    Locks or unlocks threads with a single UPDATE. Locked threads only take posts from admins
+    Arguments
+        thread_ids -- (list of int) IDs of the threads
+        locked -- (bool) True to lock, False to unlock
+    Returns a dict of thread id -> forum id for every thread found
+    '''
+    rows = db.session.execute(
+        db.update(Thread)
+        .where(Thread.id.in_(thread_ids))
+        .values(locked=locked)
+        .returning(Thread.id, Thread.forum_id)
+        .execution_options(synchronize_session=False)
+    ).all()
+    return dict(rows)
+
+def move_threads(thread_ids, forum_id):
+    '''
+    Moves threads to another forum with a single UPDATE
+    Arguments
+        thread_ids -- (list of int) IDs of the threads
+        forum_id -- (int) ID of the forum they move to
+    Returns a dict of thread id -> the forum id it moved from, for every thread found.
+    Raises LookupError when there is no such forum
+    '''
+    if db.session.execute(db.select(Forum.id).where(Forum.id == forum_id)).scalar() is None:
+        raise LookupError(f'No forum {forum_id}')
+    moved_from = dict(db.session.execute(
+        db.select(Thread.id, Thread.forum_id).where(Thread.id.in_(thread_ids)).with_for_update()
+    ).all())
+    db.session.execute(
+        db.update(Thread)
+        .where(Thread.id.in_(thread_ids))
+        .values(forum_id=forum_id)
+        .execution_options(synchronize_session=False)
+    )
+    return moved_from
+
+def merge_threads(source_id, target_id):
+    '''
+    Moves every post of the source thread into the target thread and deletes the source. Posts of both threads
+    are renumbered in creation order and put on the pages their new numbers fall on, all with a fixed number of
+    set-based statements however long the threads are. Runs in the session's transaction and leaves committing
+    to the caller
+    Arguments
+        source_id -- (int) ID of the thread that is merged away
+        target_id -- (int) ID of the thread that receives the posts
+    Returns a dict of thread id -> forum id for both threads, as before the merge.
+    Raises ValueError when both IDs are the same thread and LookupError when either thread doesn't exist
+    '''
+    if source_id == target_id:
+        raise ValueError('A thread cannot be merged into itself')
+    # Row locks, taken in id order, hold off posters in either thread until the merge commits
+    forums = dict(db.session.execute(
+        db.select(Thread.id, Thread.forum_id)
+        .where(Thread.id.in_([source_id, target_id]))
+        .order_by(Thread.id)
+        .with_for_update()
+    ).all())
+    if len(forums) != 2:
+        raise LookupError(f'Threads {source_id} and {target_id} must both exist')
+
+    # New numbers are written negated first, so they can never collide with an old one under uq_posts_thread_id_seq
+    ranked = db.select(
+        Post.id, db.func.row_number().over(order_by=(Post.date_created, Post.id)).label('seq')
+    ).where(Post.thread_id.in_([source_id, target_id])).subquery()
+    post_count = db.session.execute(
+        db.update(Post)
+        .where(Post.id == ranked.c.id)
+        .values(thread_id=target_id, seq=-ranked.c.seq)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+
+    dialect = postgresql if db.session.get_bind().dialect.name == 'postgresql' else sqlite
+    if post_count:
+        db.session.execute(
+            dialect.insert(Page).on_conflict_do_nothing(index_elements=['thread_id', 'page_number']),
+            [{'thread_id': target_id, 'page_number': n} for n in range(1, count_pages(post_count) + 1)]
+        )
+    page_id = db.select(Page.id).where(
+        Page.thread_id == target_id,
+        Page.page_number == (-Post.seq - 1) // POSTS_PER_PAGE + 1
+    ).scalar_subquery()
+    db.session.execute(
+        db.update(Post)
+        .where(Post.thread_id == target_id)
+        .values(seq=-Post.seq, page_id=page_id)
+        .execution_options(synchronize_session=False)
+    )
+
+    db.session.execute(db.delete(Page).where(Page.thread_id == source_id).execution_options(synchronize_session=False))
+    db.session.execute(db.delete(Thread).where(Thread.id == source_id).execution_options(synchronize_session=False))
+    last_post = db.select(Post.date_created, Post.user_id).where(Post.thread_id == target_id).order_by(Post.seq.desc()).limit(1)
+    db.session.execute(
+        db.update(Thread)
+        .where(Thread.id == target_id)
+        .values(
+            post_count=post_count,
+            page_count=count_pages(post_count),
+            last_post_at=db.func.coalesce(last_post.with_only_columns(Post.date_created).scalar_subquery(), Thread.date_created),
+            last_poster=last_post.with_only_columns(Post.user_id).scalar_subquery()
+        )
+        .execution_options(synchronize_session=False)
+    )
+    return forums
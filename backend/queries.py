@@ -0,0 +1,206 @@
+from datetime import datetime
+from models import (
+    db, Forum, Thread, Post, User, THREAD_ORDERS,
+    encode_cursor, decode_cursor, count_pages, page_seq_range
+)
+
+
+'''
+Read layer for the listing routes. Each query selects only the columns its response needs and builds the
+response dicts straight from the row tuples, so no ORM objects are created, tracked in the identity map or
+expired on commit. The dicts match the models' format() methods key for key.
+'''
+
+# Response key -> column, in the key order of the matching format() method
+FORUM_FIELDS = (
+    ('id', Forum.id),
+    ('name', Forum.name),
+    ('description', Forum.description),
+)
+THREAD_FIELDS = (
+    ('forumId', Thread.forum_id),
+    ('id', Thread.id),
+    ('user_id', Thread.user_id),
+    ('title', Thread.title),
+    ('dateCreated', Thread.date_created),
+    ('pages', Thread.page_count),
+    ('postCount', Thread.post_count),
+    ('lastPostAt', Thread.last_post_at),
+    ('lastPoster', Thread.last_poster),
+    ('locked', Thread.locked),
+)
+POST_FIELDS = (
+    ('id', Post.id),
+    ('user_id', Post.user_id),
+    ('page_id', Post.page_id),
+    ('content', Post.content),
+    ('dateCreated', Post.date_created),
+    ('dateEdited', Post.date_edited),
+)
+USER_FIELDS = (
+    ('id', User.id),
+    ('name', User.name),
+    ('role', User.role),
+    ('status', User.status),
+    ('probationStartDate', User.probation_start_date),
+    ('probationEndDate', User.probation_end_date),
+)
+# Thread columns get_thread_page needs, beyond its posts
+PAGE_THREAD_FIELDS = (
+    ('forumId', Thread.forum_id),
+    ('id', Thread.id),
+    ('title', Thread.title),
+    ('dateCreated', Thread.date_created),
+    ('locked', Thread.locked),
+)
+
+
+def select_fields(fields):
+    return db.select(*(column for _, column in fields))
+
+def rows_to_dicts(fields, rows):
+    '''
+    Builds one dict per row, keyed by the response keys of fields
+    Arguments
+        fields -- sequence of (key, column) pairs the rows were selected with
+        rows -- iterable of row tuples
+    '''
+    keys = [key for key, _ in fields]
+    return [dict(zip(keys, row)) for row in rows]
+
+
+def list_forums():
+    '''
+    Every forum, as Forum.format() would give it
+    '''
+    return rows_to_dicts(FORUM_FIELDS, db.session.execute(select_fields(FORUM_FIELDS)))
+
+def get_forum(forum_id):
+    '''
+    One forum as Forum.format() would give it, None when there is no such forum
+    Arguments
+        forum_id -- (int) ID of the forum
+    '''
+    rows = rows_to_dicts(FORUM_FIELDS, db.session.execute(select_fields(FORUM_FIELDS).where(Forum.id == forum_id)))
+    return rows[0] if rows else None
+
+def list_forum_threads(forum_id, order='activity', limit=50, cursor=None):
+    '''
+    Keyset page of a forum's threads, newest first, as Thread.format() would give them
+    Arguments
+        forum_id -- (int) ID of the forum
+        order -- (str) 'activity' orders by last post date, or creation date before the first post, 'created' by
+            thread creation date
+        limit -- (int) Maximum number of threads to return
+        cursor -- (str) next_cursor from the previous page, None for the first page
+    Returns the threads and the cursor for the following page, None when there is none.
+    Raises ValueError for a malformed cursor
+    '''
+    column = THREAD_ORDERS[order]
+    # The sort key is selected last, after the response fields, for the cursor
+    query = select_fields(THREAD_FIELDS).add_columns(column).where(Thread.forum_id == forum_id)
+    if cursor is not None:
+        position, thread_id = decode_cursor(cursor)
+        query = query.where(db.tuple_(column, Thread.id) < db.tuple_(datetime.fromisoformat(position), int(thread_id)))
+    query = query.order_by(column.desc(), Thread.id.desc()).limit(limit + 1)
+    rows = db.session.execute(query).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][-1].isoformat(), rows[-1].id)
+    return rows_to_dicts(THREAD_FIELDS, rows), next_cursor
+
+def user_dicts(rows):
+    users = rows_to_dicts(USER_FIELDS, rows)
+    for user in users:
+        user['probationStartDate'] = user['probationStartDate'] or ''
+        user['probationEndDate'] = user['probationEndDate'] or ''
+    return users
+
+def select_users(role=None, status=None, name_prefix=None, cursor=None):
+    '''
+    Users matching every filter given, in id order
+    Arguments
+        role -- (str) Only users with this role
+        status -- (str) Only users with this status
+        name_prefix -- (str) Only users whose name starts with this, ignoring case
+        cursor -- (str) next_cursor from the previous page, None to start from the first user
+    Raises ValueError for a malformed cursor
+    '''
+    query = select_fields(USER_FIELDS)
+    if role is not None:
+        query = query.where(User.role == role)
+    if status is not None:
+        query = query.where(User.status == status)
+    if name_prefix:
+        escaped = name_prefix.lower().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        query = query.where(db.func.lower(User.name).like(escaped + '%', escape='\\'))
+    if cursor is not None:
+        # Auth0 user ids contain '|', the cursor separator
+        query = query.where(User.id > '|'.join(decode_cursor(cursor)))
+    return query.order_by(User.id)
+
+def list_users(**filters):
+    '''
+    Every user matching filters (see select_users), as User.format() would give them
+    '''
+    return user_dicts(db.session.execute(select_users(**filters)))
+
+def page_users(limit=50, **filters):
+    '''
+    Keyset page of the users matching filters (see select_users)
+    Arguments
+        limit -- (int) Maximum number of users to return
+    Returns the users and the cursor for the following page, None when there is none
+    '''
+    users = user_dicts(db.session.execute(select_users(**filters).limit(limit + 1)))
+    next_cursor = None
+    if len(users) > limit:
+        users = users[:limit]
+        next_cursor = encode_cursor(users[-1]['id'])
+    return users, next_cursor
+
+def stream_users(batch_size=1000, **filters):
+    '''
+    Every user matching filters (see select_users), read through a server side cursor batch_size rows at a time.
+    The query runs right away, on the connection of the current request, and the returned generator yields
+    lists of user dicts, so memory stays flat however many users there are
+    '''
+    result = db.session.execute(select_users(**filters).execution_options(yield_per=batch_size))
+
+    def batches():
+        try:
+            for rows in result.partitions():
+                yield user_dicts(rows)
+        finally:
+            result.close()
+    return batches()
+
+def get_thread_page(thread_id, page_number):
+    '''
+    One page of a thread as Thread.get_page_posts would give it
+    Arguments
+        thread_id -- (int) ID of the thread
+        page_number -- (int) 1 based page number
+    Raises LookupError when there is no such thread and IndexError when the thread has no such page
+    '''
+    row = db.session.execute(
+        select_fields(PAGE_THREAD_FIELDS).add_columns(Thread.post_count).where(Thread.id == thread_id)
+    ).first()
+    if row is None:
+        raise LookupError(f'No thread {thread_id}')
+    *thread_values, post_count = row
+    if page_number < 1 or page_number > count_pages(post_count):
+        raise IndexError(f'Thread {thread_id} has no page {page_number}')
+    first, last = page_seq_range(page_number)
+    posts = db.session.execute(
+        select_fields(POST_FIELDS).where(
+            Post.thread_id == thread_id,
+            Post.seq.between(first, last)
+        ).order_by(Post.seq)
+    )
+    page = rows_to_dicts(PAGE_THREAD_FIELDS, [thread_values])[0]
+    page['posts'] = rows_to_dicts(POST_FIELDS, posts)
+    # Same key order as Thread.get_page_posts
+    page['locked'] = page.pop('locked')
+    return page
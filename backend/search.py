@@ -0,0 +1,230 @@
+import os
+from sqlalchemy import text
+from models import db, encode_cursor, decode_cursor, page_for_seq
+
+
+# Text search configuration for Postgres. Changing it means dropping the search_vector columns and running
+# rebuild-search-index again
+SEARCH_LANGUAGE = os.environ.get('SEARCH_LANGUAGE', 'english')
+
+# Postgres keeps a generated tsvector next to each searchable column, so every write path (ORM or bulk SQL)
+# updates the index in the writing transaction. Adding the column computes it for existing rows.
+POSTGRES_COLUMNS = [
+    f"ALTER TABLE posts ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (to_tsvector('{SEARCH_LANGUAGE}', coalesce(content, ''))) STORED",
+    f"ALTER TABLE threads ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (to_tsvector('{SEARCH_LANGUAGE}', coalesce(title, ''))) STORED",
+]
+# Built CONCURRENTLY so posting carries on while they build. Index name -> table
+POSTGRES_INDEXES = {
+    'ix_posts_search_vector': 'posts',
+    'ix_threads_search_vector': 'threads',
+}
+
+# SQLite uses external content FTS5 tables kept in step by triggers, for the same reason
+SQLITE_INDEX = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5(content, content='posts', content_rowid='id')",
+    '''CREATE TRIGGER IF NOT EXISTS posts_fts_insert AFTER INSERT ON posts BEGIN
+           INSERT INTO posts_fts (rowid, content) VALUES (new.id, new.content);
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS posts_fts_delete AFTER DELETE ON posts BEGIN
+           INSERT INTO posts_fts (posts_fts, rowid, content) VALUES ('delete', old.id, old.content);
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS posts_fts_update AFTER UPDATE OF content ON posts BEGIN
+           INSERT INTO posts_fts (posts_fts, rowid, content) VALUES ('delete', old.id, old.content);
+           INSERT INTO posts_fts (rowid, content) VALUES (new.id, new.content);
+       END''',
+    "CREATE VIRTUAL TABLE IF NOT EXISTS threads_fts USING fts5(title, content='threads', content_rowid='id')",
+    '''CREATE TRIGGER IF NOT EXISTS threads_fts_insert AFTER INSERT ON threads BEGIN
+           INSERT INTO threads_fts (rowid, title) VALUES (new.id, new.title);
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS threads_fts_delete AFTER DELETE ON threads BEGIN
+           INSERT INTO threads_fts (threads_fts, rowid, title) VALUES ('delete', old.id, old.title);
+       END''',
+    '''CREATE TRIGGER IF NOT EXISTS threads_fts_update AFTER UPDATE OF title ON threads BEGIN
+           INSERT INTO threads_fts (threads_fts, rowid, title) VALUES ('delete', old.id, old.title);
+           INSERT INTO threads_fts (rowid, title) VALUES (new.id, new.title);
+       END''',
+]
+
+SQLITE_REBUILD = [
+    "INSERT INTO posts_fts (posts_fts) VALUES ('rebuild')",
+    "INSERT INTO threads_fts (threads_fts) VALUES ('rebuild')",
+]
+
+# Per dialect: FROM clause joining the index, match condition and score (higher is better) for each searchable type
+# Scores are doubles on both dialects (ts_rank_cd returns real), so the score a cursor carries compares exactly
+SEARCH_SQL = {
+    'postgresql': {
+        'posts': (
+            'posts', 'posts.search_vector @@ websearch_to_tsquery(CAST(:language AS regconfig), :q)',
+            'CAST(ts_rank_cd(posts.search_vector, websearch_to_tsquery(CAST(:language AS regconfig), :q)) AS float8)'
+        ),
+        'threads': (
+            'threads', 'threads.search_vector @@ websearch_to_tsquery(CAST(:language AS regconfig), :q)',
+            'CAST(ts_rank_cd(threads.search_vector, websearch_to_tsquery(CAST(:language AS regconfig), :q)) AS float8)'
+        ),
+    },
+    'sqlite': {
+        'posts': ('posts_fts JOIN posts ON posts.id = posts_fts.rowid', 'posts_fts MATCH :q', '-bm25(posts_fts)'),
+        'threads': ('threads_fts JOIN threads ON threads.id = threads_fts.rowid', 'threads_fts MATCH :q', '-bm25(threads_fts)'),
+    },
+}
+
+SEARCH_TYPES = ('posts', 'threads')
+
+
+def create_search_index(connection):
+    '''
+    Creates the full text index for the connection's dialect. Safe to run repeatedly
+    Arguments
+        connection -- SQLAlchemy connection in autocommit mode, which CREATE INDEX CONCURRENTLY needs
+    '''
+    if connection.dialect.name == 'sqlite':
+        for statement in SQLITE_INDEX:
+            connection.execute(text(statement))
+    if connection.dialect.name != 'postgresql':
+        return
+    for statement in POSTGRES_COLUMNS:
+        connection.execute(text(statement))
+    for index, table in POSTGRES_INDEXES.items():
+        # A concurrent build that failed leaves an invalid index behind, which IF NOT EXISTS would keep
+        invalid = connection.execute(text('''
+            SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid
+            WHERE pg_class.relname = :index AND NOT pg_index.indisvalid'''), {'index': index}).scalar()
+        if invalid:
+            connection.execute(text(f'DROP INDEX CONCURRENTLY {index}'))
+        connection.execute(text(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {index} ON {table} USING GIN (search_vector)'))
+
+def include_object(object, name, type_, reflected, compare_to):
+    '''
+    Alembic autogenerate filter. The search columns, indexes and FTS tables live outside the models, so without
+    it manage.py db migrate would offer to drop them
+    '''
+    if type_ == 'column' and name == 'search_vector':
+        return False
+    if type_ == 'index' and name in ('ix_posts_search_vector', 'ix_threads_search_vector'):
+        return False
+    if type_ == 'table' and name.startswith(('posts_fts', 'threads_fts')):
+        return False
+    return True
+
+def rebuild_search_index():
+    '''
+    Creates the index if it is missing and reindexes every post and thread title. Tables are never created
+    with the index, so this runs once for every new database (seed.py does it for the databases it fills) as
+    well as to backfill existing ones
+    '''
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        create_search_index(connection)
+        if connection.dialect.name == 'sqlite':
+            for statement in SQLITE_REBUILD:
+                connection.execute(text(statement))
+
+def search_index_missing(error):
+    '''
+    Whether a failed search statement failed because rebuild_search_index hasn't run on this database yet
+    Arguments
+        error -- (sqlalchemy.exc.DBAPIError) Error raised by the search statement
+    '''
+    message = str(error.orig)
+    return 'no such table: posts_fts' in message or 'no such table: threads_fts' in message or (
+        'search_vector' in message and 'does not exist' in message
+    )
+
+def match_query(q, dialect):
+    '''
+    Postgres parses raw user input with websearch_to_tsquery. FTS5 syntax errors on stray quotes and operators,
+    so for SQLite every word becomes a quoted term and all of them must match
+    '''
+    if dialect != 'sqlite':
+        return q
+    return ' '.join('"{}"'.format(word.replace('"', '""')) for word in q.split())
+
+def search_content(q, search_type='posts', forum_id=None, user_id=None, limit=20, cursor=None):
+    '''
+    Ranks posts or thread titles against q, best match first
+    Arguments
+        q -- (str) Search terms
+        search_type -- (str) 'posts' or 'threads'
+        forum_id -- (int) Only return results from this forum
+        user_id -- (str) Only return results written by this user
+        limit -- (int) Maximum number of results
+        cursor -- (str) next_cursor from the previous page
+    Returns the results and the cursor for the following page, None when there is none
+    '''
+    dialect = db.session.get_bind().dialect.name
+    source, match, score = SEARCH_SQL[dialect][search_type]
+    params = {'q': match_query(q, dialect), 'language': SEARCH_LANGUAGE, 'limit': limit + 1}
+    table = 'posts' if search_type == 'posts' else 'threads'
+    conditions = [match]
+    if forum_id is not None:
+        conditions.append('threads.forum_id = :forum_id')
+        params['forum_id'] = forum_id
+    if user_id is not None:
+        conditions.append(f'{table}.user_id = :user_id')
+        params['user_id'] = user_id
+    if cursor is not None:
+        last_score, last_id = decode_cursor(cursor)
+        conditions.append(f'({score} < :last_score OR ({score} = :last_score AND {table}.id < :last_id))')
+        params['last_score'] = float(last_score)
+        params['last_id'] = int(last_id)
+
+    if search_type == 'posts':
+        statement = f'''
+            SELECT posts.id, posts.user_id, posts.page_id, posts.content, posts.date_created, posts.date_edited,
+                   posts.thread_id, posts.seq, threads.title, threads.forum_id, users.name, {score} AS score
+            FROM {source}
+            JOIN threads ON threads.id = posts.thread_id
+            LEFT JOIN users ON users.id = posts.user_id
+            WHERE {' AND '.join(conditions)}
+            ORDER BY score DESC, posts.id DESC
+            LIMIT :limit'''
+    else:
+        statement = f'''
+            SELECT threads.id, threads.forum_id, threads.user_id, threads.title, threads.date_created,
+                   threads.page_count, threads.post_count, threads.last_post_at, threads.locked, {score} AS score
+            FROM {source}
+            WHERE {' AND '.join(conditions)}
+            ORDER BY score DESC, threads.id DESC
+            LIMIT :limit'''
+    statement = text(statement).columns(
+        **{column: db.DateTime for column in ('date_created', 'date_edited', 'last_post_at')},
+        locked=db.Boolean
+    )
+    rows = db.session.execute(statement, params).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(repr(rows[-1].score), rows[-1].id)
+    format_row = format_post_row if search_type == 'posts' else format_thread_row
+    return [format_row(row) for row in rows], next_cursor
+
+def format_post_row(row):
+    return {
+        'id': row.id,
+        'user_id': row.user_id,
+        'user_name': row.name,
+        'page_id': row.page_id,
+        'content': row.content,
+        'dateCreated': row.date_created,
+        'dateEdited': row.date_edited,
+        'threadId': row.thread_id,
+        'threadTitle': row.title,
+        'forumId': row.forum_id,
+        'page': page_for_seq(row.seq) if row.seq else None,
+        'score': row.score
+    }
+
+def format_thread_row(row):
+    return {
+        'forumId': row.forum_id,
+        'id': row.id,
+        'user_id': row.user_id,
+        'title': row.title,
+        'dateCreated': row.date_created,
+        'pages': row.page_count,
+        'postCount': row.post_count,
+        'lastPostAt': row.last_post_at,
+        'locked': row.locked,
+        'score': row.score
+    }
@@ -0,0 +1,207 @@
+import itertools
+import random
+from datetime import datetime, timedelta
+import click
+from dateutil.relativedelta import relativedelta
+
+from app import app
+from models import db, User, Forum, Thread, Page, Post, POSTS_PER_PAGE, count_pages
+from roles_and_status import ForumRoles, UserStatus
+from bulk import BATCH_SIZE, insert_rows, reset_sequences
+from cache import response_cache
+from search import rebuild_search_index
+
+
+WORDS = (
+    'the forum thread post reply page user admin moderator question answer idea problem solution build test '
+    'deploy server client request response database index query cache token login error feature release '
+    'update version change review issue support help thanks agree disagree maybe really great terrible fast '
+    'slow new old first last today yesterday tomorrow week month year game music movie book photo video link'
+).split()
+ROLE_WEIGHTS = {ForumRoles.ADMIN: 1, ForumRoles.MODERATOR: 4, ForumRoles.USER: 95}
+STATUS_WEIGHTS = {UserStatus.NORMAL: 90, UserStatus.WATCH: 4, UserStatus.PROBATION: 3, UserStatus.RESTRICTED: 2, UserStatus.BANNED: 1}
+START_DATE = datetime(2020, 1, 1)
+MAX_CONTENT = Post.__table__.c.content.type.length
+
+
+def zipf_split(rnd, total, buckets, s):
+    '''
+    Splits total items over buckets with Zipf weights (rank^-s), in a random order of ranks.
+    Every bucket gets at least one item and the shares add up to total exactly
+    '''
+    ranks = list(range(1, buckets + 1))
+    rnd.shuffle(ranks)
+    weights = [rank ** -s for rank in ranks]
+    scale = (total - buckets) / sum(weights)
+    shares = [1 + int(weight * scale) for weight in weights]
+    # Hand the rounding remainder to the largest buckets
+    for index in sorted(range(buckets), key=ranks.__getitem__)[:total - sum(shares)]:
+        shares[index] += 1
+    return shares
+
+def sentence(rnd, length):
+    '''
+    Random words until the text is about length characters
+    '''
+    words = []
+    size = 0
+    while size < length:
+        word = rnd.choice(WORDS)
+        words.append(word)
+        size += len(word) + 1
+    return ' '.join(words)[:length].strip() or rnd.choice(WORDS)
+
+def content_length(rnd):
+    '''
+    Post lengths are heavy tailed: mostly a line or two, occasionally right up to the column limit
+    '''
+    return min(MAX_CONTENT, int(rnd.paretovariate(1.2) * 40))
+
+def next_id(model):
+    return (db.session.query(db.func.max(model.id)).scalar() or 0) + 1
+
+def seed(forums, threads, posts, users, s, seed_value, batch_size):
+    '''
+    Writes a deterministic forum of the requested shape with bulk inserts. Thread and post counts are Zipf
+    distributed over forums and threads, pages and thread counters are filled in as the app would. Ends by
+    building the search index, so GET /search works on the seeded database
+    '''
+    rnd = random.Random(seed_value)
+    buffers = {table: [] for table in ('threads', 'pages', 'posts')}
+    tables = {'threads': Thread.__table__, 'pages': Page.__table__, 'posts': Post.__table__}
+
+    def flush():
+        # Parents first so foreign keys always resolve
+        for name in ('threads', 'pages', 'posts'):
+            insert_rows(tables[name], buffers[name])
+            buffers[name].clear()
+        db.session.commit()
+
+    user_ids = []
+    user_rows = []
+    for n in range(users):
+        user_id = f'seed-{seed_value}-{n}'
+        status = rnd.choices(list(STATUS_WEIGHTS), weights=list(STATUS_WEIGHTS.values()))[0]
+        row = {
+            'id': user_id,
+            'name': f'user{seed_value}_{n}'[:36],
+            'join_date': START_DATE + timedelta(minutes=rnd.randrange(60 * 24 * 365)),
+            'role': rnd.choices(list(ROLE_WEIGHTS), weights=list(ROLE_WEIGHTS.values()))[0].value,
+            'status': status.value,
+            'probation_start_date': None,
+            'probation_end_date': None,
+        }
+        if status == UserStatus.PROBATION:
+            row['probation_start_date'] = row['join_date'] + timedelta(days=rnd.randrange(365))
+            row['probation_end_date'] = row['probation_start_date'] + relativedelta(days=rnd.choice([1, 3, 7, 14, 30]))
+        user_rows.append(row)
+        user_ids.append(user_id)
+        if len(user_rows) >= batch_size:
+            insert_rows(User.__table__, user_rows)
+            user_rows = []
+    insert_rows(User.__table__, user_rows)
+    # A few prolific posters write most of the content. Cumulative weights keep each draw O(log users)
+    user_weights = list(itertools.accumulate(rank ** -s for rank in range(1, users + 1)))
+
+    forum_id = next_id(Forum)
+    thread_id = next_id(Thread)
+    page_id = next_id(Page)
+    post_id = next_id(Post)
+    forum_rows = []
+    for n in range(forums):
+        forum_rows.append({
+            'id': forum_id + n,
+            'name': f'Seed {seed_value} forum {n}'[:36],
+            'description': sentence(rnd, rnd.randrange(20, 120)),
+        })
+    insert_rows(Forum.__table__, forum_rows)
+
+    threads_per_forum = zipf_split(rnd, threads, forums, s)
+    thread_count = sum(threads_per_forum)
+    posts_per_thread = zipf_split(rnd, posts, thread_count, s)
+    thread_index = 0
+    for n, forum_threads in enumerate(threads_per_forum):
+        for _ in range(forum_threads):
+            post_total = posts_per_thread[thread_index]
+            thread_index += 1
+            created = START_DATE + timedelta(minutes=rnd.randrange(60 * 24 * 730))
+            author = rnd.choices(user_ids, cum_weights=user_weights)[0]
+            posted_at = created
+            poster = author
+            thread_row = {
+                'id': thread_id,
+                'forum_id': forum_id + n,
+                'title': sentence(rnd, rnd.randrange(10, 36)),
+                'user_id': author,
+                'date_created': created,
+                'locked': rnd.random() < 0.02,
+                'post_count': post_total,
+                'page_count': count_pages(post_total),
+                'last_post_at': None,
+                'last_poster': None,
+            }
+            buffers['threads'].append(thread_row)
+            thread_flushed = False
+            first_page_id = page_id
+            for page_number in range(1, count_pages(post_total) + 1):
+                buffers['pages'].append({'id': page_id, 'thread_id': thread_id, 'page_number': page_number})
+                page_id += 1
+            for seq in range(1, post_total + 1):
+                if seq > 1:
+                    posted_at += timedelta(seconds=rnd.randrange(1, 6 * 3600))
+                    poster = rnd.choices(user_ids, cum_weights=user_weights)[0]
+                buffers['posts'].append({
+                    'id': post_id,
+                    'user_id': poster,
+                    'page_id': first_page_id + (seq - 1) // POSTS_PER_PAGE,
+                    'thread_id': thread_id,
+                    'seq': seq,
+                    'content': sentence(rnd, content_length(rnd)),
+                    'date_created': posted_at,
+                    'date_edited': posted_at + timedelta(minutes=5) if rnd.random() < 0.05 else None,
+                })
+                post_id += 1
+                if len(buffers['posts']) >= batch_size:
+                    flush()
+                    thread_flushed = True
+            thread_row['last_post_at'] = posted_at
+            thread_row['last_poster'] = poster
+            if thread_flushed:
+                # Long threads are written before their last post is known
+                db.session.execute(
+                    db.update(Thread.__table__).where(Thread.__table__.c.id == thread_id)
+                    .values(last_post_at=posted_at, last_poster=poster)
+                )
+            thread_id += 1
+            if len(buffers['threads']) >= batch_size:
+                flush()
+    flush()
+    reset_sequences([Forum.__table__, Thread.__table__, Page.__table__, Post.__table__])
+    db.session.commit()
+    rebuild_search_index()
+    response_cache.clear()
+    return {'users': users, 'forums': forums, 'threads': thread_count, 'posts': sum(posts_per_thread)}
+
+
+@click.command()
+@click.option('--forums', default=10, show_default=True, help='Number of forums')
+@click.option('--threads', default=1000, show_default=True, help='Total threads, Zipf distributed over forums')
+@click.option('--posts', default=50000, show_default=True, help='Total posts, Zipf distributed over threads')
+@click.option('--users', default=500, show_default=True, help='Number of users')
+@click.option('--zipf', 'zipf_s', default=1.1, show_default=True, help='Zipf exponent, higher is more skewed')
+@click.option('--seed', 'seed_value', default=0, show_default=True, help='Random seed, the same seed always writes the same data')
+@click.option('--batch-size', default=BATCH_SIZE, show_default=True, help='Rows written per executemany')
+def main(forums, threads, posts, users, zipf_s, seed_value, batch_size):
+    '''
+    Seeds the DATABASE_URL database with synthetic forum data for scale testing
+    '''
+    if min(forums, users) < 1 or threads < forums or posts < threads:
+        raise click.BadParameter('need at least one forum and user, a thread per forum and a post per thread')
+    with app.app_context():
+        counts = seed(forums, threads, posts, users, zipf_s, seed_value, batch_size)
+    for table, count in counts.items():
+        click.echo(f'{table}: {count}')
+
+
+if __name__ == '__main__':
+    main()
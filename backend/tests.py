@@ -1,12 +1,34 @@
 import os
 import unittest
+from unittest import mock
 import json
 from flask_sqlalchemy import SQLAlchemy
 from functools import wraps
 import subprocess
+import tempfile
+import threading
+import time
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+from flask import Flask, g
+from sqlalchemy import create_engine, event, text
 
 from app import create_app
-from models import setup_db, Forum, Thread, Page, Post, User
+from models import (
+    db, setup_db, engine_options, probe_options, unit_of_work, ReplicaSet, Forum, Thread, Page, Post, User,
+    THREAD_ORDERS, REPLICA_PROBE_TIMEOUT, user_name_cache, violated_constraint, POSTS_PER_PAGE, count_pages
+)
+from auth import JWKSCache, TokenCache, AuthError
+from cache import ResponseCache, FORMAT_VERSION, cached_response, response_cache
+from instrumentation import RequestQueries, RouteStats, instrument_engine
+from metrics import CounterSync, MeteredQueuePool
+from json_provider import StdJSONProvider, OrjsonProvider
+import queries
+import moderation
+from search import rebuild_search_index, search_content
+import bulk
+from seed import seed as seed_forum
+from prometheus_client import REGISTRY, Counter
 
 from roles_and_status import ForumRoles, UserStatus
 
@@ -36,6 +58,23 @@ def provide_auth(mode=''):
         return wrapper
     return provides_auth_decorator
 
+class DatabaseTestCase(unittest.TestCase):
+    '''
+    Sets up an app on the TEST_URL database with the USER_ID user in it. Subclasses add their own rows in seed,
+    which runs inside the app context
+    '''
+    def setUp(self):
+        self.app = create_app(test_config=True)
+        self.client = self.app.test_client
+        with self.app.app_context():
+            setup_db(self.app, TEST_URL)
+            user = User.query.get(USER_ID) or User(id=USER_ID, name='newbie')
+            user.insert()
+            self.seed()
+
+    def seed(self):
+        pass
+
 class AppTest(unittest.TestCase):
     def setUp(self):
         self.app = create_app(test_config=True)
@@ -286,6 +325,1193 @@ class AppTest(unittest.TestCase):
         data = json.loads(res.data)
         self.assertSuccess(res, data)
 
+
+@unittest.skipUnless(TEST_URL.startswith('postgres'), 'EXPLAIN checks need the Postgres test database')
+class QueryPlanTest(DatabaseTestCase):
+    '''
+    Runs the hot routes against a seeded database, then EXPLAINs every filtered statement they sent with
+    sequential scans disabled. Postgres still picks a Seq Scan when no index can serve a query, so one
+    showing up in a plan means an index is missing.
+    '''
+    def seed(self):
+        forum = Forum(name=f'Query Plan Forum {time.time_ns()}', description='Seeded for EXPLAIN checks')
+        forum.insert()
+        thread = Thread(forum_id=forum.id, title='Query Plan Thread', user_id=USER_ID)
+        thread.insert()
+        for seq in range(1, 46):
+            page = Page.query.filter(Page.thread_id == thread.id, Page.page_number == (seq - 1) // 40 + 1).one_or_none()
+            if page is None:
+                page = Page(thread_id=thread.id, page_number=(seq - 1) // 40 + 1)
+                page.insert()
+            Post(user_id=USER_ID, thread_id=thread.id, page_id=page.id, seq=seq, content=f'Seeded post {seq}').insert()
+        thread.post_count = 45
+        thread.page_count = 2
+        thread.update()
+        self.forum_id = forum.id
+        self.thread_id = thread.id
+
+    def capture_statements(self, requests):
+        statements = []
+        def record(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().upper().startswith('SELECT') and 'WHERE' in statement.upper().split():
+                statements.append((statement, parameters))
+        with self.app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                for method, url in requests:
+                    res = getattr(self.client(), method)(url, json={'content': 'Query plan post'}, headers=self.get_token())
+                    self.assertLess(res.status_code, 500, url)
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+        return statements
+
+    def get_token(self):
+        return { 'Content-Type': 'application/json', 'Authorization': f'Bearer {USER_TOKEN}' }
+
+    def test_hot_routes_use_indexes(self):
+        statements = self.capture_statements([
+            ('get', f'/forum/{self.forum_id}'),
+            ('get', f'/threads/{self.thread_id}'),
+            ('get', f'/threads/{self.thread_id}/2'),
+            ('get', f'/threads/{self.thread_id}/posts?cursor=40'),
+            ('get', f'/threads/{self.thread_id}/posts?since=2000-01-01T00:00:00'),
+            ('post', f'/threads/{self.thread_id}'),
+        ])
+        self.assertTrue(statements)
+        with self.app.app_context():
+            cursor = db.engine.raw_connection().cursor()
+            cursor.execute('SET enable_seqscan = off')
+            for statement, parameters in statements:
+                cursor.execute('EXPLAIN ' + statement, parameters)
+                plan = '\n'.join(row[0] for row in cursor.fetchall())
+                self.assertNotIn('Seq Scan', plan, f'{statement}\n{plan}')
+            cursor.close()
+
+@unittest.skipUnless(TEST_URL.startswith('postgres'), 'Concurrent writers need the Postgres test database')
+class PageRolloverStressTest(DatabaseTestCase):
+    '''
+    Hammers one thread with replies from many threads at once and checks that sequence numbers stay dense
+    and that no page ever ends up with more than 40 posts.
+    '''
+    WRITERS = 12
+    POSTS_PER_WRITER = 25
+
+    def setUp(self):
+        super().setUp()
+        res = self.client().post(f'/forum/{self.forum_id}', json={
+            'title': 'Stress Thread',
+            'content': 'Opening post',
+        }, headers=self.get_token())
+        self.thread_id = json.loads(res.data)['thread']['id']
+
+    def seed(self):
+        forum = Forum(name=f'Stress Forum {time.time_ns()}', description='Concurrent page rollover')
+        forum.insert()
+        self.forum_id = forum.id
+
+    def get_token(self):
+        return { 'Content-Type': 'application/json', 'Authorization': f'Bearer {USER_TOKEN}' }
+
+    def test_concurrent_replies_never_overfill_a_page(self):
+        failures = []
+        def reply(writer):
+            for i in range(self.POSTS_PER_WRITER):
+                res = self.client().post(f'/threads/{self.thread_id}', json={
+                    'content': f'Writer {writer} post {i}'
+                }, headers=self.get_token())
+                if res.status_code != 200:
+                    failures.append(res.status_code)
+        writers = [threading.Thread(target=reply, args=(writer,)) for writer in range(self.WRITERS)]
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join()
+        self.assertEqual(failures, [])
+
+        expected = self.WRITERS * self.POSTS_PER_WRITER + 1
+        with self.app.app_context():
+            thread = Thread.query.get(self.thread_id)
+            seqs = sorted(seq for (seq,) in db.session.query(Post.seq).filter(Post.thread_id == self.thread_id))
+            self.assertEqual(seqs, list(range(1, expected + 1)))
+            self.assertEqual(thread.post_count, expected)
+            self.assertEqual(thread.page_count, (expected + 39) // 40)
+            page_sizes = db.session.query(Page.page_number, db.func.count(Post.id)).join(Post, Post.page_id == Page.id).filter(
+                Page.thread_id == self.thread_id
+            ).group_by(Page.page_number).all()
+            self.assertEqual(len(page_sizes), thread.page_count)
+            for page_number, size in page_sizes:
+                self.assertLessEqual(size, 40, f'page {page_number}')
+
+def write_jwks(path, *kids):
+    '''
+    Writes a jwks.json document with a freshly generated RSA key for each kid
+    Arguments
+        path -- (str) File to write
+        kids -- (str) Key ids to include
+    '''
+    keys = []
+    for kid in kids:
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(private_key.public_key()))
+        jwk.update({'kid': kid, 'use': 'sig', 'alg': 'RS256'})
+        keys.append(jwk)
+    with open(path, 'w') as f:
+        json.dump({'keys': keys}, f)
+
+class JWKSCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'jwks.json')
+        self.url = f'file://{self.path}'
+        write_jwks(self.path, 'key-1')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_fresh_keys_served_from_memory(self):
+        cache = JWKSCache(self.url, ttl=600)
+        first = cache.get_signing_key('key-1')
+        second = cache.get_signing_key('key-1')
+        self.assertIs(first, second)
+        self.assertEqual(cache.fetches, 1)
+
+    def test_unknown_kid_refetches_rotated_keys(self):
+        cache = JWKSCache(self.url, ttl=600, refresh_cooldown=0)
+        cache.get_signing_key('key-1')
+        write_jwks(self.path, 'key-1', 'key-2')
+        self.assertEqual(cache.get_signing_key('key-2').key_id, 'key-2')
+        self.assertEqual(cache.fetches, 2)
+
+    def test_unknown_kid_respects_cooldown(self):
+        cache = JWKSCache(self.url, ttl=600, refresh_cooldown=600)
+        cache.get_signing_key('key-1')
+        with self.assertRaises(AuthError) as context:
+            cache.get_signing_key('forged')
+        self.assertEqual(context.exception.status_code, 401)
+        with self.assertRaises(AuthError):
+            cache.get_signing_key('forged')
+        self.assertEqual(cache.fetches, 1)
+
+    def test_stale_keys_served_while_endpoint_down(self):
+        cache = JWKSCache(self.url, ttl=0, max_stale=600)
+        key = cache.get_signing_key('key-1')
+        os.remove(self.path)
+        self.assertIs(cache.get_signing_key('key-1'), key)
+
+    def test_failing_endpoint_is_not_refetched_on_every_request(self):
+        clock = [1000.0]
+        with mock.patch('auth.time.monotonic', lambda: clock[0]):
+            cache = JWKSCache(self.url, ttl=60, max_stale=600, refresh_cooldown=30)
+            key = cache.get_signing_key('key-1')
+            os.remove(self.path)
+            clock[0] += 61
+            with self.assertLogs('auth', 'WARNING'):
+                for _ in range(20):
+                    self.assertIs(cache.get_signing_key('key-1'), key)
+                    # Waits for the background refresh, which holds the lock while it runs
+                    with cache._lock:
+                        pass
+            self.assertRaises(AuthError, cache.get_signing_key, 'forged')
+            self.assertEqual((cache.fetches, cache.fetch_errors), (2, 1))
+            clock[0] += 30
+            cache.get_signing_key('key-1')
+            with cache._lock:
+                pass
+            self.assertEqual(cache.fetches, 3)
+            clock[0] += 600
+            for _ in range(5):
+                with self.assertRaises(AuthError) as context:
+                    cache.get_signing_key('key-1')
+                self.assertEqual(context.exception.status_code, 503)
+            self.assertEqual(cache.fetches, 4)
+
+    def test_endpoint_down_without_keys(self):
+        os.remove(self.path)
+        cache = JWKSCache(self.url)
+        with self.assertRaises(AuthError) as context:
+            cache.get_signing_key('key-1')
+        self.assertEqual(context.exception.status_code, 503)
+
+    def test_concurrent_unknown_kid_single_fetch(self):
+        class SlowJWKSCache(JWKSCache):
+            def fetch(self):
+                time.sleep(0.2)
+                return super().fetch()
+        cache = SlowJWKSCache(self.url)
+        workers = [threading.Thread(target=cache.get_signing_key, args=('key-1',)) for _ in range(10)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(cache.fetches, 1)
+
+class TokenCacheTest(unittest.TestCase):
+    def payload(self, expires_in=600):
+        return {'sub': 'auth0|abc', 'user_id': 'abc', 'admin': False, 'permissions': [], 'exp': time.time() + expires_in}
+
+    def test_hit_returns_payload(self):
+        cache = TokenCache(maxsize=10)
+        self.assertIsNone(cache.get('token'))
+        cache.put('token', self.payload())
+        self.assertEqual(cache.get('token')['user_id'], 'abc')
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_expired_entries_miss(self):
+        cache = TokenCache(maxsize=10)
+        cache.put('token', self.payload(expires_in=-1))
+        self.assertIsNone(cache.get('token'))
+
+    def test_least_recently_used_evicted(self):
+        cache = TokenCache(maxsize=2)
+        cache.put('a', self.payload())
+        cache.put('b', self.payload())
+        cache.get('a')
+        cache.put('c', self.payload())
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+
+    def test_disabled(self):
+        cache = TokenCache(maxsize=10, enabled=False)
+        cache.put('token', self.payload())
+        self.assertIsNone(cache.get('token'))
+
+class ResponseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = ResponseCache(os.path.join(self.directory.name, 'cache.sqlite3'), max_bytes=1000)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_bump_moves_versions(self):
+        self.assertEqual(self.cache.versions(['thread:1', 'forum:1']), {'thread:1': 0, 'forum:1': 0})
+        self.cache.bump('thread:1')
+        self.cache.bump('thread:1')
+        self.assertEqual(self.cache.versions(['thread:1', 'forum:1']), {'thread:1': 2, 'forum:1': 0})
+
+    def test_clear_starts_new_generation(self):
+        self.cache.bump('thread:1')
+        before = self.cache.state(['thread:1'])
+        self.cache.clear()
+        after = self.cache.state(['thread:1'])
+        self.assertNotEqual(before.generation, after.generation)
+        self.assertEqual(after.versions, {'thread:1': 0})
+        self.assertGreaterEqual(after.updated_at, before.updated_at)
+
+    def test_put_and_get(self):
+        self.assertIsNone(self.cache.get('key'))
+        self.cache.put('key', b'{}')
+        self.assertEqual(self.cache.get('key'), b'{}')
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['entries']), (1, 1, 1))
+
+    def test_eviction_bounds_size(self):
+        for i in range(20):
+            self.cache.put(f'key-{i}', b'x' * 100)
+        self.cache.evict()
+        self.assertLessEqual(self.cache.stats()['bytes'], 1000)
+        self.assertEqual(self.cache.get('key-19'), b'x' * 100)
+
+    def test_disabled(self):
+        cache = ResponseCache(self.cache.path, enabled=False)
+        cache.put('key', b'{}')
+        self.assertIsNone(cache.get('key'))
+
+    def cached_app(self, calls):
+        app = Flask(__name__)
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+
+        @app.route('/threads/<int:thread_id>')
+        @cached_response('thread:{thread_id}')
+        def view(thread_id):
+            calls.append(thread_id)
+            return {'calls': len(calls)}
+        return app
+
+    def test_conditional_requests_skip_the_view(self):
+        calls, clock = [], [1700000000.5]
+        with mock.patch('cache.response_cache', self.cache), mock.patch('cache.time.time', lambda: clock[0]):
+            client = self.cached_app(calls).test_client()
+            # Within the second of the last change there is no usable Last-Modified yet
+            self.assertIsNone(client.get('/threads/1').last_modified)
+            clock[0] += 2
+            first = client.get('/threads/1')
+            self.assertEqual((first.status_code, calls), (200, [1]))
+            etag, modified = first.headers['ETag'], first.headers['Last-Modified']
+            for headers in ({'If-None-Match': etag}, {'If-Modified-Since': modified}):
+                response = client.get('/threads/1', headers=headers)
+                self.assertEqual((response.status_code, response.get_data()), (304, b''))
+                self.assertEqual(response.headers['ETag'], etag)
+            self.assertEqual(calls, [1])
+            other_etag = client.get('/threads/2').headers['ETag']
+
+            clock[0] += 5
+            self.cache.bump('thread:1')
+            clock[0] += 2
+            for headers in ({'If-None-Match': etag}, {'If-Modified-Since': modified}):
+                self.assertEqual(client.get('/threads/1', headers=headers).status_code, 200)
+            bumped = client.get('/threads/1')
+            self.assertEqual(calls, [1, 2, 1])
+            self.assertEqual(bumped.get_json(), {'calls': 3})
+            self.assertNotEqual(bumped.headers['ETag'], etag)
+            self.assertGreater(bumped.last_modified, first.last_modified)
+            # Another thread's entry and ETag survive the bump
+            other = client.get('/threads/2')
+            self.assertEqual((other.get_json(), other.headers['ETag']), ({'calls': 2}, other_etag))
+            self.assertEqual(calls, [1, 2, 1])
+
+    def test_format_version_is_part_of_the_key(self):
+        calls = []
+        with mock.patch('cache.response_cache', self.cache):
+            client = self.cached_app(calls).test_client()
+            etag = client.get('/threads/1').headers['ETag']
+            self.assertEqual(client.get('/threads/1').headers['ETag'], etag)
+            with mock.patch('cache.FORMAT_VERSION', FORMAT_VERSION + 1):
+                response = client.get('/threads/1', headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response.headers['ETag'], etag)
+            self.assertEqual(calls, [1, 1])
+
+class InstrumentationTest(unittest.TestCase):
+    def test_counts_statements_inside_a_request(self):
+        engine, other_engine = create_engine('sqlite://'), create_engine('sqlite://')
+        instrument_engine(engine)
+        instrument_engine(engine)
+        with Flask(__name__).test_request_context():
+            g.sql_queries = RequestQueries()
+            with engine.connect() as connection:
+                connection.execute(text('SELECT 1'))
+                connection.execute(text('SELECT 2'))
+            with other_engine.connect() as connection:
+                connection.execute(text('SELECT 4'))
+            queries = g.sql_queries
+        with engine.connect() as connection:
+            connection.execute(text('SELECT 3'))
+        self.assertEqual(queries.count, 2)
+        self.assertIn('SELECT', queries.slowest)
+        self.assertIn('desc="2 queries"', queries.server_timing(0.01))
+        self.assertNotIn('SELECT', queries.server_timing(0.01))
+
+    def test_route_stats_aggregate(self):
+        stats = RouteStats()
+        for count in (2, 4):
+            queries = RequestQueries()
+            for _ in range(count):
+                queries.record('SELECT 1', 0.001)
+            stats.add('get_thread_page', queries, 0.01)
+        route = stats.snapshot()['get_thread_page']
+        self.assertEqual((route['requests'], route['queries'], route['max_queries']), (2, 6, 4))
+        self.assertEqual(route['queries_per_request'], 3)
+
+
+class MetricsTest(unittest.TestCase):
+    def test_counter_sync_adds_deltas(self):
+        counter = Counter('forum_test_synced_total', 'Test counter')
+        source = {'value': 0}
+        sync = CounterSync([(counter, lambda: source['value'])])
+        for value in (3, 5, 2):
+            source['value'] = value
+            sync.sync()
+        # 3, then 2 more, then a reset to 2
+        self.assertEqual(REGISTRY.get_sample_value('forum_test_synced_total'), 7)
+
+    def test_pool_reports_checkouts(self):
+        primary, replica = {'pool': 'primary'}, {'pool': 'replica-0'}
+        before = REGISTRY.get_sample_value('forum_db_pool_checkout_wait_seconds_count', primary) or 0
+        with tempfile.TemporaryDirectory() as directory:
+            engine = create_engine(f'sqlite:///{directory}/pool.db', poolclass=MeteredQueuePool, pool_size=2)
+            replica_engine = create_engine(f'sqlite:///{directory}/replica.db', poolclass=MeteredQueuePool.labelled('replica-0'), pool_size=2)
+            with engine.connect() as connection, replica_engine.connect() as replica_connection:
+                connection.execute(text('SELECT 1'))
+                self.assertEqual(REGISTRY.get_sample_value('forum_db_pool_checked_out', primary), 1)
+                self.assertEqual(REGISTRY.get_sample_value('forum_db_pool_checked_out', replica), 1)
+            engine.dispose()
+            replica_engine.dispose()
+        self.assertEqual(REGISTRY.get_sample_value('forum_db_pool_checkout_wait_seconds_count', primary), before + 1)
+        self.assertEqual(REGISTRY.get_sample_value('forum_db_pool_checked_out', primary), 0)
+        self.assertEqual(engine_options('postgresql://localhost/forum', 'replica-1')['poolclass'].pool_label, 'replica-1')
+
+
+class EngineOptionsTest(unittest.TestCase):
+    @mock.patch.multiple('models', GUNICORN_THREADS=8, WEB_CONCURRENCY=4, DB_MAX_CONNECTIONS=20)
+    def test_pool_fits_connection_budget(self):
+        options = engine_options('postgresql://localhost/forum')
+        self.assertEqual((options['pool_size'], options['max_overflow']), (5, 0))
+
+    @mock.patch.multiple('models', DB_PGBOUNCER=True, DB_STATEMENT_TIMEOUT=5000)
+    def test_pgbouncer_profile_sets_nothing_per_session(self):
+        self.assertNotIn('options', engine_options('postgresql://localhost/forum')['connect_args'])
+        self.assertEqual(engine_options('postgresql+psycopg://localhost/forum')['connect_args']['prepare_threshold'], None)
+
+    def test_in_memory_sqlite_keeps_its_pool(self):
+        self.assertEqual(engine_options('sqlite://'), {})
+
+
+class ReplicaSetTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.replicas = ReplicaSet(retry_seconds=60, check_interval=60)
+
+    def tearDown(self):
+        self.replicas.configure([])
+        self.directory.cleanup()
+
+    def test_chooses_healthy_replica(self):
+        self.replicas.configure([f'sqlite:///{self.directory.name}/replica.db'])
+        self.assertIs(self.replicas.choose(), self.replicas.engines[0])
+
+    def test_unreachable_replica_falls_back_to_primary(self):
+        self.replicas.configure([f'sqlite:///{self.directory.name}/missing/replica.db'])
+        self.assertIsNone(self.replicas.choose())
+        self.assertFalse(self.replicas.is_healthy(self.replicas.engines[0]))
+
+    def test_checks_connect_with_the_probe_timeout(self):
+        self.assertEqual(probe_options('postgresql://replica/forum')['connect_args'], {'connect_timeout': REPLICA_PROBE_TIMEOUT})
+        self.replicas.configure([f'sqlite:///{self.directory.name}/replica.db'])
+        engine = self.replicas.engines[0]
+        self.assertTrue(self.replicas.check(engine))
+        # The check leaves the replica's own pool alone
+        self.assertEqual(engine.pool.checkedin(), 0)
+
+    def test_marked_down_replica_is_skipped_until_retry(self):
+        self.replicas.configure([f'sqlite:///{self.directory.name}/a.db', f'sqlite:///{self.directory.name}/b.db'])
+        first, second = self.replicas.engines
+        self.replicas.choose()
+        self.replicas.mark_down(first)
+        self.assertEqual({self.replicas.choose() for _ in range(10)}, {second})
+
+
+class JSONProviderTest(unittest.TestCase):
+    def test_providers_agree_on_iso_dates(self):
+        from datetime import date, datetime, timezone, timedelta
+        app = Flask(__name__)
+        payload = {
+            'naive': datetime(2024, 1, 2, 3, 4, 5),
+            'micro': datetime(2024, 1, 2, 3, 4, 5, 60),
+            'aware': datetime(2024, 1, 2, 3, 4, 5, tzinfo=timezone(timedelta(hours=2))),
+            'day': date(2024, 1, 2),
+            'empty': None,
+            'posts': [{'id': 1, 'content': 'caf\u00e9 "quoted"'}],
+        }
+        std = StdJSONProvider(app).response(payload).get_data()
+        fast = OrjsonProvider(app).response(payload).get_data()
+        self.assertEqual(std, fast)
+        self.assertEqual(json.loads(std)['naive'], '2024-01-02T03:04:05+00:00')
+        self.assertEqual(json.loads(std)['aware'], '2024-01-02T03:04:05+02:00')
+
+
+class QueriesParityTest(DatabaseTestCase):
+    '''
+    The column projections in queries.py must give exactly what the models' format() methods give
+    '''
+    def seed(self):
+        forum = Forum(name=f'Parity Forum {time.time_ns()}', description='Projection parity')
+        forum.insert()
+        user = User.query.get(USER_ID)
+        user.set_probation('1 DAY')
+        user.update()
+        thread_ids = []
+        for t in range(3):
+            thread = Thread(forum_id=forum.id, title=f'Parity Thread {t}', user_id=USER_ID)
+            thread.insert()
+            # Set by the opening post in the app. The last thread keeps NULL, as one written by bulk SQL would
+            if t < 2:
+                thread.last_post_at = thread.date_created
+                thread.update()
+            thread_ids.append(thread.id)
+        for seq in range(1, 43):
+            page_id = Page.ensure(thread_ids[0], (seq - 1) // 40 + 1)
+            Post(user_id=USER_ID, thread_id=thread_ids[0], page_id=page_id, seq=seq, content=f'Parity post {seq}').insert()
+        thread = Thread.query.get(thread_ids[0])
+        thread.post_count = 42
+        thread.page_count = 2
+        thread.last_poster = USER_ID
+        thread.update()
+        self.forum_id = forum.id
+        self.thread_id = thread_ids[0]
+
+    def test_projections_match_format(self):
+        with self.app.app_context():
+            self.assertEqual(queries.list_forums(), [forum.format() for forum in Forum.query.all()])
+            self.assertEqual(queries.get_forum(self.forum_id), Forum.query.get(self.forum_id).format())
+            self.assertIsNone(queries.get_forum(-1))
+            self.assertEqual(queries.list_users(), [user.format() for user in User.query.order_by(User.id).all()])
+            for order, column in THREAD_ORDERS.items():
+                expected = Thread.query.filter(Thread.forum_id == self.forum_id).order_by(column.desc(), Thread.id.desc()).all()
+                projected, cursor = [], None
+                while True:
+                    threads, cursor = queries.list_forum_threads(self.forum_id, order, 1, cursor)
+                    projected.extend(threads)
+                    if cursor is None:
+                        break
+                self.assertEqual(projected, [thread.format() for thread in expected])
+            thread = Thread.query.get(self.thread_id)
+            for page_number in (1, 2):
+                self.assertEqual(
+                    json.dumps(queries.get_thread_page(self.thread_id, page_number), default=str),
+                    json.dumps(thread.get_page_posts(page_number), default=str)
+                )
+            self.assertRaises(IndexError, queries.get_thread_page, self.thread_id, 3)
+            self.assertRaises(LookupError, queries.get_thread_page, -1, 1)
+
+
+class UserListingTest(DatabaseTestCase):
+    def seed(self):
+        self.prefix = f'lst{time.time_ns() % 10**9}'
+        for n in range(7):
+            User(
+                id=f'auth0|{self.prefix}-{n}', name=f'{self.prefix}_{n}' if n % 2 else f'{self.prefix.upper()}x{n}',
+                role='MODERATOR' if n < 3 else 'USER', status='WATCH' if n % 3 == 0 else 'NORMAL'
+            ).insert()
+
+    def test_pages_cover_filtered_users_once(self):
+        with self.app.app_context():
+            expected = queries.list_users(name_prefix=self.prefix)
+            self.assertEqual(len(expected), 7)
+            seen, cursor = [], None
+            while True:
+                users, cursor = queries.page_users(2, name_prefix=self.prefix, cursor=cursor)
+                seen.extend(users)
+                if cursor is None:
+                    break
+            self.assertEqual(seen, expected)
+            self.assertEqual([user['id'] for user in seen], sorted(user['id'] for user in seen))
+
+    def test_filters(self):
+        with self.app.app_context():
+            moderators = queries.list_users(role='MODERATOR', name_prefix=self.prefix)
+            self.assertEqual(len(moderators), 3)
+            watched = queries.list_users(role='USER', status='WATCH', name_prefix=self.prefix.upper())
+            # Names match their prefix whatever the case
+            self.assertEqual([user['id'] for user in watched], [f'auth0|{self.prefix}-3', f'auth0|{self.prefix}-6'])
+            # _ is matched literally, not as a LIKE wildcard
+            self.assertEqual(len(queries.list_users(name_prefix=f'{self.prefix}_')), 3)
+            self.assertRaises(ValueError, queries.page_users, 10, cursor='not a cursor')
+
+    def test_stream_matches_list(self):
+        with self.app.app_context():
+            streamed = [user for batch in queries.stream_users(3, name_prefix=self.prefix) for user in batch]
+            self.assertEqual(streamed, queries.list_users(name_prefix=self.prefix))
+
+
+class BulkModerationTest(DatabaseTestCase):
+    def seed(self):
+        from datetime import datetime
+        self.spammer = f'auth0|spam{time.time_ns()}'
+        User(id=self.spammer, name='spammer').insert()
+        self.forum_ids, self.thread_ids = [], []
+        for f in range(2):
+            forum = Forum(name=f'Moderation {self.spammer[-8:]} {f}', description='Bulk moderation')
+            forum.insert()
+            self.forum_ids.append(forum.id)
+            for t in range(2):
+                thread = Thread(forum_id=forum.id, title=f'Spam target {t}', user_id=USER_ID)
+                thread.insert()
+                self.thread_ids.append(thread.id)
+                page_id = Page.ensure(thread.id, 1)
+                for seq in range(1, 6):
+                    author = self.spammer if seq % 2 else USER_ID
+                    Post(user_id=author, thread_id=thread.id, page_id=page_id, seq=seq, content=f'Post {seq}',
+                         date_created=datetime(2024, 1, seq)).insert()
+
+    def spam(self, **filters):
+        return Post.query.filter(Post.user_id == self.spammer, *[getattr(Post, k) == v for k, v in filters.items()])
+
+    def test_deletes_a_users_history_in_chunks(self):
+        with self.app.app_context():
+            with unit_of_work():
+                deleted, thread_ids = moderation.delete_posts(chunk_size=5, user_id=self.spammer)
+            self.assertEqual(deleted, 12)
+            self.assertEqual(thread_ids, set(self.thread_ids))
+            self.assertEqual({post.content for post in self.spam()}, {'This post has been deleted.'})
+            self.assertTrue(all(post.date_edited for post in self.spam()))
+            self.assertEqual(Post.query.filter(Post.thread_id.in_(self.thread_ids), Post.user_id == USER_ID, Post.content == 'This post has been deleted.').count(), 0)
+            # Already deleted posts are not touched again
+            self.assertEqual(moderation.delete_posts(user_id=self.spammer)[0], 0)
+
+    def test_scopes_to_forum_and_dates(self):
+        from datetime import datetime
+        with self.app.app_context():
+            with unit_of_work():
+                edited, thread_ids = moderation.edit_posts(
+                    'Removed', chunk_size=2, user_id=self.spammer, forum_id=self.forum_ids[0],
+                    since=datetime(2024, 1, 2), until=datetime(2024, 1, 5)
+                )
+            # Only seq 3 is by the spammer inside the date range, in each of the forum's two threads
+            self.assertEqual(edited, 2)
+            self.assertEqual(thread_ids, set(self.thread_ids[:2]))
+            self.assertEqual(self.spam(content='Removed').count(), 2)
+
+    def test_post_ids(self):
+        with self.app.app_context():
+            post_ids = [post.id for post in Post.query.filter(Post.thread_id == self.thread_ids[3])]
+            with unit_of_work():
+                deleted, thread_ids = moderation.delete_posts(chunk_size=2, post_ids=post_ids + post_ids)
+            self.assertEqual((deleted, thread_ids), (5, {self.thread_ids[3]}))
+            self.assertRaises(ValueError, moderation.delete_posts, forum_id=self.forum_ids[0])
+            self.assertRaises(ValueError, moderation.filters_from_json, {'post_ids': ['1']})
+            self.assertEqual(
+                moderation.filters_from_json({'user_id': 'x', 'since': '2024-01-02T01:00:00+01:00'})['since'].isoformat(),
+                '2024-01-02T00:00:00'
+            )
+
+
+class ThreadModerationTest(DatabaseTestCase):
+    def seed(self):
+        from datetime import datetime, timedelta
+        self.forum_ids = []
+        for f in range(2):
+            forum = Forum(name=f'Threads {time.time_ns()} {f}', description='Thread moderation')
+            forum.insert()
+            self.forum_ids.append(forum.id)
+        # Two threads whose posts interleave in time: 50 and 35 posts, so the merge spans three pages
+        self.thread_ids = []
+        started = datetime(2024, 1, 1)
+        for t, (count, offset) in enumerate(((50, 0), (35, 1))):
+            thread = Thread(forum_id=self.forum_ids[t], title=f'Merge {t}', user_id=USER_ID, date_created=started)
+            thread.insert()
+            for seq in range(1, count + 1):
+                page_id = Page.ensure(thread.id, (seq - 1) // 40 + 1)
+                Post(user_id=USER_ID, thread_id=thread.id, page_id=page_id, seq=seq, content=f'{t}:{seq}',
+                     date_created=started + timedelta(minutes=2 * seq + offset)).insert()
+            thread.post_count = count
+            thread.page_count = (count + 39) // 40
+            thread.update()
+            self.thread_ids.append(thread.id)
+
+    def test_merge_renumbers_posts_and_pages(self):
+        source_id, target_id = self.thread_ids[1], self.thread_ids[0]
+        with self.app.app_context():
+            with unit_of_work():
+                forums = moderation.merge_threads(source_id, target_id)
+            self.assertEqual(forums, {target_id: self.forum_ids[0], source_id: self.forum_ids[1]})
+            self.assertIsNone(Thread.query.get(source_id))
+            self.assertEqual(Page.query.filter(Page.thread_id == source_id).count(), 0)
+            posts = Post.query.filter(Post.thread_id == target_id).order_by(Post.seq).all()
+            self.assertEqual([post.seq for post in posts], list(range(1, 86)))
+            dates = [post.date_created for post in posts]
+            self.assertEqual(dates, sorted(dates))
+            pages = {page.id: page.page_number for page in Page.query.filter(Page.thread_id == target_id)}
+            self.assertEqual(sorted(pages.values()), [1, 2, 3])
+            for post in posts:
+                self.assertEqual(pages[post.page_id], (post.seq - 1) // 40 + 1)
+            thread = Thread.query.get(target_id)
+            self.assertEqual((thread.post_count, thread.page_count), (85, 3))
+            self.assertEqual(thread.last_post_at, posts[-1].date_created)
+            self.assertEqual(queries.get_thread_page(target_id, 3)['posts'][-1]['id'], posts[-1].id)
+            self.assertRaises(ValueError, moderation.merge_threads, target_id, target_id)
+            self.assertRaises(LookupError, moderation.merge_threads, source_id, target_id)
+
+    def test_lock_and_move(self):
+        with self.app.app_context():
+            with unit_of_work():
+                locked = moderation.set_threads_locked(self.thread_ids + [-1], True)
+            self.assertEqual(locked, dict(zip(self.thread_ids, self.forum_ids)))
+            self.assertTrue(all(Thread.query.get(thread_id).locked for thread_id in self.thread_ids))
+            with unit_of_work():
+                moved_from = moderation.move_threads(self.thread_ids, self.forum_ids[1])
+            self.assertEqual(moved_from, dict(zip(self.thread_ids, self.forum_ids)))
+            db.session.expire_all()
+            self.assertEqual({Thread.query.get(thread_id).forum_id for thread_id in self.thread_ids}, {self.forum_ids[1]})
+            self.assertRaises(LookupError, moderation.move_threads, self.thread_ids, -1)
+
+    def call(self, path, body, admin):
+        payload = {'user_id': USER_ID, 'admin': admin, 'permissions': ['post:post']}
+        with mock.patch('auth.verify_decode_jwt', return_value=payload):
+            return self.client().post(path, json=body, headers={'Authorization': 'Bearer token'})
+
+    def post_count(self, thread_id):
+        with self.app.app_context():
+            return Post.query.filter(Post.thread_id == thread_id).count()
+
+    def test_locked_thread_only_takes_admin_posts(self):
+        thread_id = self.thread_ids[0]
+        self.assertEqual(self.call('/admin/threads/lock', {'thread_ids': [thread_id]}, admin=True).status_code, 200)
+        res = self.call(f'/threads/{thread_id}', {'content': 'Sneaking in a reply'}, admin=False)
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(json.loads(res.data)['message'], 'This thread is locked.')
+        self.assertEqual(self.post_count(thread_id), 50)
+        res = self.call(f'/threads/{thread_id}', {'content': 'Closing the thread'}, admin=True)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(self.post_count(thread_id), 51)
+
+    def test_thread_routes_reject_bad_input(self):
+        source_id, target_id = self.thread_ids
+        cases = (
+            ('/admin/threads/lock', {'thread_ids': 'all'}, 400),
+            ('/admin/threads/move', {'thread_ids': [source_id]}, 400),
+            ('/admin/threads/move', {'thread_ids': [source_id], 'forum_id': -1}, 404),
+            ('/admin/threads/merge', {'source_id': source_id}, 400),
+            ('/admin/threads/merge', {'source_id': source_id, 'target_id': source_id}, 400),
+            ('/admin/threads/merge', {'source_id': source_id, 'target_id': -1}, 404),
+        )
+        for path, body, status in cases:
+            with self.subTest(path=path, body=body):
+                self.assertEqual(self.call(path, body, admin=True).status_code, status)
+        self.assertEqual((self.post_count(source_id), self.post_count(target_id)), (50, 35))
+
+
+class PostsSinceTest(DatabaseTestCase):
+    def seed(self):
+        from datetime import datetime, timedelta
+        forum = Forum(name=f'Polling {time.time_ns()}', description='New replies')
+        forum.insert()
+        thread = Thread(forum_id=forum.id, title='Polled thread', user_id=USER_ID)
+        thread.insert()
+        # One post a minute from midnight, the last two at the same time
+        self.post_ids = []
+        for seq in range(1, 46):
+            post = Post(user_id=USER_ID, thread_id=thread.id, page_id=Page.ensure(thread.id, (seq - 1) // 40 + 1),
+                        seq=seq, content=f'Reply {seq}', date_created=datetime(2024, 1, 1) + timedelta(minutes=min(seq, 44)))
+            post.insert()
+            self.post_ids.append(post.id)
+        thread.post_count = 45
+        thread.page_count = 2
+        thread.update()
+        self.thread_id = thread.id
+
+    def get_posts(self, query=''):
+        res = self.app.test_client().get(f'/threads/{self.thread_id}/posts{query}')
+        return res.status_code, json.loads(res.data)
+
+    def test_cursor_walks_every_post_once(self):
+        seqs, cursor = [], None
+        while True:
+            status, data = self.get_posts(f'?limit=20&cursor={cursor}' if cursor else '?limit=20')
+            self.assertEqual(status, 200)
+            self.assertEqual(data['next_cursor'], str(data['posts'][-1]['seq']))
+            seqs.extend(post['seq'] for post in data['posts'])
+            cursor = data['next_cursor']
+            if not data['has_more']:
+                break
+        self.assertEqual(seqs, list(range(1, 46)))
+        self.assertEqual([post['id'] for post in data['posts']], self.post_ids[40:])
+        self.assertIn('user_name', data['posts'][0])
+        status, data = self.get_posts(f'?cursor={cursor}')
+        self.assertEqual((data['posts'], data['next_cursor'], data['has_more']), ([], '45', False))
+
+    def test_after_and_since(self):
+        status, data = self.get_posts(f'?after={self.post_ids[9]}&limit=5')
+        self.assertEqual([post['seq'] for post in data['posts']], [11, 12, 13, 14, 15])
+        self.assertTrue(data['has_more'])
+        status, data = self.get_posts('?since=2024-01-01T00:10:00')
+        self.assertEqual(data['posts'][0]['seq'], 11)
+        status, data = self.get_posts('?since=2024-01-01T01:10:30%2B01:00')
+        self.assertEqual(data['posts'][0]['seq'], 11)
+        status, data = self.get_posts('?since=2024-01-01T00:44:00')
+        self.assertEqual((data['posts'], data['next_cursor']), ([], '45'))
+        status, data = self.get_posts('?since=2023-12-31T00:00:00&limit=1')
+        self.assertEqual(([post['seq'] for post in data['posts']], data['next_cursor']), ([1], '1'))
+
+    def test_limit_is_clamped(self):
+        status, data = self.get_posts('?limit=1000')
+        self.assertEqual((len(data['posts']), data['has_more']), (45, False))
+        status, data = self.get_posts('?limit=0')
+        self.assertEqual((len(data['posts']), data['has_more']), (1, True))
+
+    def test_invalid_input(self):
+        for query in ('?cursor=last', '?after=first', '?since=yesterday', '?limit=many'):
+            self.assertEqual(self.get_posts(query)[0], 400, query)
+        self.assertEqual(self.get_posts('?after=-1')[0], 404)
+        self.assertEqual(self.app.test_client().get('/threads/-1/posts').status_code, 404)
+
+
+class ForumConstraintTest(DatabaseTestCase):
+    def test_only_duplicate_names_map_to_the_name_constraint(self):
+        from sqlalchemy.exc import IntegrityError
+        name = f'Unique {time.time_ns()}'
+        with self.app.app_context():
+            Forum(name=name, description='First').insert()
+            with self.assertRaises(IntegrityError) as duplicate:
+                Forum(name=name, description='Second').insert()
+            db.session.rollback()
+            self.assertEqual(violated_constraint(duplicate.exception, Forum.__table__), 'uq_forums_name')
+            with self.assertRaises(IntegrityError) as missing:
+                Forum(name=f'{name} without description', description=None).insert()
+            db.session.rollback()
+            self.assertIsNone(violated_constraint(missing.exception, Forum.__table__))
+
+
+class SearchTest(DatabaseTestCase):
+    def seed(self):
+        rebuild_search_index()
+        # A word no other test writes, so earlier runs' rows can't match
+        self.word = f'sourdough{time.time_ns()}'
+        self.author = f'auth0|baker{time.time_ns()}'
+        User(id=self.author, name='baker').insert()
+        self.forum_ids, self.thread_ids, self.post_ids = [], [], {}
+        titles = ((f'{self.word} starter tips', USER_ID), ('Kayak routes', self.author), (f'More {self.word}', self.author))
+        for t, (title, user_id) in enumerate(titles):
+            if t < 2:
+                forum = Forum(name=f'Search {self.word[-9:]} {t}', description='Full text search')
+                forum.insert()
+                self.forum_ids.append(forum.id)
+            thread = Thread(forum_id=self.forum_ids[min(t, 1)], title=title, user_id=user_id)
+            thread.insert()
+            self.thread_ids.append(thread.id)
+        posts = (
+            ('best', 0, USER_ID, f'{self.word} {self.word} {self.word} starter'),
+            ('good', 0, USER_ID, f'my {self.word} failed after a long day at the bakery'),
+            ('none', 0, USER_ID, 'unrelated bread talk'),
+            ('kayak', 1, self.author, f'{self.word} on a kayak trip'),
+        )
+        for seq, (name, t, user_id, content) in enumerate(posts, start=1):
+            post = Post(user_id=user_id, thread_id=self.thread_ids[t], page_id=Page.ensure(self.thread_ids[t], 1),
+                        seq=seq, content=content)
+            post.insert()
+            self.post_ids[name] = post.id
+
+    def search(self, query):
+        res = self.app.test_client().get(f'/search?q={self.word}&{query}')
+        return res.status_code, json.loads(res.data)
+
+    def test_database_without_the_index_answers_503(self):
+        with tempfile.TemporaryDirectory() as directory:
+            target = create_app(test_config=True)
+            with target.app_context():
+                setup_db(target, f'sqlite:///{directory}/unindexed.db')
+            res = target.test_client().get(f'/search?q={self.word}')
+        self.assertEqual(res.status_code, 503)
+        self.assertIn('search index', json.loads(res.data)['message'])
+
+    def test_ranks_best_match_first(self):
+        status, data = self.search('')
+        self.assertEqual(status, 200)
+        ids = [result['id'] for result in data['results']]
+        self.assertEqual(ids[0], self.post_ids['best'])
+        self.assertEqual(set(ids), {self.post_ids[name] for name in ('best', 'good', 'kayak')})
+        scores = [result['score'] for result in data['results']]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+        self.assertEqual(data['results'][0]['threadId'], self.thread_ids[0])
+        self.assertIsNone(data['next_cursor'])
+
+    def test_thread_titles(self):
+        status, data = self.search('type=threads')
+        self.assertEqual({result['id'] for result in data['results']}, {self.thread_ids[0], self.thread_ids[2]})
+        status, data = self.search(f'type=threads&forum_id={self.forum_ids[1]}')
+        self.assertEqual([result['id'] for result in data['results']], [self.thread_ids[2]])
+
+    def test_forum_and_author_filters(self):
+        status, data = self.search(f'forum_id={self.forum_ids[0]}')
+        self.assertEqual({result['id'] for result in data['results']}, {self.post_ids['best'], self.post_ids['good']})
+        status, data = self.search(f'user_id={self.author}')
+        self.assertEqual([result['id'] for result in data['results']], [self.post_ids['kayak']])
+        status, data = self.search(f'user_id={self.author}&forum_id={self.forum_ids[0]}')
+        self.assertEqual(data['results'], [])
+
+    def test_cursor_pages_have_no_gaps_or_duplicates(self):
+        with self.app.app_context():
+            # Identical posts score the same, so their order rests on the id tie break
+            for seq in range(5, 30):
+                Post(user_id=USER_ID, thread_id=self.thread_ids[0], page_id=Page.ensure(self.thread_ids[0], 1), seq=seq,
+                     content=f'{self.word} again' if seq % 3 else f'{self.word} {self.word} twice').insert()
+        status, data = self.search('limit=100')
+        expected = [result['id'] for result in data['results']]
+        self.assertEqual(len(expected), 28)
+        ids, cursor = [], None
+        while True:
+            status, data = self.search(f'limit=4&cursor={cursor}' if cursor else 'limit=4')
+            self.assertEqual(status, 200)
+            ids.extend(result['id'] for result in data['results'])
+            cursor = data['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(ids, expected)
+
+    def test_index_follows_edits_and_deletes(self):
+        with self.app.app_context():
+            Post.query.get(self.post_ids['good']).content = 'rewritten without the word'
+            Post.query.get(self.post_ids['none']).content = f'now about {self.word}'
+            db.session.commit()
+            Post.query.get(self.post_ids['kayak']).delete()
+            Thread.query.get(self.thread_ids[2]).title = 'Renamed'
+            db.session.commit()
+            db.session.delete(Post.query.get(self.post_ids['best']))
+            db.session.commit()
+        status, data = self.search('')
+        self.assertEqual([result['id'] for result in data['results']], [self.post_ids['none']])
+        status, data = self.search('type=threads')
+        self.assertEqual([result['id'] for result in data['results']], [self.thread_ids[0]])
+
+    def test_invalid_input(self):
+        client = self.app.test_client()
+        self.assertEqual(client.get('/search').status_code, 400)
+        self.assertEqual(client.get('/search?q=bread&type=users').status_code, 400)
+        self.assertEqual(self.search('cursor=garbage')[0], 400)
+        self.assertEqual(self.search('forum_id=first')[0], 400)
+
+
+class UnitOfWorkTest(DatabaseTestCase):
+    PAYLOAD = {'user_id': USER_ID, 'admin': False, 'permissions': ['post:thread']}
+
+    def seed(self):
+        forum = Forum(name=f'Unit of work {time.time_ns()}', description='Single commit writes')
+        forum.insert()
+        self.forum_id = forum.id
+
+    def create_thread(self, title, content):
+        commits = []
+
+        def count_commit(conn):
+            commits.append(conn)
+        with self.app.app_context():
+            event.listen(db.engine, 'commit', count_commit)
+        try:
+            with mock.patch('auth.verify_decode_jwt', return_value=dict(self.PAYLOAD)):
+                res = self.client().post(f'/forum/{self.forum_id}', json={'title': title, 'content': content},
+                                         headers={'Authorization': 'Bearer token'})
+        finally:
+            with self.app.app_context():
+                event.remove(db.engine, 'commit', count_commit)
+        return res, len(commits)
+
+    def test_create_thread_commits_once(self):
+        res, commits = self.create_thread('One commit thread', 'The opening post of the thread')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(commits, 1)
+        with self.app.app_context():
+            thread = Thread.query.get(json.loads(res.data)['thread']['id'])
+            self.assertEqual((thread.post_count, thread.page_count, thread.last_poster), (1, 1, USER_ID))
+            post = Post.query.filter(Post.thread_id == thread.id).one()
+            self.assertEqual((post.seq, Page.query.get(post.page_id).page_number), (1, 1))
+
+    def test_failed_post_rolls_back_the_thread(self):
+        self.app.config['PROPAGATE_EXCEPTIONS'] = False
+        # The posts.content NOT NULL constraint fails after the thread row was flushed
+        res, commits = self.create_thread('Rolled back thread', None)
+        self.assertEqual(res.status_code, 500)
+        self.assertEqual(commits, 0)
+        with self.app.app_context():
+            self.assertEqual(Thread.query.filter(Thread.forum_id == self.forum_id).count(), 0)
+            self.assertEqual(Post.query.filter(Post.content.is_(None)).count(), 0)
+
+
+class MaintenanceCommandsTest(DatabaseTestCase):
+    def seed(self):
+        from datetime import datetime, timedelta
+        forum = Forum(name=f'Maintenance {time.time_ns()}', description='Backfills and repairs')
+        forum.insert()
+        other = User(id=f'auth0|legacy{time.time_ns()}', name='legacy')
+        other.insert()
+        started = datetime(2024, 1, 1)
+        thread = Thread(forum_id=forum.id, title='Legacy thread', user_id=USER_ID, date_created=started)
+        thread.insert()
+        # Pre-seq layout: 40 posts on page 1 and 5 on page 2, created out of order within each page
+        pages = [Page(thread_id=thread.id, page_number=n) for n in (1, 2)]
+        for page in pages:
+            page.insert()
+        self.old_order = []
+        for n in range(45):
+            minutes = 45 - n if n < 40 else 100 + n
+            post = Post(user_id=USER_ID if n % 2 else other.id, thread_id=None if n == 3 else thread.id, page_id=pages[n // 40].id,
+                        content=f'Legacy post {n}', date_created=started + timedelta(minutes=minutes))
+            post.insert()
+            self.old_order.append((n // 40, post.date_created, post.id))
+        self.old_order = [post_id for _, _, post_id in sorted(self.old_order)]
+        empty = Thread(forum_id=forum.id, title='Empty thread', user_id=USER_ID, date_created=started)
+        empty.insert()
+        for corrupted in (thread, empty):
+            corrupted.post_count, corrupted.page_count, corrupted.last_post_at = 7, 9, None
+            corrupted.update()
+        self.thread_id, self.empty_id = thread.id, empty.id
+
+    def run_command(self, name):
+        from manage import manager
+        result = self.app.test_cli_runner().invoke(manager, [name])
+        self.assertEqual(result.exit_code, 0, result.output)
+        return result.output
+
+    def test_backfill_post_seq_numbers_posts_densely_in_page_order(self):
+        self.assertIn('backfilled', self.run_command('backfill-post-seq'))
+        with self.app.app_context():
+            posts = Post.query.join(Page, Page.id == Post.page_id).filter(Page.thread_id == self.thread_id).order_by(Post.seq).all()
+            self.assertEqual([post.seq for post in posts], list(range(1, 46)))
+            self.assertTrue(all(post.thread_id == self.thread_id for post in posts))
+            self.assertEqual([post.id for post in posts], self.old_order)
+            for post in posts:
+                self.assertEqual(Page.query.get(post.page_id).page_number, (post.seq - 1) // 40 + 1)
+            thread = Thread.query.get(self.thread_id)
+            self.assertEqual((thread.post_count, thread.page_count), (45, 2))
+            self.assertEqual((thread.last_post_at, thread.last_poster), (max(post.date_created for post in posts), posts[-1].user_id))
+
+    def test_repair_thread_counters(self):
+        self.run_command('backfill-post-seq')
+        with self.app.app_context():
+            for thread_id in (self.thread_id, self.empty_id):
+                thread = Thread.query.get(thread_id)
+                thread.post_count, thread.page_count, thread.last_post_at, thread.last_poster = 3, 1, None, None
+                thread.update()
+        self.assertIn('repaired', self.run_command('repair-thread-counters'))
+        with self.app.app_context():
+            thread = Thread.query.get(self.thread_id)
+            last = Post.query.filter(Post.thread_id == self.thread_id, Post.seq == 45).one()
+            self.assertEqual((thread.post_count, thread.page_count, thread.last_poster), (45, 2, last.user_id))
+            self.assertEqual(thread.last_post_at, last.date_created)
+            empty = Thread.query.get(self.empty_id)
+            self.assertEqual((empty.post_count, empty.page_count, empty.last_poster), (0, 0, None))
+            self.assertEqual(empty.last_post_at, empty.date_created)
+
+
+class ThreadPageStatementsTest(DatabaseTestCase):
+    def seed(self):
+        forum = Forum(name=f'Authors {time.time_ns()}', description='One author per post')
+        forum.insert()
+        thread = Thread(forum_id=forum.id, title='Many authors', user_id=USER_ID)
+        thread.insert()
+        prefix = f'auth0|author{time.time_ns()}'
+        self.authors = []
+        for seq in range(1, 86):
+            author = User(id=f'{prefix}-{seq}', name=f'Author {seq}')
+            author.insert()
+            self.authors.append(author.id)
+            Post(user_id=author.id, thread_id=thread.id, page_id=Page.ensure(thread.id, (seq - 1) // 40 + 1), seq=seq,
+                 content=f'Post by author {seq}').insert()
+        thread.post_count = 85
+        thread.page_count = 3
+        thread.update()
+        self.thread_id = thread.id
+
+    def get_pages(self):
+        statements = []
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        counts = []
+        with self.app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            for page_number in (1, 2, 3):
+                before = len(statements)
+                res = self.client().get(f'/threads/{self.thread_id}/{page_number}')
+                self.assertEqual(res.status_code, 200)
+                posts = json.loads(res.data)['page']['posts']
+                seqs = range((page_number - 1) * 40 + 1, min(page_number * 40, 85) + 1)
+                self.assertEqual([post['user_name'] for post in posts], [f'Author {seq}' for seq in seqs])
+                counts.append(len(statements) - before)
+        finally:
+            with self.app.app_context():
+                event.remove(db.engine, 'before_cursor_execute', record)
+        return counts
+
+    def test_statement_count_does_not_grow_with_authors(self):
+        user_name_cache.invalidate()
+        # Thread row, the page's posts and one IN query for its 40, 40 and 5 distinct authors
+        self.assertEqual(self.get_pages(), [3, 3, 3])
+        # Names now come from the cache
+        self.assertEqual(self.get_pages(), [2, 2, 2])
+
+    def test_only_name_changes_invalidate_thread_pages(self):
+        def version():
+            return response_cache.versions(['user-names'])['user-names']
+        with self.app.app_context():
+            before = version()
+            author = User.query.get(self.authors[0])
+            author.set_status('BANNED')
+            author.update()
+            User(id=f'{self.authors[0]}-signup', name='Newcomer').insert()
+            self.assertEqual(version(), before)
+            author.name = 'Renamed author'
+            author.update()
+            self.assertEqual(version(), before + 1)
+        res = self.client().get(f'/threads/{self.thread_id}/1')
+        self.assertEqual(json.loads(res.data)['page']['posts'][0]['user_name'], 'Renamed author')
+
+    def test_missing_thread_or_page_is_404(self):
+        self.assertEqual(self.client().get(f'/threads/{self.thread_id}/4').status_code, 404)
+        self.assertEqual(self.client().get('/threads/0/1').status_code, 404)
+
+
+def table_rows():
+    '''
+    Every row the export covers, as a dict of table name -> list of row dicts in id order
+    '''
+    return {
+        name: [dict(row) for row in db.session.execute(db.select(table).order_by(table.c.id)).mappings()]
+        for name, table in bulk.TABLES.items()
+    }
+
+class BulkRoundTripTest(DatabaseTestCase):
+    def seed(self):
+        from datetime import datetime
+        rebuild_search_index()
+        self.word = f'roundtrip{time.time_ns()}'
+        user = User.query.get(USER_ID)
+        user.set_probation('1 WEEK')
+        user.update()
+        forum = Forum(name=f'Export {self.word[-9:]}', description='Round trip')
+        forum.insert()
+        thread = Thread(forum_id=forum.id, title=f'{self.word} thread', user_id=USER_ID)
+        thread.insert()
+        thread.locked = True
+        thread.update()
+        for seq in range(1, 4):
+            post = Post(user_id=USER_ID, thread_id=thread.id, page_id=Page.ensure(thread.id, 1), seq=seq,
+                        content=f'{self.word} post {seq}' if seq == 2 else f'Plain post {seq}',
+                        date_edited=datetime(2024, 2, 29, 12, 30, 15, 123456) if seq == 3 else None)
+            post.insert()
+            if seq == 2:
+                self.post_id = post.id
+
+    def test_export_then_import_into_an_empty_database(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'dump.ndjson.gz')
+            with self.app.app_context():
+                exported = bulk.export_ndjson(path, batch_size=7)
+                rows = table_rows()
+            target = create_app(test_config=True)
+            with target.app_context():
+                setup_db(target, f'sqlite:///{directory}/target.db')
+                rebuild_search_index()
+                imported = bulk.import_ndjson(path, batch_size=7)
+                self.assertEqual(imported, {table: count for table, count in exported.items() if count})
+                self.assertEqual(table_rows(), rows)
+                # Ids continue after the imported ones
+                forum = Forum(name='Created after import', description='Fresh id')
+                forum.insert()
+                self.assertEqual(forum.id, max(row['id'] for row in rows['forums']) + 1)
+                # The imported rows went through the search index triggers
+                results, _ = search_content(self.word)
+                self.assertEqual([result['id'] for result in results], [self.post_id])
+                results, _ = search_content(self.word, 'threads')
+                self.assertEqual(len(results), 1)
+
+
+class SeedTest(unittest.TestCase):
+    SHAPE = {'forums': 3, 'threads': 8, 'posts': 300, 'users': 20}
+
+    def seed_database(self, path):
+        app = create_app(test_config=True)
+        with app.app_context():
+            setup_db(app, f'sqlite:///{path}')
+            with mock.patch('seed.response_cache'):
+                counts = seed_forum(**self.SHAPE, s=1.1, seed_value=7, batch_size=25)
+            return counts, table_rows()
+
+    def test_same_seed_writes_the_same_consistent_forum(self):
+        with tempfile.TemporaryDirectory() as directory:
+            counts, rows = self.seed_database(os.path.join(directory, 'first.db'))
+            self.assertEqual(self.seed_database(os.path.join(directory, 'second.db')), (counts, rows))
+        self.assertEqual(counts, self.SHAPE)
+        self.assertEqual({name: len(rows[name]) for name in ('forums', 'threads', 'posts', 'users')}, self.SHAPE)
+        pages = {page['id']: page for page in rows['pages']}
+        posts_by_thread = {}
+        for post in rows['posts']:
+            posts_by_thread.setdefault(post['thread_id'], []).append(post)
+        self.assertEqual(set(posts_by_thread), {thread['id'] for thread in rows['threads']})
+        self.assertTrue(any(thread['page_count'] > 1 for thread in rows['threads']))
+        for thread in rows['threads']:
+            posts = sorted(posts_by_thread[thread['id']], key=lambda post: post['seq'])
+            self.assertEqual([post['seq'] for post in posts], list(range(1, thread['post_count'] + 1)))
+            self.assertEqual(thread['page_count'], count_pages(thread['post_count']))
+            thread_pages = sorted(page['page_number'] for page in rows['pages'] if page['thread_id'] == thread['id'])
+            self.assertEqual(thread_pages, list(range(1, thread['page_count'] + 1)))
+            for post in posts:
+                self.assertEqual(pages[post['page_id']]['thread_id'], thread['id'])
+                self.assertEqual(pages[post['page_id']]['page_number'], (post['seq'] - 1) // POSTS_PER_PAGE + 1)
+            dates = [post['date_created'] for post in posts]
+            self.assertEqual(dates, sorted(dates))
+            self.assertEqual((thread['last_post_at'], thread['last_poster']), (dates[-1], posts[-1]['user_id']))
+
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     """ Resets the database each time the test suite starts"""
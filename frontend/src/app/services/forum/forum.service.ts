@@ -3,7 +3,7 @@ import { Injectable } from '@angular/core';
 import { ActivatedRoute, Router } from '@angular/router';
 import { StateService, ViewState } from '../state.service';
 import { ForumResponse, Thread } from 'src/app/view/forum/forum.component';
-import { BehaviorSubject, Subscription, take } from 'rxjs';
+import { BehaviorSubject, EMPTY, Observable, Subscription, expand, reduce, take } from 'rxjs';
 import { AbstractControl, FormControl, FormGroup, Validators } from '@angular/forms';
 import { AuthService } from '../auth/auth-service.service';
 
@@ -30,15 +30,24 @@ export class ForumService {
     }
     console.log('getting forum', id)
     this.loading = true;
-    this.responseSubscription = this.http.get<ForumResponse>(`http://127.0.0.1:5000/forum/${id}`).pipe(take(1)).subscribe((response: ForumResponse) => {
-      console.log(response);
+    // The API returns a forum's threads a page at a time, so follow next_cursor until every page is loaded
+    this.responseSubscription = this.getForumPage(id).pipe(
+      expand((response: ForumResponse) => response.next_cursor ? this.getForumPage(id, response.next_cursor) : EMPTY),
+      reduce((pages: ForumResponse[], response: ForumResponse) => [...pages, response], [] as ForumResponse[])
+    ).subscribe((pages: ForumResponse[]) => {
+      console.log(pages);
       this.loading = false;
-      this.stateService.setState({ forum: response.forum })
-      this.threads.next(response.threads);
+      this.stateService.setState({ forum: pages[0].forum })
+      this.threads.next(pages.flatMap((page: ForumResponse) => page.threads));
       this.responseSubscription.unsubscribe();
     })
   }
 
+  private getForumPage(id: string, cursor?: string): Observable<ForumResponse> {
+    const params: Record<string, string | number> = cursor ? { limit: 100, cursor } : { limit: 100 };
+    return this.http.get<ForumResponse>(`http://127.0.0.1:5000/forum/${id}`, { params });
+  }
+
   public forumThreads(): BehaviorSubject<Thread[]> {
     return this.threads;
   }
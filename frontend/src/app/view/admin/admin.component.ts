@@ -1,7 +1,7 @@
 import { HttpClient } from '@angular/common/http';
 import { Component, OnInit } from '@angular/core';
 import { FormControl, FormGroup, Validators } from '@angular/forms';
-import { take } from 'rxjs';
+import { EMPTY, Observable, expand, reduce, take } from 'rxjs';
 import { AuthService } from 'src/app/services/auth/auth-service.service';
 
 type AdminView = 'forum' | 'ban';
@@ -22,7 +22,8 @@ export type User = {
 
 export type UserListResponse = {
   status: 'SUCCESS' | 'FAILURE',
-  users: User[]
+  users: User[],
+  next_cursor?: string | null
 }
 
 @Component({
@@ -65,9 +66,16 @@ export class AdminComponent implements OnInit {
   }
 
   protected getUserList(): void {
-    const subscription = this.http.get<UserListResponse>('http://127.0.0.1:5000/admin/users', { headers: this.auth.getHeaders()}).pipe(take(1)).subscribe((response: UserListResponse) => {
-      if (response.status === 'SUCCESS') {
-        this.userListResponse = response;
+    // The API returns the user list a page at a time, so follow next_cursor until every page is loaded
+    const subscription = this.getUserListPage().pipe(
+      expand((response: UserListResponse) => response.status === 'SUCCESS' && response.next_cursor ? this.getUserListPage(response.next_cursor) : EMPTY),
+      reduce((pages: UserListResponse[], response: UserListResponse) => [...pages, response], [] as UserListResponse[])
+    ).subscribe((pages: UserListResponse[]) => {
+      if (pages.every((page: UserListResponse) => page.status === 'SUCCESS')) {
+        this.userListResponse = {
+          status: 'SUCCESS',
+          users: pages.flatMap((page: UserListResponse) => page.users)
+        };
       } else {
         this.userListResponse = {
           status: 'FAILURE',
@@ -78,6 +86,11 @@ export class AdminComponent implements OnInit {
     })
   }
 
+  private getUserListPage(cursor?: string): Observable<UserListResponse> {
+    const params: Record<string, string | number> = cursor ? { limit: 100, cursor } : { limit: 100 };
+    return this.http.get<UserListResponse>('http://127.0.0.1:5000/admin/users', { headers: this.auth.getHeaders(), params });
+  }
+
   protected selectAction(formType: AdminView): void {
     this.view = formType;
   }
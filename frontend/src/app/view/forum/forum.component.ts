@@ -39,7 +39,8 @@ export type Post = {
 export type ForumResponse = {
   status: 'SUCCESS' | 'FAILURE';
   forum: Forum;
-  threads: Thread[]
+  threads: Thread[];
+  next_cursor: string | null
 }
 
 @Component({